@@ -1,15 +1,203 @@
+import asyncio
 import controller as ctrl
 import model as md
-from fastapi import FastAPI, HTTPException, Request, Response
+import cache
+import storage
+import name_index
+import export
+import metrics
+import snapshot
+import serialization
+import stats
+import singleflight
+import limiter
+import invalidation
+from typing import List, Optional
+from loguru import logger
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
-# Initialize the FastAPI app
+# Initialize the FastAPI app and its access log
+ctrl.init_logger()
 app = FastAPI()
+app.router.route_class = metrics.TimedRoute
+# Token buckets of the clients and global concurrency cap, the refused requests being logged and measured
+rate_limiter = limiter.RateLimiter()
+admission = limiter.Admission()
+app.add_middleware(limiter.LimiterMiddleware, rate_limiter=rate_limiter, admission=admission)
+app.add_middleware(ctrl.AccessLogMiddleware)
+# Outermost : the latency includes the access log
+app.add_middleware(metrics.MetricsMiddleware)
 
-# Initialize the database connection
-collection = ctrl.init_collection()
+# Database connection of this worker, opened at startup by every worker process, every query
+# being run outside of the event loop
+client = None
+collection = None
+names = None
+stats_collection = None
+# Sirets written by every worker, polled to invalidate the cache of this one
+invalidations = None
+invalidation_task = None
+# Loading of md.PREWARM_FILE into the cache, the worker being ready once it is done
+prewarm_task = None
+# Whether the unique siret indexes were checked, and why the database can't serve this worker if
+# they are missing : the worker isn't ready until they are checked and built
+indexes_checked = False
+index_error = None
 
-@app.get("/get", response_description="Get informations from a given siret code")
-async def fetch_siret_info(request: Request, response: Response, siret:int):
+# Cache of the siret lookups, invalidated by every write
+company_cache = cache.TTLCache()
+# Concurrent lookups of the same siret and fields, sharing a single query and serialization
+lookups = singleflight.SingleFlight("get")
+
+@app.exception_handler(snapshot.UnsupportedOperation)
+async def unsupported_operation(request: Request, error: snapshot.UnsupportedOperation):
+    """
+    Answer the writes and the queries the snapshot storage backend can't serve with a 501 HTTP error.
+    """
+    return JSONResponse(status_code=501, content={"detail": str(error)})
+
+@app.on_event("startup")
+async def startup():
+    """
+    Open the connection pool of this worker, check the unique siret indexes and start the cache pre-warming.
+    """
+    global client, collection, names, stats_collection, invalidations, invalidation_task, prewarm_task, indexes_checked
+    indexes_checked = False
+    client = ctrl.init_client()
+    collection = storage.AsyncCollection(ctrl.init_collection(client=client))
+    names = storage.AsyncCollection(ctrl.init_collection(name=md.NAMES_COLLECTION_NAME, client=client))
+    stats_collection = storage.AsyncCollection(ctrl.init_collection(name=md.STATS_COLLECTION_NAME, client=client))
+
+    # A database unreachable at boot leaves the worker alive but not ready, the readiness probe checking again
+    try:
+        await check_indexes()
+    except PyMongoError as error:
+        logger.error("Database unavailable at startup : {}".format(error))
+
+    # The other workers cache the companies too, the snapshot backend has no writes
+    if md.STORAGE_BACKEND != "snapshot" and md.CACHE_SYNC_INTERVAL > 0:
+        invalidations = storage.AsyncCollection(ctrl.init_collection(name=md.CACHE_INVALIDATIONS_COLLECTION_NAME, client=client), pool_size=2)
+        # A small collection, its index built right away
+        try:
+            await invalidations.run(invalidation.ensure_indexes, invalidations.collection)
+        except PyMongoError as error:
+            logger.error("Cache invalidations unavailable at startup : {}".format(error))
+        invalidation_task = asyncio.ensure_future(invalidation.follow(invalidations, company_cache))
+
+    # The worker answers while the cache is warming up, but isn't ready
+    if md.PREWARM_FILE:
+        prewarm_task = asyncio.ensure_future(prewarm(md.PREWARM_FILE))
+
+async def check_indexes():
+    """
+    Check the unique siret indexes the writes rely on to reject the duplicated companies.
+
+    They are built by data_integration.py : a worker only checks them, the snapshot keys being
+    unique by construction.
+
+    Raises:
+        pymongo.errors.PyMongoError: If the database can't be reached.
+    """
+    global indexes_checked, index_error
+    if md.STORAGE_BACKEND != "snapshot":
+        missing = [c.collection.name for c in (collection, names) if not await c.run(ctrl.has_unique_siret_index, c.collection)]
+        if missing:
+            index_error = "No unique siret index on {}, run `python data_integration.py --migrate-indexes`".format(", ".join(missing))
+            logger.error(index_error)
+        else:
+            index_error = None
+    indexes_checked = True
+
+async def prewarm(path: str):
+    """
+    Load the companies of a file of hot sirets, one per line, into the lookup cache.
+
+    Args:
+        path (str): Path of the file. At most md.CACHE_SIZE sirets are loaded.
+    """
+    # A failed pre-warming only leaves the cache cold
+    try:
+        with open(path) as file:
+            sirets = [int(line) for line in file if line.strip()][:md.CACHE_SIZE]
+        async for _ in ctrl.iter_batch_results(collection, sirets, cache=company_cache):
+            pass
+        logger.info("Cache pre-warmed with {} siret(s) from {}".format(len(sirets), path))
+    except Exception as error:
+        logger.warning("Cache pre-warming from {} failed : {}".format(path, error))
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+    Close the connection pool, then flush the access log queue and close the log file.
+    """
+    for task in (prewarm_task, invalidation_task):
+        if task is not None:
+            task.cancel()
+    for async_collection in (collection, names, stats_collection, invalidations):
+        if async_collection is not None:
+            async_collection.close()
+    if client is not None:
+        client.close()
+    await logger.complete()
+    logger.remove()
+
+@app.get("/health/live", response_description="Tell whether the worker is running")
+async def liveness():
+    """
+    Answer as long as the event loop of the worker runs, without touching the database.
+    """
+    return {"status": "alive"}
+
+@app.get("/health/ready", response_description="Tell whether the worker can serve requests")
+async def readiness():
+    """
+    Check that the worker is started, its cache pre-warmed and its database indexed and answering.
+
+    Raises:
+        HTTPException: 503 if the worker is starting, pre-warming its cache, misses the unique siret
+        indexes or can't reach the database.
+    """
+    if collection is None or (prewarm_task is not None and not prewarm_task.done()):
+        raise HTTPException(status_code=503, detail="Starting")
+    try:
+        # Checked again until the indexes are built, as long as the database couldn't be reached
+        if not indexes_checked or index_error is not None:
+            await asyncio.wait_for(check_indexes(), md.READY_TIMEOUT)
+        await asyncio.wait_for(collection.ping(), md.READY_TIMEOUT)
+    except Exception as error:
+        raise HTTPException(status_code=503, detail=f"Database unavailable : {type(error).__name__}")
+    if index_error is not None:
+        raise HTTPException(status_code=503, detail=index_error)
+
+    return {"status": "ready"}
+
+def check_fields(fields: Optional[str]):
+    """
+    Expand the `fields` parameter of a route and check the names against the company model.
+
+    Args:
+        fields (str, optional): Comma separated fields or presets, None for every field.
+
+    Returns:
+        list[str] | None: The field names to return, None for every field.
+
+    Raises:
+        HTTPException: If a requested field is unknown.
+    """
+    if fields is None:
+        return None
+    field_names = ctrl.parse_fields(fields)
+    unknown = [name for name in field_names if name not in md.CompanyModel.__fields__]
+    if len(unknown) > 0:
+        raise HTTPException(status_code=400, detail=f"Unknown fields : {', '.join(unknown)}")
+
+    return field_names
+
+@app.get("/get", response_description="Get informations from a given siret code", response_model=List[md.SparseCompanyModel], response_model_exclude_none=True)
+async def fetch_siret_info(request: Request, response: Response, siret:int, fields: Optional[str] = None):
     """
     Retrieve a company's information from the database based on its siret code.
     
@@ -17,27 +205,251 @@ async def fetch_siret_info(request: Request, response: Response, siret:int):
         request (Request): The request object provided by FastAPI.
         response (Response): The response object provided by FastAPI.
         siret (int): The siret code of the company to retrieve.
+        fields (str, optional): Comma separated fields or presets (address, activity, status) to return. Default is every field.
     
     Returns:
         list[dict]: A list of dictionaries representing the company's information.
     
     Raises:
-        HTTPException: If a company with the given siret code is not found.
+        HTTPException: If a requested field is unknown or if a company with the given siret code is not found.
     """
+    field_names = check_fields(fields)
 
-    # Fetch from the DB based on the siret code
-    cursor = collection.find({"siret":siret}, {"_id":False})
-    # Parse the result
-    results = [{k:str(v) for k,v in company.items()} for company in cursor]
+    # Fetch from the DB based on the siret code, the identical lookups in flight sharing the encoded result
+    async def lookup():
+        results = await ctrl.find_cached_result(collection, company_cache, siret, field_names)
+        return serialization.encode_companies(results) if len(results) > 0 else None
+    body = await lookups.do((siret, None if field_names is None else tuple(field_names)), lookup)
 
-    # Return the parsed result if found, otherwise raise an HTTPException
-    if len(results) > 0 :
-        ctrl.log(request, response)
-        return results
+    # Return the encoded result if found, otherwise raise an HTTPException
+    if body is not None :
+        return serialization.body_response(body)
     else:
-        ctrl.log(request, response, 404)
         raise HTTPException(status_code=404, detail=f"Siret code : {siret} -> not found")
 
+async def batch_response(request: Request, response: Response, sirets: List[int], format: str):
+    """
+    Resolve a batch of siret codes and build the response in the requested format.
+
+    Args:
+        request (Request): The request object provided by FastAPI.
+        response (Response): The response object provided by FastAPI.
+        sirets (list[int]): The siret codes of the companies to retrieve.
+        format (str): "json" to return a single list, "ndjson" to stream one line per siret.
+
+    Returns:
+        Response | StreamingResponse: One entry per requested siret, in the input order.
+
+    Raises:
+        HTTPException: If the batch is empty, too large or the format is unknown.
+    """
+    if len(sirets) == 0 or len(sirets) > md.BATCH_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"A batch must contain between 1 and {md.BATCH_MAX_SIZE} siret codes")
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail=f"Unknown format : {format}. Expected json or ndjson")
+
+    results = ctrl.iter_batch_results(collection, sirets, cache=company_cache)
+    if format == "ndjson":
+        return StreamingResponse((serialization.dumps(serialization.batch_entry(result)) + b"\n" async for result in results), media_type="application/x-ndjson")
+    return serialization.json_response([serialization.batch_entry(result) async for result in results])
+
+@app.post("/get/batch", response_description="Get informations from a list of siret codes", response_model=List[md.BatchResultModel], response_model_exclude_none=True)
+async def fetch_batch_siret_info(request: Request, response: Response, batch: md.BatchSiretModel, format: str = "json"):
+    """
+    Retrieve several companies' information from the database in a single request.
+
+    Args:
+        request (Request): The request object provided by FastAPI.
+        response (Response): The response object provided by FastAPI.
+        batch (BatchSiretModel): The siret codes of the companies to retrieve.
+        format (str, optional): "json" (default) or "ndjson" to stream the results.
+
+    Returns:
+        list[dict]: One entry per requested siret with its found flag and results, in the input order.
+
+    Raises:
+        HTTPException: If the batch is empty, too large or the format is unknown.
+    """
+    return await batch_response(request, response, batch.sirets, format)
+
+@app.get("/get/batch", response_description="Get informations from a list of siret codes", response_model=List[md.BatchResultModel], response_model_exclude_none=True)
+async def fetch_batch_siret_info_query(request: Request, response: Response, siret: List[int] = Query(...), format: str = "json"):
+    """
+    Retrieve several companies' information from the database, the siret codes being given as repeated query parameters.
+
+    Args:
+        request (Request): The request object provided by FastAPI.
+        response (Response): The response object provided by FastAPI.
+        siret (list[int]): The siret codes of the companies to retrieve (`?siret=...&siret=...`).
+        format (str, optional): "json" (default) or "ndjson" to stream the results.
+
+    Returns:
+        list[dict]: One entry per requested siret with its found flag and results, in the input order.
+
+    Raises:
+        HTTPException: If the batch is empty, too large or the format is unknown.
+    """
+    return await batch_response(request, response, siret, format)
+
+@app.get("/search", response_description="Search the companies by siren, postal code, commune or activity", response_model=md.SearchResultModel, response_model_exclude_none=True)
+async def search_companies(
+    request: Request,
+    response: Response,
+    siren: Optional[int] = None,
+    codePostalEtablissement: Optional[str] = None,
+    codeCommuneEtablissement: Optional[str] = None,
+    activitePrincipaleEtablissement: Optional[str] = None,
+    etatAdministratifEtablissement: Optional[md.EtatAdministratif] = None,
+    limit: int = Query(md.SEARCH_DEFAULT_LIMIT, ge=1, le=md.SEARCH_MAX_LIMIT),
+    after: Optional[int] = None,
+    fields: Optional[str] = None,
+):
+    """
+    Retrieve the companies matching the given criteria, one page at a time, sorted by siret.
+
+    Args:
+        request (Request): The request object provided by FastAPI.
+        response (Response): The response object provided by FastAPI.
+        siren, codePostalEtablissement, codeCommuneEtablissement, activitePrincipaleEtablissement: The searched values, at least one is required.
+        etatAdministratifEtablissement (EtatAdministratif, optional): Only return the active (A) or closed (F) companies.
+        limit (int, optional): Maximum number of companies of the page. Default is md.SEARCH_DEFAULT_LIMIT.
+        after (int, optional): The `next` cursor of the previous page.
+        fields (str, optional): Comma separated fields or presets to return. Default is every field.
+
+    Returns:
+        dict: The companies of the page and the `next` cursor, absent on the last page.
+
+    Raises:
+        HTTPException: If no criterion is given or if a requested field is unknown.
+    """
+    criteria = {
+        "siren": siren,
+        "codePostalEtablissement": codePostalEtablissement,
+        "codeCommuneEtablissement": codeCommuneEtablissement,
+        "activitePrincipaleEtablissement": activitePrincipaleEtablissement,
+    }
+    if all(value is None for value in criteria.values()):
+        raise HTTPException(status_code=400, detail=f"At least one of {', '.join(md.SEARCH_FIELDS)} is required")
+    if etatAdministratifEtablissement is not None:
+        criteria["etatAdministratifEtablissement"] = etatAdministratifEtablissement.value
+
+    return serialization.search_response(await ctrl.search(collection, criteria, limit, after, check_fields(fields)))
+
+@app.get("/search/name", response_description="Search the companies by name", response_model=md.NameSearchResultModel)
+async def search_company_names(request: Request, response: Response, q: str, limit: int = Query(md.NAME_DEFAULT_LIMIT, ge=1, le=md.NAME_MAX_LIMIT)):
+    """
+    Retrieve the companies whose denomination or enseignes best match the searched name.
+
+    The search ignores the case and the accents, completes the last word and tolerates one typo per word.
+
+    Args:
+        request (Request): The request object provided by FastAPI.
+        response (Response): The response object provided by FastAPI.
+        q (str): The searched name.
+        limit (int, optional): Maximum number of companies returned. Default is md.NAME_DEFAULT_LIMIT.
+
+    Returns:
+        dict: The siret, names and match score of the best companies, best first.
+    """
+    return {"results": await name_index.search(names, q, limit)}
+
+@app.get("/export", response_description="Export the companies as NDJSON, CSV or Parquet")
+async def export_companies(
+    request: Request,
+    response: Response,
+    format: str = "ndjson",
+    siren: Optional[int] = None,
+    codePostalEtablissement: Optional[str] = None,
+    codeCommuneEtablissement: Optional[str] = None,
+    activitePrincipaleEtablissement: Optional[str] = None,
+    etatAdministratifEtablissement: Optional[md.EtatAdministratif] = None,
+    departement: Optional[str] = None,
+    fields: Optional[str] = None,
+    batch_size: int = Query(md.EXPORT_BATCH_SIZE, ge=1, le=md.EXPORT_MAX_BATCH_SIZE),
+    gzip: bool = False,
+):
+    """
+    Stream every company matching the given criteria, straight from the database cursor.
+
+    Args:
+        request (Request): The request object provided by FastAPI.
+        response (Response): The response object provided by FastAPI.
+        format (str, optional): "ndjson" (default), "csv" or "parquet" (one row group per batch).
+        siren, codePostalEtablissement, codeCommuneEtablissement, activitePrincipaleEtablissement: The exported values.
+        etatAdministratifEtablissement (EtatAdministratif, optional): Only export the active (A) or closed (F) companies.
+        departement (str, optional): Only export the companies of this département (prefix of the commune code).
+        fields (str, optional): Comma separated fields or presets to export. Default is every field.
+        batch_size (int, optional): Number of companies read and encoded at once. Default is md.EXPORT_BATCH_SIZE.
+        gzip (bool, optional): Compress the stream with gzip.
+
+    Returns:
+        StreamingResponse: The exported companies.
+
+    Raises:
+        HTTPException: If the format is unknown or not available, or if a requested field is unknown.
+    """
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format : {format}. Expected {', '.join(export.FORMATS)}")
+    if format == "parquet" and export.pa is None:
+        raise HTTPException(status_code=400, detail="The parquet format requires the pyarrow package")
+
+    criteria = {
+        "siren": siren,
+        "codePostalEtablissement": codePostalEtablissement,
+        "codeCommuneEtablissement": codeCommuneEtablissement,
+        "activitePrincipaleEtablissement": activitePrincipaleEtablissement,
+        "etatAdministratifEtablissement": etatAdministratifEtablissement.value if etatAdministratifEtablissement else None,
+    }
+    filter = export.export_filter(criteria, departement)
+    stream = export.export_stream(collection, filter, format, check_fields(fields), batch_size, gzip)
+
+    headers = {"Content-Disposition": f"attachment; filename=companies.{format}"}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(stream, media_type=export.FORMATS[format], headers=headers)
+
+@app.get("/cache/stats", response_description="Get the counters of the lookup cache")
+async def fetch_cache_stats():
+    """
+    Retrieve the hit, miss and eviction counters of the siret lookup cache.
+
+    Returns:
+        dict: The counters of the cache of this worker.
+    """
+    return company_cache.stats()
+
+@app.get("/metrics", response_description="Get the metrics of the API in the Prometheus text format", response_class=PlainTextResponse)
+async def fetch_metrics():
+    """
+    Retrieve the request latencies, the stage timings, the Mongo pool usage and the cache counters of this worker.
+
+    Returns:
+        PlainTextResponse: The metrics in the Prometheus text format.
+    """
+    for name, value in company_cache.stats().items():
+        metrics.CACHE.set(value, name)
+
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats", response_description="Get the number of companies per activity, headcount band, département and state")
+async def fetch_stats(dimension: Optional[str] = None):
+    """
+    Retrieve the materialized counts of the companies, without scanning the companies.
+
+    Args:
+        dimension (str, optional): Only return the counts of this dimension of md.STATS_DIMENSIONS. Default is every dimension.
+
+    Returns:
+        dict: The total and the number of companies per value of every dimension.
+
+    Raises:
+        HTTPException: If the dimension is unknown.
+    """
+    if dimension is not None and dimension not in md.STATS_DIMENSIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown dimension : {dimension}. Expected one of {', '.join(md.STATS_DIMENSIONS)}")
+
+    return await stats.read(stats_collection, dimension)
+
 @app.post("/", response_description="Add a new company")
 async def add_company(request: Request, response: Response, company: md.CompanyModel):
     """
@@ -53,32 +465,112 @@ async def add_company(request: Request, response: Response, company: md.CompanyM
                       if the siret code is not consistent with the siren and nic numbers, 
                       or if the insertion into the database fails.
     """
-    # Check if a company with the same siret code already exists
-    already_exist = ctrl.find_result(collection, company.siret)
-    if (len(already_exist)>0):
+    # Check if the siret code is consistent with the siren and nic numbers
+    if not ctrl.consistency_siret(company.siret, company.siren, company.nic):
+        raise HTTPException(status_code=400, detail=f"Inputs entered are not consistent. Siret must be composed of the siren number and the nic number.")
+
+    # Insert the new company, the unique siret index rejecting an existing one
+    new_company = ctrl.create_new_company(company)
+    try:
+        await collection.insert_one(new_company)
+    except DuplicateKeyError:
         raise HTTPException(status_code=409, detail=f"A company with {company.siret} siret code already exists")
-    else:
-        # Check if the siret code is consistent with the siren and nic numbers
-        if(ctrl.consistency_siret(company.siret, company.siren, company.nic)):
-            # Create a new company document
-            new_company = ctrl.create_new_company(company)
-            # Insert the new company into the database
-            collection.insert_one(new_company)
-            # Verify that the insertion was successful
-            confirmed_insertion = ctrl.find_result(collection, company.siret)
-            if len(confirmed_insertion)==1:
-                ctrl.log(request, response)
-                raise HTTPException(status_code=200, detail=f"The insertion proceed correctly")
-            else:
-                ctrl.log(request, response, 400)
-                raise HTTPException(status_code=400, detail=f"The insertion doesn't work")
-        else:
-            ctrl.log(request, response, 400)
-            raise HTTPException(status_code=400, detail=f"Inputs entered are not consistent. Siret must be composed of the siren number and the nic number.")
+    await after_write({company.siret: new_company}, {company.siret: None})
+    raise HTTPException(status_code=200, detail=f"The insertion proceed correctly")
+
+@app.post("/bulk", response_description="Add several companies", response_model=md.BulkReportModel)
+async def add_companies(request: Request, response: Response, companies: List[md.CompanyModel]):
+    """
+    Add several companies to the database with a single unordered bulk write.
 
+    Args:
+        request (Request): The request object provided by FastAPI.
+        response (Response): The response object provided by FastAPI.
+        companies (list[CompanyModel]): The companies to add to the database.
+
+    Returns:
+        dict: The status (200, 400 or 409) and detail of every company, in the input order.
+
+    Raises:
+        HTTPException: If the list is empty or too large.
+    """
+    check_bulk_size(companies)
+    report, written, previous = await ctrl.bulk_insert(collection, companies)
+    await after_write(written, previous)
+
+    return {"results": report}
+
+@app.put("/bulk", response_description="Update several companies", response_model=md.BulkReportModel)
+async def update_companies(request: Request, response: Response, companies: List[md.BulkUpdateCompanyModel]):
+    """
+    Update several companies, each update returning the company it replaced.
+
+    Args:
+        request (Request): The request object provided by FastAPI.
+        response (Response): The response object provided by FastAPI.
+        companies (list[BulkUpdateCompanyModel]): The siret and updated information of every company.
+
+    Returns:
+        dict: The status (200 or 404) and detail of every company, in the input order.
+
+    Raises:
+        HTTPException: If the list is empty or too large.
+    """
+    check_bulk_size(companies)
+    report, written, previous = await ctrl.bulk_update(collection, companies)
+    await after_write(written, previous)
+
+    return {"results": report}
+
+@app.delete("/bulk", response_description="Delete several companies", response_model=md.BulkReportModel)
+async def delete_companies(request: Request, response: Response, batch: md.BatchSiretModel):
+    """
+    Delete several companies, each deletion returning the company it deleted.
+
+    Args:
+        request (Request): The request object provided by FastAPI.
+        response (Response): The response object provided by FastAPI.
+        batch (BatchSiretModel): The siret codes of the companies to delete.
+
+    Returns:
+        dict: The status (200 or 404) and detail of every siret, in the input order.
+
+    Raises:
+        HTTPException: If the list is empty or too large.
+    """
+    check_bulk_size(batch.sirets)
+    report, written, previous = await ctrl.bulk_delete(collection, batch.sirets)
+    await after_write(written, previous)
+
+    return {"results": report}
+
+def check_bulk_size(items: list):
+    """
+    Raise an HTTPException if a bulk request is empty or larger than md.BULK_MAX_SIZE.
+    """
+    if len(items) == 0 or len(items) > md.BULK_MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"A bulk request must contain between 1 and {md.BULK_MAX_SIZE} companies")
+
+async def after_write(written: dict, previous: dict):
+    """
+    Invalidate the cached companies written by a request, in every worker, update their name index
+    entries and the statistics.
+
+    Args:
+        written (dict): The written companies as stored, None for the deleted ones, keyed by siret.
+        previous (dict): The same companies before the write, None for the inserted ones, keyed by siret.
+    """
+    for siret in written:
+        company_cache.invalidate(siret)
+    # The lookups in flight may have read the companies before the write
+    lookups.forget(lambda key: key[0] in written)
+    if invalidations is not None:
+        await invalidation.publish(invalidations, written)
+    await ctrl.index_names(names, written)
+    await stats.apply(stats_collection, previous, written)
 
 @app.put("/{siret}", response_description="Update a company")
-def update_company(request: Request, response: Response, siret:int, company:md.UpdateCompanyModel):
+async def update_company(request: Request, response: Response, siret:int, company:md.UpdateCompanyModel):
     """
     Update a company in the database.
     
@@ -91,21 +583,17 @@ def update_company(request: Request, response: Response, siret:int, company:md.U
     Raises:
         HTTPException: If a company with the given siret code does not exist, or if the update fails.
     """
-    # Check if a company with the given siret code exists
-    exist = ctrl.find_result(collection, siret)
-    if len(exist)==0:
-        ctrl.log(request, response, 404)
+    # Update the company's information, no company being returned if it doesn't exist
+    updated_company = ctrl.update_company(company)
+    previous_company = await collection.find_one_and_update({"siret":siret}, updated_company, projection={"_id": False}, return_document=ReturnDocument.BEFORE)
+    if previous_company is None:
         raise HTTPException(status_code=404, detail=f"The corporate with {siret} siret code doesn't exist")
-    else:
-        # Update the company's information
-        updated_company = ctrl.update_company(company)
 
-        collection.update_one({"siret":siret}, {"$set": updated_company})
-        ctrl.log(request, response, 200)
-        raise HTTPException(status_code=200, detail=f"The update proceed correctly")
+    await after_write({siret: ctrl.apply_update(previous_company, updated_company)}, {siret: previous_company})
+    raise HTTPException(status_code=200, detail=f"The update proceed correctly")
 
 @app.delete("/delete/{company_siret}", response_description="Delete a company")
-def delete_company(request: Request, response: Response, company_siret:int):
+async def delete_company(request: Request, response: Response, company_siret:int):
     """
     Delete a company from the database.
     
@@ -115,22 +603,12 @@ def delete_company(request: Request, response: Response, company_siret:int):
         company_siret (int): The siret code of the company to delete.
     
     Raises:
-        HTTPException: If a company with the given siret code does not exist, or if the deletion fails.
+        HTTPException: If a company with the given siret code does not exist.
     """
-
-    exist = ctrl.find_result(collection, company_siret)
-    if len(exist)==0:
-        ctrl.log(request, response, 404)
+    # Delete the company from the database, nothing being deleted if it doesn't exist
+    deleted_company = await collection.find_one_and_delete({"siret": company_siret}, projection=ctrl.projection(["siret"] + md.STATS_FIELDS))
+    if deleted_company is None:
         raise HTTPException(status_code=404, detail=f"The corporate with {company_siret} siret code doesn't exist")
-    else:
-        # Delete the company from the database
-        delete_result = collection.delete_one({"siret": company_siret})
-        # Verify that the deletion was successful
-        if delete_result.deleted_count == 1:
-            ctrl.log(request, response, 200)
-            raise HTTPException(status_code=200, detail=f"The deletion proceed correctly")
-        else:
-            ctrl.log(request, response, 400)
-            raise HTTPException(status_code=400, detail=f"The deletion doesn't work")
-
 
+    await after_write({company_siret: None}, {company_siret: deleted_company})
+    raise HTTPException(status_code=200, detail=f"The deletion proceed correctly")
@@ -0,0 +1,642 @@
+"""
+Benchmarks of the SIRET API.
+
+Every benchmark runs offline, against the configured mongod or, with --memory, against an in-memory
+stand-in (mongomock). The results are printed as JSON, and also written to --output so that two
+runs can be compared.
+
+Usage :
+    python benchmark.py generate --rows 1000000 --csv synthetic.csv
+    python benchmark.py [--memory] [--output results.json] micro [--rows 10000] [--iterations 10000]
+    python benchmark.py [--memory] [--output results.json] load [--scenario read|write|mixed] [--requests 10000] [--concurrency 32] [--url URL]
+    python benchmark.py scaling [--max-workers 8] [--clients 4] [--requests 20000] [--rows 10000]
+    python benchmark.py snapshot [--rows 200000] [--lookups 100000]
+    python benchmark.py logging [--requests 10000]
+    python benchmark.py export [--format ndjson] [--departement 75] [--batch-size 5000] [--gzip]
+"""
+import os
+import csv
+import sys
+import json
+import time
+import random
+import asyncio
+import platform
+import argparse
+import tempfile
+import subprocess
+import statistics
+import pymongo
+import export
+import storage
+import name_index
+import snapshot
+import serialization
+import stats
+import model as md
+import controller as ctrl
+from datetime import date, datetime, timedelta
+from loguru import logger
+from starlette.requests import Request
+from pymongo.errors import BulkWriteError
+
+# resource is Unix only, the peak memory of the exports isn't measured without it
+try:
+    import resource
+except ImportError:
+    resource = None
+
+## Synthetic SIRENE data
+# (codeCommuneEtablissement, codePostalEtablissement, libelleCommuneEtablissement, weight)
+COMMUNES = [
+    ("75056", "75001", "PARIS", 20), ("13055", "13001", "MARSEILLE", 5), ("69123", "69001", "LYON", 5),
+    ("31555", "31000", "TOULOUSE", 3), ("06088", "06000", "NICE", 3), ("44109", "44000", "NANTES", 2),
+    ("33063", "33000", "BORDEAUX", 2), ("59350", "59000", "LILLE", 2), ("2A004", "20000", "AJACCIO", 1),
+    ("97411", "97400", "SAINT-DENIS", 1),
+]
+TYPES_VOIE = ["RUE", "AV", "BD", "CHE", "PL", "ALL", "RTE", "IMP", "QUAI"]
+WORDS = ["BOULANGERIE", "GARAGE", "PHARMACIE", "CONSEIL", "TRANSPORTS", "HOLDING", "IMMOBILIER", "BATIMENT",
+         "RESTAURANT", "CAFE", "COIFFURE", "INFORMATIQUE", "MARTIN", "BERNARD", "DUBOIS", "PETIT", "DURAND",
+         "LEROY", "MOREAU", "SIMON", "LAURENT", "DU CENTRE", "DE LA GARE", "DES ALPES", "DU PORT"]
+ACTIVITES = ["10.71C", "45.20A", "47.73Z", "70.22Z", "49.41A", "64.20Z", "68.20B", "43.21A", "56.10A",
+             "56.30Z", "96.02A", "62.01Z", "47.11B", "86.21Z", "41.20A", "81.21Z", "85.59A", "94.99Z"]
+TRANCHES = [None, None, None, "NN", "00", "01", "02", "03", "11", "12", "21", "22", "31", "32", "41", "42", "51", "52", "53"]
+# Siren stride, prime with the 900 000 000 possible sirens : every row gets a different siren
+SIREN_STRIDE = 7919
+
+
+def random_date(rng, start_year=1950, end_year=2022):
+    """
+    Draw a date between two years.
+    """
+    return date(start_year, 1, 1) + timedelta(days=rng.randrange((end_year - start_year) * 365))
+
+def synthetic_company(rng, index):
+    """
+    Build a realistic company, its fields drawn with the distributions of the SIRENE stock file.
+
+    Args:
+        rng (random.Random): The random generator, seeded for reproducible companies.
+        index (int): Number of the company, which sets its siren.
+
+    Returns:
+        dict: The fields of a md.CompanyModel, None for the empty ones.
+    """
+    siren = 100000000 + (index * SIREN_STRIDE) % 900000000
+    nic = rng.choice([10, 11, 12, 13, 14, 17, 18, 19, 21, 23, 24, 25, 26, 27, 28, 35, 43])
+    if rng.random() < 0.5:
+        commune, postal, libelle, _ = rng.choices(COMMUNES, weights=[c[3] for c in COMMUNES])[0]
+    else:
+        # Any other commune of metropolitan France
+        departement = "{:02}".format(rng.choice([d for d in range(1, 96) if d != 20]))
+        number = rng.randrange(1, 700)
+        commune, postal, libelle = "{}{:03}".format(departement, number), "{}{:03}".format(departement, rng.randrange(0, 1000, 10)), "COMMUNE {}".format(number)
+    created = random_date(rng)
+    closed = rng.random() < 0.3
+    name = " ".join(rng.sample(WORDS, rng.randint(1, 3)))
+
+    return {
+        "siret": int("{}{:05}".format(siren, nic)),
+        "siren": siren,
+        "nic": nic,
+        "statutDiffusionEtablissement": "O" if rng.random() < 0.98 else "P",
+        "dateCreationEtablissement": created,
+        "trancheEffectifsEtablissement": rng.choice(TRANCHES),
+        "anneeEffectifsEtablissement": rng.choice([None, 2019, 2020, 2021]),
+        "activitePrincipaleRegistreMetiersEtablissement": None,
+        "dateDernierTraitementEtablissement": datetime(2022, 1, 1) + timedelta(seconds=rng.randrange(365 * 86400)),
+        "etablissementSiege": rng.random() < 0.6,
+        "nombrePeriodesEtablissement": rng.randint(1, 5),
+        "complementAdresseEtablissement": rng.choice([None] * 9 + ["BATIMENT B"]),
+        "numeroVoieEtablissement": str(rng.randint(1, 200)),
+        "indiceRepetitionEtablissement": rng.choice([None] * 19 + ["B"]),
+        "typeVoieEtablissement": rng.choice(TYPES_VOIE),
+        "libelleVoieEtablissement": rng.choice(WORDS[12:]),
+        "codePostalEtablissement": postal,
+        "libelleCommuneEtablissement": libelle,
+        "codeCommuneEtablissement": commune,
+        "dateDebut": created if not closed else random_date(rng, created.year, 2022),
+        "etatAdministratifEtablissement": "F" if closed else "A",
+        "enseigne1Etablissement": name if rng.random() < 0.3 else None,
+        "denominationUsuelleEtablissement": name if rng.random() < 0.2 else None,
+        "activitePrincipaleEtablissement": rng.choice(ACTIVITES),
+        "nomenclatureActivitePrincipaleEtablissement": "NAFRev2",
+        "caractereEmployeurEtablissement": rng.choice(["O", "N"]),
+    }
+
+def synthetic_companies(rows, seed=0, start=0):
+    """
+    Generate `rows` synthetic companies, always the same ones for a given seed.
+
+    Args:
+        rows (int): Number of companies.
+        seed (int, optional): Seed of the random generator.
+        start (int, optional): Index of the first company, to generate companies different from a previous call.
+
+    Returns:
+        Iterator[dict]: The fields of the companies.
+    """
+    rng = random.Random("{}:{}".format(seed, start))
+    for index in range(start, start + rows):
+        yield synthetic_company(rng, index)
+
+def write_csv(path, companies):
+    """
+    Write companies as a SIRENE stock file, loadable by data_integration.py.
+
+    Returns:
+        int: The number of rows written.
+    """
+    rows = 0
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.DictWriter(file, fieldnames=md.COMPANY_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        for company in companies:
+            writer.writerow({k: ("true" if v else "false") if isinstance(v, bool) else ("" if v is None else v) for k, v in company.items()})
+            rows += 1
+
+    return rows
+
+def seed_database(rows, seed=0, batch_size=10000):
+    """
+    Insert synthetic companies and their name index entries, the ones already there being skipped.
+
+    Returns:
+        int: The number of rows written.
+    """
+    collection = ctrl.init_collection()
+    names = ctrl.init_collection(name=md.NAMES_COLLECTION_NAME)
+    ctrl.ensure_siret_index(collection)
+    names.create_index("siret", unique=True)
+
+    batch = []
+    for company in synthetic_companies(rows, seed):
+        batch.append(ctrl.to_document(company))
+        if len(batch) == batch_size:
+            insert_batch(collection, names, batch)
+            batch = []
+    insert_batch(collection, names, batch)
+    ctrl.ensure_indexes(collection)
+    name_index.ensure_indexes(names)
+    stats.rebuild(collection, ctrl.init_collection(name=md.STATS_COLLECTION_NAME))
+
+    return rows
+
+def insert_batch(collection, names, documents):
+    """
+    Insert a batch of companies and of name index entries with unordered bulk writes.
+    """
+    entries = [entry for entry in map(name_index.build_entry, documents) if entry is not None]
+    for target, batch in [(collection, documents), (names, entries)]:
+        if len(batch) > 0:
+            try:
+                target.insert_many(batch, ordered=False)
+            except BulkWriteError as error:
+                # Only tolerate the companies of a previous run
+                if any(write_error["code"] != 11000 for write_error in error.details["writeErrors"]):
+                    raise
+
+def in_memory():
+    """
+    Replace the Mongo server by a single in-memory mongomock client shared by every collection.
+    Must be called before the app is imported.
+    """
+    import mongomock
+    client = mongomock.MongoClient()
+    pymongo.MongoClient = lambda *args, **kwargs: client
+
+
+def percentiles(samples):
+    """
+    Summarize a list of latencies given in seconds.
+
+    Args:
+        samples (list[float]): The measured latencies.
+
+    Returns:
+        dict: The number of samples and the mean, p50, p95 and p99 latencies in milliseconds.
+    """
+    ordered = sorted(samples)
+
+    def at(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 4)
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(statistics.mean(ordered) * 1000, 4),
+        "p50_ms": at(0.50),
+        "p95_ms": at(0.95),
+        "p99_ms": at(0.99),
+    }
+
+def timed(func, iterations):
+    """
+    Call a function `iterations` times and summarize the latency of the calls.
+    """
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+
+    return percentiles(samples)
+
+async def timed_async(func, iterations):
+    """
+    Await a coroutine function `iterations` times and summarize the latency of the calls.
+    """
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await func()
+        samples.append(time.perf_counter() - start)
+
+    return percentiles(samples)
+
+def fake_request(path="/get", method="GET"):
+    """
+    Build a request object as received by the handlers, without any HTTP server.
+    """
+    return Request({
+        "type": "http",
+        "scheme": "http",
+        "method": method,
+        "path": path,
+        "root_path": "",
+        "query_string": b"",
+        "headers": [],
+        "client": ("127.0.0.1", 50000),
+        "server": ("testserver", 80),
+    })
+
+def legacy_log(request, code_status, log_file):
+    """
+    Previous access log : the file sink was opened and closed for every request.
+    """
+    logger.add(log_file)
+    message = "{} {:<6} {}  | route : {}".format(request.client.host, request.method, code_status, request.url.path)
+    logger.info(message)
+    logger.remove()
+
+def bench_logging(args):
+    """
+    Compare the latency added to each request by the legacy and the queued access log.
+    """
+    request = fake_request()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        logger.remove()
+        samples = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            legacy_log(request, 200, os.path.join(tmp, "legacy.log"))
+            samples.append(time.perf_counter() - start)
+        results["legacy"] = percentiles(samples)
+
+        ctrl.init_logger(os.path.join(tmp, "queued.log"))
+        samples = []
+        for _ in range(args.requests):
+            start = time.perf_counter()
+            ctrl.log(request, 200)
+            samples.append(time.perf_counter() - start)
+        logger.remove()
+        results["queued"] = percentiles(samples)
+
+    return results
+
+def bench_generate(args):
+    """
+    Write a synthetic stock file, or load the synthetic companies straight into the database.
+    """
+    start = time.perf_counter()
+    if args.output_csv is not None:
+        rows = write_csv(args.output_csv, synthetic_companies(args.rows, args.seed))
+    else:
+        rows = seed_database(args.rows, args.seed)
+    elapsed = time.perf_counter() - start
+
+    return {"rows": rows, "seconds": round(elapsed, 3), "rows_per_s": round(rows / elapsed) if elapsed else 0}
+
+def bench_micro(args):
+    """
+    Measure the functions on the path of a lookup and of an insertion, one call at a time.
+
+    `serialization` is the encoding of a /get result through its response model, as done by FastAPI,
+    and `serialization_fast` the encoding of the same result by the serialization module.
+    """
+    from fastapi.routing import serialize_response
+    from fastapi.responses import JSONResponse
+    import app as api
+
+    if args.rows > 0:
+        seed_database(args.rows, args.seed)
+    rng = random.Random(args.seed)
+    companies = list(synthetic_companies(min(args.rows, 1000) or 1000, args.seed))
+    sirets = [company["siret"] for company in companies]
+    company = md.CompanyModel(**companies[0])
+    route = next(route for route in api.app.routes if getattr(route, "path", None) == "/get")
+
+    async def run():
+        await api.startup()
+        results = {}
+        results["consistency_siret"] = timed(lambda: ctrl.consistency_siret(company.siret, company.siren, company.nic), args.iterations)
+        results["create_new_company"] = timed(lambda: ctrl.create_new_company(company), args.iterations)
+        results["find_result"] = await timed_async(lambda: ctrl.find_result(api.collection, rng.choice(sirets)), args.iterations)
+
+        # Response model validation and JSON encoding of a /get result, as done by FastAPI
+        documents = await ctrl.find_result(api.collection, company.siret) or [ctrl.create_new_company(company)]
+        async def serialize():
+            content = await serialize_response(field=route.response_field, response_content=documents, exclude_none=True)
+            return JSONResponse(content).body
+        results["serialization"] = await timed_async(serialize, args.iterations)
+        results["serialization_fast"] = timed(lambda: serialization.encode_companies(documents), args.iterations)
+        return results
+
+    return asyncio.run(run())
+
+# Share of each operation in the load scenarios
+SCENARIOS = {
+    "read": {"get": 1.0},
+    "write": {"post": 0.5, "put": 0.5},
+    "mixed": {"get": 0.8, "search": 0.1, "put": 0.05, "post": 0.05},
+}
+
+def bench_load(args):
+    """
+    Send a scenario of HTTP requests with `concurrency` clients and measure the throughput and the latencies.
+
+    The requests go to the app in process through httpx, or to a running server with --url.
+    """
+    import httpx
+
+    if args.rows > 0:
+        seed_database(args.rows, args.seed)
+    if args.url is None:
+        import app as api
+        # Every request comes from the same host
+        md.LIMITER_ENABLED = False
+        client = httpx.AsyncClient(app=api.app, base_url="http://benchmark")
+        # httpx doesn't run the startup of the app
+        startup = api.startup
+    else:
+        client = httpx.AsyncClient(base_url=args.url, limits=httpx.Limits(max_connections=args.concurrency))
+        startup = None
+
+    rng = random.Random(args.seed)
+    existing = list(synthetic_companies(min(args.rows, 10000) or 10000, args.seed))
+    # The inserted companies follow the seeded ones, a random start for every run and client
+    fresh = synthetic_companies(args.requests, args.seed, start=args.rows + 10000 + random.randrange(10 ** 8))
+    operations, weights = zip(*SCENARIOS[args.scenario].items())
+
+    def request(operation):
+        company = rng.choice(existing)
+        if operation == "get":
+            return client.get("/get", params={"siret": company["siret"]})
+        if operation == "search":
+            return client.get("/search", params={"codePostalEtablissement": company["codePostalEtablissement"], "limit": 20})
+        if operation == "put":
+            return client.put("/{}".format(company["siret"]), json=dict(serialization.jsonable(ctrl.to_document(company)), nombrePeriodesEtablissement=rng.randint(1, 5)))
+        return client.post("/", json=serialization.jsonable(ctrl.to_document(next(fresh))))
+
+    samples = {operation: [] for operation in operations}
+    statuses = {}
+    plan = rng.choices(operations, weights=weights, k=args.requests)
+
+    async def worker(queue):
+        while queue:
+            operation = queue.pop()
+            start = time.perf_counter()
+            response = await request(operation)
+            samples[operation].append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    async def run():
+        if startup is not None:
+            await startup()
+        async with client:
+            begin = time.perf_counter()
+            await asyncio.gather(*[worker(plan) for _ in range(args.concurrency)])
+            return time.perf_counter() - begin
+
+    elapsed = asyncio.run(run())
+    results = {
+        "scenario": args.scenario,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "seconds": round(elapsed, 3),
+        "requests_per_s": round(args.requests / elapsed) if elapsed else 0,
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+        "all": percentiles([sample for operation in samples.values() for sample in operation]),
+    }
+    results.update({operation: percentiles(values) for operation, values in samples.items() if len(values) > 0})
+
+    return results
+
+def wait_ready(url, timeout=60):
+    """
+    Wait until a server answers its readiness probe.
+
+    Returns:
+        bool: Whether the server got ready before the timeout.
+    """
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url + "/health/ready").status_code == 200:
+                return True
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+
+    return False
+
+def bench_scaling(args):
+    """
+    Measure the throughput of serve.py with 1, 2, 4... up to `max_workers` worker processes.
+
+    The load is sent by `clients` processes running the load benchmark against the server, so that
+    the client isn't the bottleneck. The server uses the configured storage backend.
+    """
+    if args.rows > 0:
+        seed_database(args.rows, args.seed)
+    url = "http://127.0.0.1:{}".format(args.port)
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    workers = 1
+    while workers <= args.max_workers:
+        # The clients share a host, the rate limits would refuse most of the load
+        env = dict(os.environ, LIMITER_ENABLED="false")
+        server = subprocess.Popen([sys.executable, os.path.join(here, "serve.py"), "--host", "127.0.0.1", "--port", str(args.port), "--workers", str(workers)], cwd=here, env=env)
+        try:
+            if not wait_ready(url):
+                raise RuntimeError("The server with {} worker(s) didn't get ready".format(workers))
+            with tempfile.TemporaryDirectory() as tmp:
+                outputs = [os.path.join(tmp, "client{}.json".format(i)) for i in range(args.clients)]
+                clients = [subprocess.Popen([
+                    sys.executable, os.path.join(here, "benchmark.py"), "--output", output, "load", "--url", url, "--scenario", args.scenario,
+                    "--rows", "0", "--seed", str(args.seed), "--requests", str(args.requests // args.clients), "--concurrency", str(args.concurrency),
+                ], stdout=subprocess.DEVNULL) for output in outputs]
+                for process in clients:
+                    process.wait()
+                loads = []
+                for output in outputs:
+                    with open(output) as file:
+                        loads.append(json.load(file)["results"])
+        finally:
+            server.terminate()
+            server.wait()
+
+        results.append({
+            "workers": workers,
+            # The clients run at the same time
+            "requests_per_s": sum(load["requests_per_s"] for load in loads),
+            "p50_ms": max(load["all"]["p50_ms"] for load in loads),
+            "p99_ms": max(load["all"]["p99_ms"] for load in loads),
+        })
+        workers *= 2
+
+    return results
+
+def bench_snapshot(args):
+    """
+    Measure the build, the opening and the lookups of a snapshot of synthetic companies.
+    """
+    companies = [ctrl.to_document(company) for company in synthetic_companies(args.rows, args.seed)]
+    sirets = [company["siret"] for company in companies]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "benchmark.snapshot")
+        start = time.perf_counter()
+        snapshot.write_snapshot(path, companies)
+        write_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        collection = snapshot.SnapshotCollection(path)
+        open_seconds = time.perf_counter() - start
+
+        rng = random.Random(args.seed)
+        results = {
+            "rows": args.rows,
+            "mb": round(os.path.getsize(path) / 1024 / 1024, 2),
+            "write_seconds": round(write_seconds, 3),
+            "open_ms": round(open_seconds * 1000, 3),
+            "lookup": timed(lambda: collection.find_one({"siret": rng.choice(sirets)}, {"_id": False}), args.lookups),
+            "lookup_missing": timed(lambda: collection.find_one({"siret": rng.randrange(10 ** 13)}, {"_id": False}), args.lookups),
+        }
+        collection.close()
+
+    return results
+
+def peak_rss_mb():
+    """
+    Return the peak memory of the process in MB, None where the resource module is missing.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is given in kilobytes
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def bench_export(args):
+    """
+    Measure the throughput and the memory of an export from the configured database.
+    """
+    collection = ctrl.init_collection()
+    filter = export.export_filter({}, args.departement)
+    rows = collection.count_documents(filter)
+
+    async def consume():
+        size = 0
+        async for chunk in export.export_stream(storage.AsyncCollection(collection), filter, args.format, batch_size=args.batch_size, compress=args.gzip):
+            size += len(chunk)
+        return size
+
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    size = asyncio.run(consume())
+    elapsed = time.perf_counter() - start
+    rss_after = peak_rss_mb()
+
+    return {
+        "format": args.format,
+        "gzip": args.gzip,
+        "rows": rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_s": round(rows / elapsed) if elapsed else 0,
+        "mb": round(size / 1024 / 1024, 2),
+        "peak_rss_mb_before": rss_before,
+        "peak_rss_mb_after": rss_after,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the SIRET API")
+    parser.add_argument("--memory", action="store_true", help="Run against an in-memory database (needs mongomock)")
+    parser.add_argument("--output", default=None, help="Also write the results to this JSON file")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="Synthetic SIRENE companies, as a stock file or loaded into the database")
+    generate_parser.add_argument("--rows", type=int, default=1000000)
+    generate_parser.add_argument("--seed", type=int, default=0)
+    generate_parser.add_argument("--csv", dest="output_csv", default=None, help="Write a stock file instead of loading the database")
+    generate_parser.set_defaults(func=bench_generate)
+
+    micro_parser = subparsers.add_parser("micro", help="Latency of find_result, consistency_siret, create_new_company and the serialization")
+    micro_parser.add_argument("--rows", type=int, default=0, help="Load this many synthetic companies first")
+    micro_parser.add_argument("--seed", type=int, default=0)
+    micro_parser.add_argument("--iterations", type=int, default=10000)
+    micro_parser.set_defaults(func=bench_micro)
+
+    load_parser = subparsers.add_parser("load", help="Throughput and latency of an HTTP scenario")
+    load_parser.add_argument("--scenario", choices=list(SCENARIOS), default="read")
+    load_parser.add_argument("--rows", type=int, default=0, help="Load this many synthetic companies first")
+    load_parser.add_argument("--seed", type=int, default=0)
+    load_parser.add_argument("--requests", type=int, default=10000)
+    load_parser.add_argument("--concurrency", type=int, default=32)
+    load_parser.add_argument("--url", default=None, help="Running server to load, default is the app in process")
+    load_parser.set_defaults(func=bench_load)
+
+    scaling_parser = subparsers.add_parser("scaling", help="Throughput of serve.py from 1 to --max-workers worker processes")
+    scaling_parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    scaling_parser.add_argument("--scenario", choices=list(SCENARIOS), default="read")
+    scaling_parser.add_argument("--rows", type=int, default=10000, help="Load this many synthetic companies first")
+    scaling_parser.add_argument("--seed", type=int, default=0)
+    scaling_parser.add_argument("--requests", type=int, default=20000, help="Requests per step, split between the clients")
+    scaling_parser.add_argument("--clients", type=int, default=4, help="Number of client processes")
+    scaling_parser.add_argument("--concurrency", type=int, default=32, help="Concurrent requests per client")
+    scaling_parser.add_argument("--port", type=int, default=8765)
+    scaling_parser.set_defaults(func=bench_scaling)
+
+    snapshot_parser = subparsers.add_parser("snapshot", help="Build, opening and lookup latency of a snapshot of synthetic companies")
+    snapshot_parser.add_argument("--rows", type=int, default=200000)
+    snapshot_parser.add_argument("--seed", type=int, default=0)
+    snapshot_parser.add_argument("--lookups", type=int, default=100000)
+    snapshot_parser.set_defaults(func=bench_snapshot)
+
+    logging_parser = subparsers.add_parser("logging", help="Per-request cost of the access log")
+    logging_parser.add_argument("--requests", type=int, default=10000)
+    logging_parser.set_defaults(func=bench_logging)
+
+    export_parser = subparsers.add_parser("export", help="Throughput and memory of a streaming export")
+    export_parser.add_argument("--format", choices=list(export.FORMATS), default="ndjson")
+    export_parser.add_argument("--departement", default=None)
+    export_parser.add_argument("--batch-size", type=int, default=md.EXPORT_BATCH_SIZE)
+    export_parser.add_argument("--gzip", action="store_true")
+    export_parser.set_defaults(func=bench_export)
+
+    args = parser.parse_args()
+    if args.memory:
+        in_memory()
+    results = {
+        "benchmark": args.benchmark,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {k: v for k, v in vars(args).items() if k != "func"},
+        "results": args.func(args),
+    }
+    print(json.dumps(results, indent=2))
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,126 @@
+"""
+In-process read-through cache of the company lookups.
+"""
+import time
+import model as md
+from collections import OrderedDict
+
+# Returned by `TTLCache.get` when the key is not cached
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries expire after a time to live.
+
+    Empty results (unknown sirets) are cached as well, with their own shorter time to live,
+    so that repeated lookups of a missing siret don't reach the database either.
+
+    Every invalidation bumps a write generation : a lookup reads it with `version` before its query
+    and passes it to `set`, which drops the result if its key was written in between, so that a
+    lookup in flight during a write doesn't put the previous company back into the cache.
+
+    Args:
+        maxsize (int, optional): Maximum number of entries. Default is md.CACHE_SIZE.
+        ttl (float, optional): Time to live of an entry in seconds. Default is md.CACHE_TTL.
+        negative_ttl (float, optional): Time to live of an empty result in seconds. Default is md.CACHE_NEGATIVE_TTL.
+        timer (callable, optional): Clock used to expire the entries. Default is time.monotonic.
+    """
+
+    def __init__(self, maxsize=md.CACHE_SIZE, ttl=md.CACHE_TTL, negative_ttl=md.CACHE_NEGATIVE_TTL, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timer = timer
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        # Generation of the last invalidation of the recently written keys, the oldest being forgotten
+        self.generation = 0
+        self.written = OrderedDict()
+        self.forgotten = 0
+
+    def get(self, key):
+        """
+        Return the cached value of `key`, or MISSING if it is not cached or has expired.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISSING
+
+        expires_at, value = entry
+        if expires_at <= self.timer():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return MISSING
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def version(self):
+        """
+        Return the write generation, read before querying a value to cache.
+        """
+        return self.generation
+
+    def set(self, key, value, version=None):
+        """
+        Cache `value`, evicting the least recently used entries beyond `maxsize`.
+
+        Args:
+            key (hashable): The key of the value.
+            value (list): The value read from the database.
+            version (int, optional): The generation returned by `version` before the value was read.
+                The value isn't cached if the key may have been written since. Default is no check.
+        """
+        if self.maxsize <= 0:
+            return
+        if version is not None and max(self.written.get(key, 0), self.forgotten) > version:
+            return
+        ttl = self.ttl if value else self.negative_ttl
+        self.entries[key] = (self.timer() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        """
+        Drop the entry of `key` after a write on it.
+        """
+        self.generation += 1
+        self.written[key] = self.generation
+        self.written.move_to_end(key)
+        # A lookup older than a forgotten write can't tell whether its key was written
+        while len(self.written) > max(self.maxsize, 1):
+            _, self.forgotten = self.written.popitem(last=False)
+        if self.entries.pop(key, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        """
+        Return the counters used to size the cache.
+
+        Returns:
+            dict: The size and the hit, miss, eviction, expiration and invalidation counters.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
@@ -1,22 +1,143 @@
+import os
+import math
+import asyncio
 import model as md
+import metrics
+import name_index
+import snapshot
 import pymongo  # package for working with MongoDB
+from pymongo import DeleteOne, InsertOne, ReplaceOne, ReturnDocument
+from pymongo.errors import BulkWriteError
+from datetime import date, datetime
+from cache import MISSING
 from loguru import logger
 from fastapi import FastAPI, HTTPException, Request, Response
 
 
-def init_collection():
+def init_client(pool_size=md.MONGO_POOL_SIZE):
+    """
+    Open a client of the mongoDB server, with the pool and timeout settings of model.py.
+
+    The client opens its connections lazily, in the process using it : a worker process must open
+    its own client rather than inherit one.
+
+    Args:
+        pool_size (int, optional): Maximum number of connections kept by the client. Default is md.MONGO_POOL_SIZE.
+
+    Returns:
+        pymongo.MongoClient | None: The client, None with the snapshot storage backend.
+    """
+    if md.STORAGE_BACKEND == "snapshot":
+        return None
+
+    return pymongo.MongoClient(
+        md.MONGO_URL,
+        maxPoolSize=pool_size,
+        minPoolSize=min(md.MONGO_MIN_POOL_SIZE, pool_size),
+        connectTimeoutMS=md.MONGO_CONNECT_TIMEOUT_MS,
+        serverSelectionTimeoutMS=md.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        socketTimeoutMS=md.MONGO_SOCKET_TIMEOUT_MS or None,
+        maxIdleTimeMS=md.MONGO_MAX_IDLE_TIME_MS or None,
+        event_listeners=[metrics.PoolListener()],
+    )
+
+def init_collection(pool_size=md.MONGO_POOL_SIZE, name=md.COLLECTION_NAME, client=None):
     """
     Initialize the connection to the mongoDB database and return it
+
+    With md.STORAGE_BACKEND set to "snapshot", the collection is read from md.SNAPSHOT_PATH instead.
+
+    Args:
+        pool_size (int, optional): Maximum number of connections kept by the client. Default is md.MONGO_POOL_SIZE.
+        name (str, optional): Name of the collection. Default is md.COLLECTION_NAME.
+        client (pymongo.MongoClient, optional): Client shared with other collections. Default is a new client.
     """
-    client = pymongo.MongoClient(md.MONGO_URL)
+    if md.STORAGE_BACKEND == "snapshot":
+        return snapshot.open_collection(name)
+
+    if client is None:
+        client = init_client(pool_size)
     db = client[md.DB_NAME]
-    collection = db[md.COLLECTION_NAME]
+    collection = db[name]
 
     return collection
 
-def log(request, response, code_status=200):
+def ensure_siret_index(collection):
+    """
+    Create the unique siret index of the collection if it doesn't exist yet.
+
+    The unique index rejects duplicated companies without any read before the write.
+    A non unique siret index left by a previous version is replaced, once the collection is checked
+    for duplicated sirets : a build over the whole collection, only run by data_integration.py.
+
+    Args:
+        collection (pymongo.collection.Collection): The collection to index.
+
+    Raises:
+        ValueError: If the collection holds duplicated sirets, the previous index being kept.
+    """
+    siret_index = collection.index_information().get("siret_1")
+    if siret_index is not None and not siret_index.get("unique", False):
+        duplicates = [group["_id"] for group in collection.aggregate([
+            {"$group": {"_id": "$siret", "count": {"$sum": 1}}},
+            {"$match": {"count": {"$gt": 1}}},
+            {"$limit": 10},
+        ], allowDiskUse=True)]
+        if duplicates:
+            raise ValueError("Duplicated sirets, the unique index can't be built : {}".format(", ".join(map(str, duplicates))))
+        collection.drop_index("siret_1")
+    collection.create_index("siret", unique=True)
+
+def has_unique_siret_index(collection):
     """
-    Logs a request and response in a log file.
+    Tell whether the collection has the unique siret index the writes rely on.
+
+    Args:
+        collection (pymongo.collection.Collection): The collection to check.
+
+    Returns:
+        bool: True if the siret index exists and is unique.
+    """
+    siret_index = collection.index_information().get("siret_1")
+
+    return siret_index is not None and siret_index.get("unique", False)
+
+def ensure_indexes(collection):
+    """
+    Create every index of the collection if it doesn't exist yet : the unique siret index and
+    the compound indexes of md.SEARCH_INDEXES used by /search.
+
+    Args:
+        collection (pymongo.collection.Collection): The collection to index.
+    """
+    ensure_siret_index(collection)
+    for keys in md.SEARCH_INDEXES:
+        collection.create_index([(key, pymongo.ASCENDING) for key in keys])
+
+def init_logger(log_file=md.logFile):
+    """
+    Configure the access log once at startup.
+
+    The file sink stays open for the whole life of the app. Messages are enqueued and written
+    by a background thread, so logging never blocks the request path, and the file is rotated
+    once it reaches md.LOG_ROTATION. With md.LOG_PER_WORKER, the pid is added to the file name : the
+    worker processes of serve.py don't share a file, each one rotating its own.
+
+    Parameters:
+    log_file (str, optional): Path of the log file. Default is md.logFile.
+
+    Returns:
+    None
+    """
+    if md.LOG_PER_WORKER:
+        root, extension = os.path.splitext(log_file)
+        log_file = "{}.{}{}".format(root, os.getpid(), extension)
+    logger.remove()
+    logger.add(log_file, enqueue=True, rotation=md.LOG_ROTATION, retention=md.LOG_RETENTION)
+
+def log(request, code_status=200):
+    """
+    Logs a request and its response status in the log file.
 
     The function logs the client hostname, the request method, the response status code,
     and the route URL in the log file. If the status code is 200, the log is recorded as 
@@ -24,45 +145,209 @@ def log(request, response, code_status=200):
 
     Parameters:
     request (Request): Request object containing information about the request.
-    response (Response): Response object containing information about the response.
     code_status (int, optional): Response status code. Default is 200.
 
     Returns:
     None
     """
-
-    response.status_code = code_status
-
-    # Open the log file
-    logger.add(md.logFile)
-    # Log the request and response
     message = "{} {:<6} {}  | route : {}".format(
-        request.client.host,
+        request.client.host if request.client else "-",
         request.method,
-        response.status_code,
+        code_status,
         request.url.path
     )
-    if response.status_code == 200:
+    if code_status == 200:
         logger.info(message)
     else:
         logger.warning(message)
-    # Close the log file
-    logger.remove()
 
-def find_result(collection, siret):
+class AccessLogMiddleware:
+    """
+    ASGI middleware logging every HTTP request with the status code actually sent to the client.
+
+    Args:
+        app (ASGI app): The application to wrap.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            # Keep the status code of the response being sent
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            with metrics.stage("logging"):
+                log(Request(scope), status["code"])
+
+def parse_fields(fields):
+    """
+    Expand the `fields` parameter of a lookup into a list of field names.
+
+    Args:
+        fields (str): Comma separated field names and md.FIELD_PRESETS names.
+
+    Returns:
+        list[str]: The requested field names, siret always included, in the order of md.COMPANY_FIELDS.
+        The unknown names are kept so that the caller can report them.
+    """
+    names = {"siret"}
+    for name in fields.split(","):
+        name = name.strip()
+        if name:
+            names.update(md.FIELD_PRESETS.get(name, [name]))
+    known = [name for name in md.COMPANY_FIELDS if name in names]
+
+    return known + sorted(names.difference(known))
+
+def search_filter(criteria, after=None):
+    """
+    Build the filter of a search.
+
+    Without any etatAdministratifEtablissement criterion, every state is listed explicitly so that
+    the compound indexes of md.SEARCH_INDEXES both select the companies and return them sorted by siret.
+
+    Args:
+        criteria (dict): The searched values of the md.SEARCH_FIELDS and of etatAdministratifEtablissement.
+        after (int, optional): Only return the companies whose siret is greater (keyset pagination).
+
+    Returns:
+        dict: The filter of the find query.
+    """
+    filter = {k: v for k, v in criteria.items() if v is not None}
+    if "etatAdministratifEtablissement" not in filter:
+        filter["etatAdministratifEtablissement"] = {"$in": md.ETATS_ADMINISTRATIFS}
+    if after is not None:
+        filter["siret"] = {"$gt": after}
+
+    return filter
+
+async def search(collection, criteria, limit, after=None, fields=None):
+    """
+    Retrieve one page of the companies matching the criteria, sorted by siret.
+
+    Args:
+        collection (storage.AsyncCollection): The collection to search.
+        criteria (dict): See search_filter.
+        limit (int): Maximum number of companies of the page.
+        after (int, optional): The `next` cursor returned with the previous page.
+        fields (list[str], optional): Only return these fields. Default is every field.
+
+    Returns:
+        dict: The companies of the page and the `next` cursor, None on the last page.
+    """
+    # Fetch one more company to know whether there is a next page
+    results = await collection.find(search_filter(criteria, after), projection(fields), sort=[("siret", pymongo.ASCENDING)], limit=limit + 1)
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        next_cursor = results[-1]["siret"]
+
+    return {"results": results, "next": next_cursor}
+
+def projection(fields=None):
+    """
+    Build the projection of a find query returning only `fields`, or every field if None.
+    """
+    if fields is None:
+        return {"_id": False}
+
+    return dict({"_id": False}, **{name: True for name in fields})
+
+async def find_result(collection, siret, fields=None):
     """
     Retrieve the company information from the specified collection in the database with the given siret.
     
     Args:
-        collection (pymongo.collection.Collection): The collection to retrieve the company from.
+        collection (storage.AsyncCollection): The collection to retrieve the company from.
         siret (str): The siret of the company to retrieve.
+        fields (list[str], optional): Only read these fields from the database. Default is every field.
     
     Returns:
-        list[dict]: A list of dictionaries containing the company's information. The _id field is excluded from the returned dictionaries.
+        list[dict]: A list of dictionaries containing the company's information, as stored. The _id field is excluded from the returned dictionaries.
+    """
+    return await collection.find({"siret":siret}, projection(fields))
+
+async def find_cached_result(collection, cache, siret, fields=None):
+    """
+    Retrieve the company information with the given siret, going to the database only if it is not cached.
+
+    Only complete companies are cached : a projected lookup is answered from the cache when the
+    company is there, otherwise the projection is pushed down to the database.
+
+    Args:
+        collection (storage.AsyncCollection): The collection to retrieve the company from.
+        cache (cache.TTLCache): The cache of the previous lookups, keyed by siret.
+        siret (int): The siret of the company to retrieve.
+        fields (list[str], optional): Only return these fields. Default is every field.
+
+    Returns:
+        list[dict]: Same as find_result. Empty results are cached too.
     """
-    cursor = collection.find({"siret":siret}, {"_id":False})
+    results = cache.get(siret)
+    if results is MISSING:
+        version = cache.version()
+        results = await find_result(collection, siret, fields)
+        if fields is None or len(results) == 0:
+            cache.set(siret, results, version)
+        return results
+
+    if fields is not None:
+        results = [{k: v for k, v in company.items() if k in fields} for company in results]
+
+    return results
+
+async def iter_batch_results(collection, sirets, chunk_size=md.BATCH_CHUNK_SIZE, cache=None):
+    """
+    Resolve a list of sirets with one `$in` query per chunk and yield one result per requested siret.
+
+    Args:
+        collection (storage.AsyncCollection): The collection to retrieve the companies from.
+        sirets (list[int]): The sirets to retrieve, duplicates allowed.
+        chunk_size (int, optional): Number of sirets resolved by each query. Default is md.BATCH_CHUNK_SIZE.
+        cache (cache.TTLCache, optional): Cache of the previous lookups. Only the uncached sirets are queried.
+
+    Yields:
+        dict: The requested siret, whether it was found and the matching companies, in the input order.
+    """
+    for start in range(0, len(sirets), chunk_size):
+        chunk = sirets[start:start + chunk_size]
+
+        # Take what is already cached
+        found = {}
+        missing = set(chunk)
+        if cache is not None:
+            for siret in set(chunk):
+                results = cache.get(siret)
+                if results is not MISSING:
+                    found[siret] = results
+                    missing.discard(siret)
+
+        # Fetch every other company of the chunk at once
+        if missing:
+            version = cache.version() if cache is not None else None
+            cursor = await collection.find({"siret": {"$in": list(missing)}}, {"_id": False})
+            for company in cursor:
+                found.setdefault(company["siret"], []).append(company)
+            if cache is not None:
+                for siret in missing:
+                    cache.set(siret, found.get(siret, []), version)
 
-    return [{k:str(v) for k,v in company.items()} for company in cursor]
+        # Keep the input order and report the misses
+        for siret in chunk:
+            results = found.get(siret, [])
+            yield {"siret": siret, "found": len(results) > 0, "results": results}
 
 def consistency_siret(siret, siren, nic):
     """
@@ -79,121 +364,219 @@ def consistency_siret(siret, siren, nic):
 
     return (str(siret) == "{}{:0>5}".format(siren, nic)) and (len("{:>14}".format(siret))==14)
 
+async def index_names(names, companies):
+    """
+    Update the name index entries of companies after a write, with a single bulk write.
+
+    Args:
+        names (storage.AsyncCollection): The name index collection.
+        companies (dict): The written companies as stored after the write, None for the deleted ones, keyed by siret.
+    """
+    operations = []
+    for siret, company in companies.items():
+        entry = name_index.build_entry(company) if company is not None else None
+        if entry is None:
+            operations.append(DeleteOne({"siret": siret}))
+        else:
+            operations.append(ReplaceOne({"siret": siret}, entry, upsert=True))
+    if operations:
+        await names.bulk_write(operations, ordered=False)
+
+async def bulk_insert(collection, companies):
+    """
+    Insert several companies with a single unordered bulk write.
+
+    The unique siret index rejects the companies already in the database, no read being needed before the write.
+
+    Args:
+        collection (storage.AsyncCollection): The collection to insert the companies in.
+        companies (list[md.CompanyModel]): The companies to insert.
+
+    Returns:
+        tuple[list[dict], dict, dict]: The siret, status and detail of every company in the input order,
+        the inserted documents keyed by siret, and None for each of them as their previous state.
+    """
+    report = [None] * len(companies)
+    documents, positions = [], []
+    for i, company in enumerate(companies):
+        if consistency_siret(company.siret, company.siren, company.nic):
+            documents.append(create_new_company(company))
+            positions.append(i)
+        else:
+            report[i] = (400, "Inputs entered are not consistent. Siret must be composed of the siren number and the nic number.")
+
+    # Errors are reported with the index of their operation
+    errors = {}
+    if documents:
+        try:
+            await collection.bulk_write([InsertOne(document) for document in documents], ordered=False)
+        except BulkWriteError as error:
+            errors = {write_error["index"]: write_error["code"] for write_error in error.details["writeErrors"]}
+
+    written = {}
+    for index, i in enumerate(positions):
+        siret = companies[i].siret
+        if index not in errors:
+            report[i] = (200, "The insertion proceed correctly")
+            written[siret] = documents[index]
+        elif errors[index] == 11000:
+            report[i] = (409, f"A company with {siret} siret code already exists")
+        else:
+            report[i] = (400, "The insertion doesn't work")
+
+    return [{"siret": company.siret, "status": status, "detail": detail} for company, (status, detail) in zip(companies, report)], written, {siret: None for siret in written}
+
+async def bulk_update(collection, companies):
+    """
+    Update several companies, with one find_one_and_update per siret run concurrently.
+
+    Every update returns the company just before it, so that the previous values of the names and
+    of the counted fields are the ones it actually replaced, whatever the other requests writing the
+    same companies : a bulk write doesn't tell which of its updates matched what. The updates of a
+    siret given several times are merged in the input order.
+
+    Args:
+        collection (storage.AsyncCollection): The collection of the companies.
+        companies (list[md.BulkUpdateCompanyModel]): The siret and updated information of every company.
+
+    Returns:
+        tuple[list[dict], dict, dict]: The siret, status and detail of every company in the input order,
+        the updated companies and the same companies before the update (siret, names and md.STATS_FIELDS), keyed by siret.
+    """
+    updates = {}
+    for company in companies:
+        updates[company.siret] = merge_updates(updates.get(company.siret, {}), update_company(company))
+    fields = projection(["siret"] + md.NAME_FIELDS + md.STATS_FIELDS)
+    stored = await asyncio.gather(*(
+        collection.find_one_and_update({"siret": siret}, update, projection=fields, return_document=ReturnDocument.BEFORE)
+        for siret, update in updates.items()
+    ))
+    previous = {siret: company for siret, company in zip(updates, stored) if company is not None}
+    written = {siret: apply_update(company, updates[siret]) for siret, company in previous.items()}
+
+    report = []
+    for company in companies:
+        if company.siret in previous:
+            report.append({"siret": company.siret, "status": 200, "detail": "The update proceed correctly"})
+        else:
+            report.append({"siret": company.siret, "status": 404, "detail": f"The corporate with {company.siret} siret code doesn't exist"})
+
+    return report, written, previous
+
+async def bulk_delete(collection, sirets):
+    """
+    Delete several companies, with one find_one_and_delete per siret run concurrently.
+
+    Every deletion returns the company it actually deleted, none if another request deleted it first.
+
+    Args:
+        collection (storage.AsyncCollection): The collection of the companies.
+        sirets (list[int]): The siret codes of the companies to delete.
+
+    Returns:
+        tuple[list[dict], dict, dict]: The siret, status and detail of every siret in the input order,
+        the deleted sirets mapped to None, and the deleted companies (siret and md.STATS_FIELDS) keyed by siret.
+    """
+    unique = list(dict.fromkeys(sirets))
+    fields = projection(["siret"] + md.STATS_FIELDS)
+    deleted = await asyncio.gather(*(collection.find_one_and_delete({"siret": siret}, projection=fields) for siret in unique))
+    previous = {siret: company for siret, company in zip(unique, deleted) if company is not None}
+
+    report = []
+    for siret in sirets:
+        if siret in previous:
+            report.append({"siret": siret, "status": 200, "detail": "The deletion proceed correctly"})
+        else:
+            report.append({"siret": siret, "status": 404, "detail": f"The corporate with {siret} siret code doesn't exist"})
+
+    return report, {siret: None for siret in previous}, previous
+
+def to_document(values):
+    """
+    Convert the fields of a company into a compact document.
+
+    Empty and NaN fields are omitted and the dates are stored as BSON datetimes.
+
+    Args:
+        values (dict): The fields of the company.
+
+    Returns:
+        dict: The document to store.
+    """
+    document = {}
+    for k, v in values.items():
+        if v is None or v == "" or (isinstance(v, float) and math.isnan(v)):
+            continue
+        if isinstance(v, date) and not isinstance(v, datetime):
+            v = datetime(v.year, v.month, v.day)
+        document[k] = v
+
+    return document
+
 def create_new_company(company : md.CompanyModel):
     """
-    Create a dictionary containing the company's information.
+    Create the document containing the company's information.
     
     Args:
         company (md.CompanyModel): The company object to extract the information from.
     
     Returns:
-        dict: A dictionary containing the company's information.
-    """
-    return {
-        "siret" : company.siret,
-        "siren" : company.siren,
-        "nic" : company.nic,
-        "statutDiffusionEtablissement" : company.statutDiffusionEtablissement,
-        "dateCreationEtablissement" : company.dateCreationEtablissement,
-        "trancheEffectifsEtablissement" : company.trancheEffectifsEtablissement,
-        "anneeEffectifsEtablissement" : company.anneeEffectifsEtablissement,
-        "activitePrincipaleRegistreMetiersEtablissement" : company.activitePrincipaleRegistreMetiersEtablissement,
-        "dateDernierTraitementEtablissement" : company.dateDernierTraitementEtablissement,
-        "etablissementSiege" : company.etablissementSiege,
-        "nombrePeriodesEtablissement" : company.nombrePeriodesEtablissement,
-        "complementAdresseEtablissement" : company.complementAdresseEtablissement,
-        "numeroVoieEtablissement" : company.numeroVoieEtablissement,
-        "indiceRepetitionEtablissement" : company.indiceRepetitionEtablissement,
-        "typeVoieEtablissement" : company.typeVoieEtablissement,
-        "libelleVoieEtablissement" : company.libelleVoieEtablissement,
-        "codePostalEtablissement" : company.codePostalEtablissement,
-        "libelleCommuneEtablissement" : company.libelleCommuneEtablissement,
-        "libelleCommuneEtrangerEtablissement" : company.libelleCommuneEtrangerEtablissement,
-        "distributionSpecialeEtablissement" : company.distributionSpecialeEtablissement,
-        "codeCommuneEtablissement" : company.codeCommuneEtablissement,
-        "codeCedexEtablissement" : company.codeCedexEtablissement,
-        "libelleCedexEtablissement" : company.libelleCedexEtablissement,
-        "codePaysEtrangerEtablissement" : company.codePaysEtrangerEtablissement,
-        "libellePaysEtrangerEtablissement" : company.libellePaysEtrangerEtablissement,
-        "complementAdresse2Etablissement" : company.complementAdresse2Etablissement,
-        "numeroVoie2Etablissement" : company.numeroVoie2Etablissement,
-        "indiceRepetition2Etablissement" : company.indiceRepetition2Etablissement,
-        "typeVoie2Etablissement" : company.typeVoie2Etablissement,
-        "libelleVoie2Etablissement" : company.libelleVoie2Etablissement,
-        "codePostal2Etablissement" : company.codePostal2Etablissement,
-        "libelleCommune2Etablissement" : company.libelleCommune2Etablissement,
-        "libelleCommuneEtranger2Etablissement" : company.libelleCommuneEtranger2Etablissement,
-        "distributionSpeciale2Etablissement" : company.distributionSpeciale2Etablissement,
-        "codeCommune2Etablissement" : company.codeCommune2Etablissement,
-        "codeCedex2Etablissement" : company.codeCedex2Etablissement,
-        "libelleCedex2Etablissement" : company.libelleCedex2Etablissement,
-        "codePaysEtranger2Etablissement" : company.codePaysEtranger2Etablissement,
-        "libellePaysEtranger2Etablissement" : company.libellePaysEtranger2Etablissement,
-        "dateDebut" : company.dateDebut,
-        "etatAdministratifEtablissement" : company.etatAdministratifEtablissement,
-        "enseigne1Etablissement" : company.enseigne1Etablissement,
-        "enseigne2Etablissement" : company.enseigne2Etablissement,
-        "enseigne3Etablissement" : company.enseigne3Etablissement,
-        "denominationUsuelleEtablissement" : company.denominationUsuelleEtablissement,
-        "activitePrincipaleEtablissement" : company.activitePrincipaleEtablissement,
-        "nomenclatureActivitePrincipaleEtablissement" : company.nomenclatureActivitePrincipaleEtablissement,
-        "caractereEmployeurEtablissement" : company.caractereEmployeurEtablissement
-    }
+        dict: A dictionary containing the company's information, without the empty fields.
+    """
+    return to_document(company.dict())
 
 def update_company(company : md.UpdateCompanyModel):
     """
-    Create a dictionary containing the company's information based on the update company model
+    Create the update replacing the company's information by the ones of the update company model.
+
+    The empty fields of the model are removed from the stored document.
     
     Args:
         company (md.UpdateCompanyModel): The company object to get the information from.
     
     Returns:
-        dict: A dictionary containing the company's information.
-    """
-    return {
-            "statutDiffusionEtablissement" : company.statutDiffusionEtablissement,
-            "dateCreationEtablissement" : company.dateCreationEtablissement,
-            "trancheEffectifsEtablissement" : company.trancheEffectifsEtablissement,
-            "anneeEffectifsEtablissement" : company.anneeEffectifsEtablissement,
-            "activitePrincipaleRegistreMetiersEtablissement" : company.activitePrincipaleRegistreMetiersEtablissement,
-            "dateDernierTraitementEtablissement" : company.dateDernierTraitementEtablissement,
-            "etablissementSiege" : company.etablissementSiege,
-            "nombrePeriodesEtablissement" : company.nombrePeriodesEtablissement,
-            "complementAdresseEtablissement" : company.complementAdresseEtablissement,
-            "numeroVoieEtablissement" : company.numeroVoieEtablissement,
-            "indiceRepetitionEtablissement" : company.indiceRepetitionEtablissement,
-            "typeVoieEtablissement" : company.typeVoieEtablissement,
-            "libelleVoieEtablissement" : company.libelleVoieEtablissement,
-            "codePostalEtablissement" : company.codePostalEtablissement,
-            "libelleCommuneEtablissement" : company.libelleCommuneEtablissement,
-            "libelleCommuneEtrangerEtablissement" : company.libelleCommuneEtrangerEtablissement,
-            "distributionSpecialeEtablissement" : company.distributionSpecialeEtablissement,
-            "codeCommuneEtablissement" : company.codeCommuneEtablissement,
-            "codeCedexEtablissement" : company.codeCedexEtablissement,
-            "libelleCedexEtablissement" : company.libelleCedexEtablissement,
-            "codePaysEtrangerEtablissement" : company.codePaysEtrangerEtablissement,
-            "libellePaysEtrangerEtablissement" : company.libellePaysEtrangerEtablissement,
-            "complementAdresse2Etablissement" : company.complementAdresse2Etablissement,
-            "numeroVoie2Etablissement" : company.numeroVoie2Etablissement,
-            "indiceRepetition2Etablissement" : company.indiceRepetition2Etablissement,
-            "typeVoie2Etablissement" : company.typeVoie2Etablissement,
-            "libelleVoie2Etablissement" : company.libelleVoie2Etablissement,
-            "codePostal2Etablissement" : company.codePostal2Etablissement,
-            "libelleCommune2Etablissement" : company.libelleCommune2Etablissement,
-            "libelleCommuneEtranger2Etablissement" : company.libelleCommuneEtranger2Etablissement,
-            "distributionSpeciale2Etablissement" : company.distributionSpeciale2Etablissement,
-            "codeCommune2Etablissement" : company.codeCommune2Etablissement,
-            "codeCedex2Etablissement" : company.codeCedex2Etablissement,
-            "libelleCedex2Etablissement" : company.libelleCedex2Etablissement,
-            "codePaysEtranger2Etablissement" : company.codePaysEtranger2Etablissement,
-            "libellePaysEtranger2Etablissement" : company.libellePaysEtranger2Etablissement,
-            "dateDebut" : company.dateDebut,
-            "etatAdministratifEtablissement" : company.etatAdministratifEtablissement,
-            "enseigne1Etablissement" : company.enseigne1Etablissement,
-            "enseigne2Etablissement" : company.enseigne2Etablissement,
-            "enseigne3Etablissement" : company.enseigne3Etablissement,
-            "denominationUsuelleEtablissement" : company.denominationUsuelleEtablissement,
-            "activitePrincipaleEtablissement" : company.activitePrincipaleEtablissement,
-            "nomenclatureActivitePrincipaleEtablissement" : company.nomenclatureActivitePrincipaleEtablissement,
-            "caractereEmployeurEtablissement" : company.caractereEmployeurEtablissement
-        }
\ No newline at end of file
+        dict: The `$set` / `$unset` update to apply to the company.
+    """
+    values = company.dict(exclude={"siret"})
+    document = to_document(values)
+    removed = {k: "" for k in values if k not in document}
+
+    update = {}
+    if document:
+        update["$set"] = document
+    if removed:
+        update["$unset"] = removed
+
+    return update
+
+def merge_updates(first, second):
+    """
+    Merge two updates built by update_company into one, the second applying after the first.
+    """
+    updated, removed = dict(first.get("$set", {})), dict(first.get("$unset", {}))
+    for k, v in second.get("$set", {}).items():
+        updated[k] = v
+        removed.pop(k, None)
+    for k in second.get("$unset", {}):
+        removed[k] = ""
+        updated.pop(k, None)
+
+    update = {}
+    if updated:
+        update["$set"] = updated
+    if removed:
+        update["$unset"] = removed
+
+    return update
+
+def apply_update(company, update):
+    """
+    Apply an update built by update_company to a company document.
+
+    Returns:
+        dict: The company as stored after the update.
+    """
+    updated = {k: v for k, v in company.items() if k not in update.get("$unset", {})}
+    updated.update(update.get("$set", {}))
+
+    return updated
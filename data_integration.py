@@ -1,27 +1,533 @@
 """
 Used to implement the data in the db database
+
+The csv files are split into slices of md.INGEST_CHUNK_BYTES which are parsed and inserted in
+parallel by a pool of worker processes. Every committed slice is recorded in a checkpoint file,
+so that an interrupted load resumes where it stopped instead of restarting from zero.
+
+The incremental mode compares a new stock file, or a daily delta file, with the stored companies
+and only writes the inserted and updated records, plus the deletions for a full stock file.
+
+Usage :
+    python data_integration.py [--files "./*.csv"] [--workers 4] [--restart]
+    python data_integration.py --incremental [--compare date|content] [--deletions] [--dry-run]
+    python data_integration.py --snapshot corporate.snapshot [--files "./*.csv"] [--workers 4]
 """
 # Modules
 
 import controller as ctrl
+import model as md
+import name_index
+import snapshot
+import stats
 
 ## DataFrame manipulation
-import pandas as pd 
+import pandas as pd
 
 ## Path
 import glob as g
+import os
+
+## Command line, progress and checkpoint
+import io
+import csv
+import json
+import time
+import heapq
+import hashlib
+import argparse
+import tempfile
+from array import array
+from pymongo import DeleteOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Collections of the current worker process, opened once by `init_worker`
+worker_collection = None
+worker_names = None
+
+
+def split_file(path, chunk_bytes=md.INGEST_CHUNK_BYTES):
+    """
+    Split a csv file into slices of about `chunk_bytes` ending on a line boundary.
+
+    Args:
+        path (str): Path of the csv file.
+        chunk_bytes (int, optional): Target size of a slice. Default is md.INGEST_CHUNK_BYTES.
+
+    Returns:
+        tuple[bytes, list[tuple[int, int]]]: The header line and the (start, end) offsets of every slice.
+    """
+    size = os.path.getsize(path)
+    chunks = []
+    with open(path, "rb") as file:
+        header = file.readline()
+        start = file.tell()
+        while start < size:
+            file.seek(min(start + chunk_bytes, size))
+            # Finish the current line so that no record is cut in two
+            file.readline()
+            end = file.tell()
+            chunks.append((start, end))
+            start = end
+
+    return header, chunks
+
+def read_chunk(path, header, start, end):
+    """
+    Parse a slice of a csv file with the explicit column types of md.CSV_DTYPES.
+
+    Returns:
+        pandas.DataFrame: The records of the slice.
+    """
+    with open(path, "rb") as file:
+        file.seek(start)
+        data = file.read(end - start)
+
+    columns = next(csv.reader([header.decode("utf-8")]))
+    dtypes = {column: md.CSV_DTYPES.get(column, md.CSV_DEFAULT_DTYPE) for column in columns}
+
+    return pd.read_csv(io.BytesIO(header + data), dtype=dtypes)
+
+def to_documents(frame):
+    """
+    Convert the records of a DataFrame into typed documents, the missing values being omitted.
+    """
+    for column in md.CSV_DATE_COLUMNS:
+        if column in frame:
+            frame[column] = pd.to_datetime(frame[column], errors="coerce")
+    for column in md.CSV_BOOL_COLUMNS:
+        if column in frame:
+            frame[column] = frame[column].str.lower().map({"true": True, "false": False})
+    frame = frame.astype(object).where(frame.notna(), None)
+
+    return [ctrl.to_document(record) for record in frame.to_dict(orient="records")]
+
+def init_worker():
+    """
+    Open the database connection of a worker process.
+    """
+    global worker_collection, worker_names
+    worker_collection = ctrl.init_collection()
+    worker_names = ctrl.init_collection(name=md.NAMES_COLLECTION_NAME)
+
+def insert_unordered(collection, documents):
+    """
+    Insert documents with an unordered bulk write, skipping the ones already in the collection.
+
+    Returns:
+        int: The number of documents inserted.
+    """
+    if len(documents) == 0:
+        return 0
+    try:
+        return len(collection.insert_many(documents, ordered=False).inserted_ids)
+    except BulkWriteError as error:
+        # Only tolerate the duplicates of a resumed load
+        if any(write_error["code"] != 11000 for write_error in error.details["writeErrors"]):
+            raise
+        return error.details["nInserted"]
+
+def load_chunk(path, header, start, end):
+    """
+    Parse a slice of a csv file and insert its records, and their name index entries, with
+    unordered bulk writes.
+
+    Records already in the database, from a slice inserted before an interruption, are
+    rejected by the unique siret indexes and skipped.
+
+    Returns:
+        tuple[int, int]: The number of records read and the number of records inserted.
+    """
+    documents = to_documents(read_chunk(path, header, start, end))
+    entries = [entry for entry in map(name_index.build_entry, documents) if entry is not None]
+
+    inserted = insert_unordered(worker_collection, documents)
+    insert_unordered(worker_names, entries)
+
+    return len(documents), inserted
+
+def file_version(path):
+    """
+    Identify the version of a file by its size and modification time.
+    """
+    stat = os.stat(path)
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+def read_checkpoint(checkpoint, chunk_bytes):
+    """
+    Read the chunks already committed. A checkpoint written with another slice size is ignored, as
+    are the chunks of a file replaced since (e.g. the next monthly stock file at the same path).
+
+    Returns:
+        dict: The committed chunk indexes of every file.
+    """
+    if not os.path.exists(checkpoint):
+        return {}
+    with open(checkpoint) as file:
+        state = json.load(file)
+    if state.get("chunk_bytes") != chunk_bytes:
+        return {}
+
+    return {
+        path: set(entry["chunks"])
+        for path, entry in state["files"].items()
+        if isinstance(entry, dict) and os.path.exists(path) and entry.get("version") == file_version(path)
+    }
+
+def write_checkpoint(checkpoint, chunk_bytes, committed):
+    """
+    Atomically record the committed chunks of every file, along with the version of the file.
+    """
+    state = {"chunk_bytes": chunk_bytes, "files": {path: {"version": file_version(path), "chunks": sorted(indexes)} for path, indexes in committed.items()}}
+    with open(checkpoint + ".tmp", "w") as file:
+        json.dump(state, file)
+    os.replace(checkpoint + ".tmp", checkpoint)
+
+def ingest(paths, workers=md.INGEST_WORKERS, chunk_bytes=md.INGEST_CHUNK_BYTES, checkpoint=md.INGEST_CHECKPOINT):
+    """
+    Load csv files into the database, resuming from the checkpoint.
+
+    Args:
+        paths (list[str]): Paths of the csv files.
+        workers (int, optional): Number of worker processes. Default is md.INGEST_WORKERS.
+        chunk_bytes (int, optional): Size of a slice. Default is md.INGEST_CHUNK_BYTES.
+        checkpoint (str, optional): Path of the checkpoint file. Default is md.INGEST_CHECKPOINT.
+
+    Returns:
+        int: The number of records inserted.
+    """
+    # The unique index rejects the records committed before an interruption
+    print("Create an index based on the siret code ..")
+    collection = ctrl.init_collection()
+    names = ctrl.init_collection(name=md.NAMES_COLLECTION_NAME)
+    ctrl.ensure_siret_index(collection)
+    names.create_index("siret", unique=True)
+
+    committed = read_checkpoint(checkpoint, chunk_bytes)
+    tasks = []
+    for path in paths:
+        header, chunks = split_file(path, chunk_bytes)
+        done = committed.setdefault(path, set())
+        tasks += [(path, index, header, start, end) for index, (start, end) in enumerate(chunks) if index not in done]
+    print("Uploading {} file(s) to the database : {} chunk(s) to load".format(len(paths), len(tasks)))
+
+    rows, inserted, begin = 0, 0, time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        futures = {pool.submit(load_chunk, path, header, start, end): (path, index) for path, index, header, start, end in tasks}
+        for i, future in enumerate(as_completed(futures)):
+            path, index = futures[future]
+            chunk_rows, chunk_inserted = future.result()
+            rows += chunk_rows
+            inserted += chunk_inserted
+
+            committed[path].add(index)
+            write_checkpoint(checkpoint, chunk_bytes, committed)
+
+            elapsed = time.perf_counter() - begin
+            print("{}/{} chunks | {} rows read | {} inserted | {:.0f} rows/s".format(
+                i + 1, len(tasks), rows, inserted, rows / elapsed if elapsed else 0.0
+            ))
+
+    # The search indexes are built once the data is loaded, which is faster than maintaining them during the load
+    print("Create the search indexes ..")
+    ctrl.ensure_indexes(collection)
+    name_index.ensure_indexes(names)
+
+    print("Compute the statistics ..")
+    stats.rebuild(collection, ctrl.init_collection(name=md.STATS_COLLECTION_NAME))
+
+    # The load is complete, the next one starts from scratch
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    return inserted
+
+def parse_chunk(path, header, start, end):
+    """
+    Parse a slice of a csv file into typed documents.
+    """
+    return to_documents(read_chunk(path, header, start, end))
+
+def build_snapshot(paths, output=md.SNAPSHOT_PATH, workers=md.INGEST_WORKERS, chunk_bytes=md.INGEST_CHUNK_BYTES):
+    """
+    Write the companies of csv files into a snapshot for the read-only storage backend, without any database.
+
+    The slices are parsed in parallel and written in the order of the files : a stock file sorted by
+    siret gives a snapshot without any sort.
+
+    Args:
+        paths (list[str]): Paths of the csv files.
+        output (str, optional): Path of the snapshot. Default is md.SNAPSHOT_PATH.
+        workers (int, optional): Number of worker processes. Default is md.INGEST_WORKERS.
+        chunk_bytes (int, optional): Size of a slice. Default is md.INGEST_CHUNK_BYTES.
+
+    Returns:
+        int: The number of companies in the snapshot.
+    """
+    tasks = []
+    for path in paths:
+        header, chunks = split_file(path, chunk_bytes)
+        tasks += [(path, header, start, end) for start, end in chunks]
+    print("Writing {} file(s) to {} : {} chunk(s) to parse".format(len(paths), output, len(tasks)))
+
+    writer = snapshot.SnapshotWriter(output)
+    rows, begin = 0, time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # map keeps the order of the slices
+        for i, documents in enumerate(pool.map(parse_chunk, *zip(*tasks)) if tasks else []):
+            for document in documents:
+                writer.add(document)
+            rows += len(documents)
+            elapsed = time.perf_counter() - begin
+            print("{}/{} chunks | {} rows | {:.0f} rows/s".format(i + 1, len(tasks), rows, rows / elapsed if elapsed else 0.0))
+
+    return writer.close()
+
+def content_hash(document):
+    """
+    Hash the fields of a company, ignoring the _id and the empty fields.
+    """
+    fields = sorted((k, v) for k, v in document.items() if k != "_id" and v is not None)
+
+    return hashlib.md5(json.dumps(fields, default=str).encode("utf-8")).hexdigest()
+
+def has_changed(stored, document, compare):
+    """
+    Tell whether a record of the file differs from the stored company.
+
+    Args:
+        stored (dict): The company in the database.
+        document (dict): The record of the file.
+        compare (str): "date" to compare the dateDernierTraitementEtablissement fields, "content" to compare every field.
+    """
+    if compare == "date":
+        return stored.get("dateDernierTraitementEtablissement") != document.get("dateDernierTraitementEtablissement")
+
+    return content_hash(stored) != content_hash(document)
+
+def sync_chunk(path, header, start, end, compare, dry_run, sirets_dir):
+    """
+    Compare a slice of a csv file with the stored companies and upsert the new and changed records,
+    along with their name index entries.
+
+    Returns:
+        tuple[int, int, int, str]: The number of records read, inserted and updated, and the file of the
+        sorted sirets of the slice written into `sirets_dir` if set (used to find the deletions), else None.
+    """
+    documents = to_documents(read_chunk(path, header, start, end))
+    projection = {"_id": False} if compare == "content" else {"_id": False, "siret": True, "dateDernierTraitementEtablissement": True}
+
+    inserted, updated = 0, 0
+    for i in range(0, len(documents), md.SYNC_LOOKUP_SIZE):
+        batch = documents[i:i + md.SYNC_LOOKUP_SIZE]
+        cursor = worker_collection.find({"siret": {"$in": [document["siret"] for document in batch]}}, projection)
+        stored = {company["siret"]: company for company in cursor}
+
+        operations, name_operations = [], []
+        for document in batch:
+            current = stored.get(document["siret"])
+            if current is None:
+                inserted += 1
+            elif has_changed(current, document, compare):
+                updated += 1
+            else:
+                continue
+            operations.append(ReplaceOne({"siret": document["siret"]}, document, upsert=True))
+            entry = name_index.build_entry(document)
+            if entry is None:
+                name_operations.append(DeleteOne({"siret": document["siret"]}))
+            else:
+                name_operations.append(ReplaceOne({"siret": document["siret"]}, entry, upsert=True))
+
+        if operations and not dry_run:
+            worker_collection.bulk_write(operations, ordered=False)
+            worker_names.bulk_write(name_operations, ordered=False)
+
+    sirets = write_sirets(sirets_dir, [document["siret"] for document in documents]) if sirets_dir is not None else None
+
+    return len(documents), inserted, updated, sirets
+
+def write_sirets(directory, sirets):
+    """
+    Write sirets, sorted, into a new file of a directory.
+
+    Returns:
+        str: The path of the file.
+    """
+    descriptor, path = tempfile.mkstemp(suffix=".sirets", dir=directory)
+    with os.fdopen(descriptor, "wb") as file:
+        array("Q", sorted(sirets)).tofile(file)
+
+    return path
+
+def read_sirets(path, block_size=65536):
+    """
+    Iterate over the sirets of a file written by write_sirets, `block_size` sirets being read at once.
+    """
+    with open(path, "rb") as file:
+        while True:
+            block = array("Q")
+            try:
+                block.fromfile(file, block_size)
+            except EOFError:
+                # The last block is shorter, its sirets are read anyway
+                pass
+            if len(block) == 0:
+                return
+            yield from block
+
+def missing_sirets(stored, seen):
+    """
+    Merge two ascending iterators of sirets and yield the stored sirets which weren't seen.
+    """
+    seen = iter(seen)
+    current = next(seen, None)
+    for siret in stored:
+        while current is not None and current < siret:
+            current = next(seen, None)
+        if current != siret:
+            yield siret
+
+def delete_missing(files, dry_run=False):
+    """
+    Delete the stored companies and name index entries whose siret is in none of the files of the sync.
+
+    The stored sirets, read in order from the siret index, are merged with the sorted sirets of the
+    files : only a block of every file is held in memory, whatever the number of companies.
+
+    Args:
+        files (list[str]): The files of sorted sirets written by sync_chunk.
+        dry_run (bool, optional): Only count the deletions.
+
+    Returns:
+        int: The number of deleted companies.
+    """
+    collection = ctrl.init_collection()
+    names = ctrl.init_collection(name=md.NAMES_COLLECTION_NAME)
+    stored = (company["siret"] for company in collection.find({}, {"_id": False, "siret": True}).sort("siret", 1))
+    seen = heapq.merge(*[read_sirets(path) for path in files])
+
+    deleted, batch = 0, []
+    for siret in missing_sirets(stored, seen):
+        deleted += 1
+        if not dry_run:
+            batch.append(siret)
+        if len(batch) == md.SYNC_LOOKUP_SIZE:
+            collection.delete_many({"siret": {"$in": batch}})
+            names.delete_many({"siret": {"$in": batch}})
+            batch = []
+    if batch:
+        collection.delete_many({"siret": {"$in": batch}})
+        names.delete_many({"siret": {"$in": batch}})
+
+    return deleted
+
+def sync(paths, workers=md.INGEST_WORKERS, chunk_bytes=md.INGEST_CHUNK_BYTES, compare="date", deletions=False, dry_run=False):
+    """
+    Apply the differences between csv files and the database.
+
+    Args:
+        paths (list[str]): Paths of the stock or delta csv files.
+        workers (int, optional): Number of worker processes. Default is md.INGEST_WORKERS.
+        chunk_bytes (int, optional): Size of a slice. Default is md.INGEST_CHUNK_BYTES.
+        compare (str, optional): "date" (default) or "content", see has_changed.
+        deletions (bool, optional): Delete the stored companies missing from the files. Only valid for a full stock file.
+        dry_run (bool, optional): Only compute and print the changes.
+
+    Returns:
+        dict: The number of records read, inserted, updated, unchanged and deleted.
+    """
+    tasks = []
+    for path in paths:
+        header, chunks = split_file(path, chunk_bytes)
+        tasks += [(path, header, start, end) for start, end in chunks]
+    print("Comparing {} file(s) with the database : {} chunk(s)".format(len(paths), len(tasks)))
+
+    summary = {"read": 0, "inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+    # The sorted sirets of every slice are kept on disk, to be merged with the stored ones
+    sirets_dir = tempfile.TemporaryDirectory() if deletions else None
+    files, begin = [], time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+        futures = [pool.submit(sync_chunk, path, header, start, end, compare, dry_run, sirets_dir.name if deletions else None) for path, header, start, end in tasks]
+        for i, future in enumerate(as_completed(futures)):
+            rows, inserted, updated, sirets = future.result()
+            summary["read"] += rows
+            summary["inserted"] += inserted
+            summary["updated"] += updated
+            if sirets is not None:
+                files.append(sirets)
+
+            elapsed = time.perf_counter() - begin
+            print("{}/{} chunks | {} rows read | {:.0f} rows/s".format(
+                i + 1, len(tasks), summary["read"], summary["read"] / elapsed if elapsed else 0.0
+            ))
+    summary["unchanged"] = summary["read"] - summary["inserted"] - summary["updated"]
+
+    if deletions:
+        print("Looking for the deleted companies ..")
+        with sirets_dir:
+            summary["deleted"] = delete_missing(files, dry_run)
+
+    if not dry_run:
+        print("Compute the statistics ..")
+        stats.rebuild(ctrl.init_collection(), ctrl.init_collection(name=md.STATS_COLLECTION_NAME))
+
+    print("{}{} inserted | {} updated | {} unchanged | {} deleted".format(
+        "[dry run] " if dry_run else "", summary["inserted"], summary["updated"], summary["unchanged"], summary["deleted"]
+    ))
+
+    return summary
+
+
+def migrate_indexes():
+    """
+    Build the indexes the API relies on over an existing database, once and before the app is started.
+
+    A database loaded by a previous version has a non unique siret index : the workers of the API
+    report not ready until it is replaced by the unique one. Every siret lookup is a collection
+    scan while the unique index is being built.
+    """
+    collection = ctrl.init_collection()
+    names = ctrl.init_collection(name=md.NAMES_COLLECTION_NAME)
+    print("Create the indexes of {} ..".format(collection.name))
+    try:
+        ctrl.ensure_indexes(collection)
+    except ValueError as error:
+        raise SystemExit(str(error))
+    print("Create the indexes of {} ..".format(names.name))
+    name_index.ensure_indexes(names)
 
-siren = ctrl.init_collection()
 
-# Get the csv path
-path = g.glob("./*.csv", recursive=True)[0]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the StockEtablissement csv files into the database")
+    parser.add_argument("--files", default=md.INGEST_FILES, help="Glob of the csv files to load")
+    parser.add_argument("--workers", type=int, default=md.INGEST_WORKERS)
+    parser.add_argument("--chunk-bytes", type=int, default=md.INGEST_CHUNK_BYTES)
+    parser.add_argument("--checkpoint", default=md.INGEST_CHECKPOINT)
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and load every chunk again")
+    parser.add_argument("--incremental", action="store_true", help="Only apply the differences with the stored companies")
+    parser.add_argument("--compare", choices=["date", "content"], default="date", help="How changed records are detected in incremental mode")
+    parser.add_argument("--deletions", action="store_true", help="Delete the companies missing from the files (full stock file only)")
+    parser.add_argument("--dry-run", action="store_true", help="Print the changes of the incremental mode without writing them")
+    parser.add_argument("--snapshot", default=None, help="Write the files into this snapshot for the read-only storage backend instead of the database")
+    parser.add_argument("--migrate-indexes", action="store_true", help="Only build the indexes of an existing database, replacing the non unique siret index of a previous version")
+    args = parser.parse_args()
 
-# Upload the csv to the db
-print("Uploading the csv to the database")
-for i, chunk in enumerate(pd.read_csv(path, chunksize=1000000, low_memory=False)):
-    x = siren.insert_many(chunk.to_dict(orient='records'))
-    print("{}/34".format(i+1))
+    if args.migrate_indexes:
+        migrate_indexes()
+        raise SystemExit(0)
 
-# Create an index based on the siren code 
-print("Create an index based on the siret code ..")
-siren.create_index("siret")
\ No newline at end of file
+    # Get the csv paths
+    paths = sorted(g.glob(args.files, recursive=True))
+    if len(paths) == 0:
+        parser.error("No csv file matches {}".format(args.files))
+    if args.snapshot is not None:
+        build_snapshot(paths, args.snapshot, args.workers, args.chunk_bytes)
+    elif args.incremental:
+        sync(paths, args.workers, args.chunk_bytes, args.compare, args.deletions, args.dry_run)
+    else:
+        if args.restart and os.path.exists(args.checkpoint):
+            os.remove(args.checkpoint)
+        ingest(paths, args.workers, args.chunk_bytes, args.checkpoint)
@@ -0,0 +1,152 @@
+"""
+Streaming export of the companies as NDJSON, CSV or Parquet.
+
+The companies are read from the Mongo cursor by batches and every batch is encoded and sent before
+the next one is read, so that the memory used by an export doesn't depend on its number of rows.
+"""
+import io
+import re
+import csv
+import zlib
+import model as md
+import serialization
+from datetime import date, datetime
+
+# The Parquet format needs pyarrow, which is optional
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def export_filter(criteria, departement=None):
+    """
+    Build the filter of an export.
+
+    Args:
+        criteria (dict): The exported values of the md.SEARCH_FIELDS and of etatAdministratifEtablissement.
+        departement (str, optional): Only export the companies whose commune code starts with this code.
+
+    Returns:
+        dict: The filter of the find query.
+    """
+    filter = {k: v for k, v in criteria.items() if v is not None}
+    if departement is not None and "codeCommuneEtablissement" not in filter:
+        # Anchored prefix : the regex is answered by the codeCommuneEtablissement index bounds
+        filter["codeCommuneEtablissement"] = {"$regex": "^" + re.escape(departement)}
+
+    return filter
+
+async def iter_ndjson(batches, fields):
+    """
+    Encode the batches of companies as one JSON document per line.
+    """
+    async for batch in batches:
+        yield b"".join(serialization.dumps(serialization.company_values(company)) + b"\n" for company in batch)
+
+async def iter_csv(batches, fields):
+    """
+    Encode the batches of companies as CSV rows, after a header line.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+    writer.writeheader()
+    async for batch in batches:
+        writer.writerows(serialization.jsonable(company) for company in batch)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    # Header of an empty export
+    if buffer.tell() > 0:
+        yield buffer.getvalue().encode("utf-8")
+
+class ParquetSink(io.RawIOBase):
+    """
+    Write-only file handing the written bytes over as soon as they are produced.
+
+    The Parquet footer holds absolute offsets : the position keeps counting the bytes already handed over.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def parquet_schema(fields):
+    """
+    Build the Parquet schema of the exported fields from the types of md.CompanyModel.
+    """
+    types = {int: pa.int64(), bool: pa.bool_(), date: pa.date32(), datetime: pa.timestamp("ms")}
+
+    return pa.schema([(name, types.get(md.CompanyModel.__fields__[name].type_, pa.string())) for name in fields])
+
+async def iter_parquet(batches, fields):
+    """
+    Encode the batches of companies as the row groups of a Parquet file.
+    """
+    schema = parquet_schema(fields)
+    sink = ParquetSink()
+    writer = pq.ParquetWriter(sink, schema)
+    async for batch in batches:
+        rows = [serialization.company_values(company) for company in batch]
+        # One row group per batch
+        writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+async def gzip_stream(chunks):
+    """
+    Compress a stream of bytes into a single gzip stream.
+    """
+    compressor = zlib.compressobj(wbits=31)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_stream(collection, filter, format, fields=None, batch_size=md.EXPORT_BATCH_SIZE, compress=False):
+    """
+    Stream the companies matching a filter in the given format.
+
+    Args:
+        collection (storage.AsyncCollection): The collection to export.
+        filter (dict): The filter of the find query, see export_filter.
+        format (str): One of FORMATS.
+        fields (list[str], optional): Only export these fields. Default is md.COMPANY_FIELDS.
+        batch_size (int, optional): Number of companies read and encoded at once. Default is md.EXPORT_BATCH_SIZE.
+        compress (bool, optional): Compress the stream with gzip.
+
+    Returns:
+        AsyncIterator[bytes]: The encoded companies.
+    """
+    fields = fields or md.COMPANY_FIELDS
+    projection = dict({"_id": False}, **{name: True for name in fields})
+    batches = collection.iter_batches(filter, projection, batch_size)
+    encoders = {"ndjson": iter_ndjson, "csv": iter_csv, "parquet": iter_parquet}
+    chunks = encoders[format](batches, fields)
+
+    return gzip_stream(chunks) if compress else chunks
@@ -0,0 +1,78 @@
+"""
+Invalidation of the lookup caches of every worker process.
+
+Each worker of serve.py keeps its own lookup cache, and a write only invalidates the cache of the
+worker which handled it. The written sirets are therefore recorded in the
+md.CACHE_INVALIDATIONS_COLLECTION_NAME collection, which every worker polls every
+md.CACHE_SYNC_INTERVAL seconds to drop the companies written by the others : a company stays stale
+on the other workers for about md.CACHE_SYNC_INTERVAL seconds instead of md.CACHE_TTL.
+
+The poll reads back md.CACHE_SYNC_MARGIN seconds before the previous one, so that a write recorded
+late, or by a host whose clock is slightly behind, isn't missed. Invalidating a siret twice only
+costs a lookup. The records expire after md.CACHE_INVALIDATION_RETENTION seconds.
+"""
+import asyncio
+import model as md
+from loguru import logger
+from pymongo import InsertOne
+from pymongo.errors import PyMongoError
+from datetime import datetime, timedelta
+
+
+def ensure_indexes(invalidations):
+    """
+    Create the expiring index of the invalidation records, which also serves the polls.
+
+    Args:
+        invalidations (pymongo.collection.Collection): The invalidations collection.
+    """
+    invalidations.create_index("at", expireAfterSeconds=md.CACHE_INVALIDATION_RETENTION)
+
+async def publish(invalidations, sirets):
+    """
+    Record the sirets written by a request for the other workers, with a single bulk write.
+
+    Args:
+        invalidations (storage.AsyncCollection): The invalidations collection.
+        sirets (Iterable[int]): The written sirets.
+    """
+    at = datetime.utcnow()
+    operations = [InsertOne({"siret": siret, "at": at}) for siret in sirets]
+    if operations:
+        await invalidations.bulk_write(operations, ordered=False)
+
+async def poll(invalidations, cache, since):
+    """
+    Invalidate the cached companies written since the previous poll, by any worker.
+
+    Args:
+        invalidations (storage.AsyncCollection): The invalidations collection.
+        cache (cache.TTLCache): The lookup cache of this worker.
+        since (datetime): The start of the previous poll.
+
+    Returns:
+        datetime: The start of this poll, to pass to the next one.
+    """
+    start = datetime.utcnow()
+    records = await invalidations.find({"at": {"$gt": since - timedelta(seconds=md.CACHE_SYNC_MARGIN)}}, {"_id": False, "siret": True})
+    for siret in {record["siret"] for record in records}:
+        cache.invalidate(siret)
+
+    return start
+
+async def follow(invalidations, cache):
+    """
+    Poll the invalidations every md.CACHE_SYNC_INTERVAL seconds, until cancelled.
+
+    Args:
+        invalidations (storage.AsyncCollection): The invalidations collection.
+        cache (cache.TTLCache): The lookup cache of this worker.
+    """
+    since = datetime.utcnow()
+    while True:
+        await asyncio.sleep(md.CACHE_SYNC_INTERVAL)
+        # An unreachable database only delays the invalidations, the next poll reads them
+        try:
+            since = await poll(invalidations, cache, since)
+        except PyMongoError as error:
+            logger.warning("Cache invalidation poll failed : {}".format(error))
@@ -0,0 +1,194 @@
+"""
+Admission control of the API : per-client rate limiting and load shedding.
+
+Every client host gets a token bucket per group of routes (md.RATE_LIMITS), so that a client scanning
+the sirets is answered with 429 once its burst is spent, without reaching the database, while the
+other clients keep their own budget. The limited requests then take a slot of a global concurrency
+cap : when every slot is taken and md.ADMISSION_MAX_QUEUE requests already wait, or a request waited
+md.ADMISSION_QUEUE_TIMEOUT seconds, it is shed with 503 instead of queueing until every client times out.
+Both answers carry a Retry-After header.
+"""
+import math
+import time
+import asyncio
+import metrics
+import model as md
+from collections import OrderedDict, deque
+from fastapi.responses import JSONResponse
+
+
+def route_group(method, path, routes=None):
+    """
+    Return the group of md.RATE_LIMITS of a request.
+
+    Args:
+        method (str): HTTP method of the request.
+        path (str): Path of the request.
+        routes (list[tuple], optional): The (method, path prefix, group) rules. Default is md.ROUTE_LIMITS.
+
+    Returns:
+        str: The group of the first matching rule, None if the route isn't limited.
+    """
+    for route_method, prefix, group in md.ROUTE_LIMITS if routes is None else routes:
+        if method == route_method and path.startswith(prefix):
+            return group
+
+    return None
+
+class RateLimiter:
+    """
+    Token buckets keyed by client host and group of routes.
+
+    A bucket holds up to `burst` tokens and is refilled at `rate` tokens per second, every request
+    taking a token. The least recently used buckets are dropped beyond `maxsize`, a dropped bucket
+    starting full again.
+
+    Args:
+        limits (dict, optional): The (rate, burst) of every group. Default is md.RATE_LIMITS.
+        maxsize (int, optional): Maximum number of buckets. Default is md.LIMITER_MAX_CLIENTS.
+        timer (callable, optional): Clock used to refill the buckets. Default is time.monotonic.
+    """
+
+    def __init__(self, limits=None, maxsize=md.LIMITER_MAX_CLIENTS, timer=time.monotonic):
+        self.limits = md.RATE_LIMITS if limits is None else limits
+        self.maxsize = maxsize
+        self.timer = timer
+        self.buckets = OrderedDict()
+
+    def acquire(self, host, group):
+        """
+        Take a token of the bucket of a client.
+
+        Args:
+            host (str): The client host.
+            group (str): The group of routes, a key of `limits`.
+
+        Returns:
+            float: 0 if the request is allowed, else the number of seconds before a token is available.
+        """
+        rate, burst = self.limits[group]
+        key = (host, group)
+        now = self.timer()
+        tokens, updated = self.buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0
+        else:
+            wait = (1 - tokens) / rate
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.maxsize:
+            self.buckets.popitem(last=False)
+
+        return wait
+
+    def clear(self):
+        self.buckets.clear()
+
+class Admission:
+    """
+    Global cap on the requests processed at the same time, with a bounded waiting queue.
+
+    Args:
+        max_concurrency (int, optional): Number of requests processed at the same time. Default is md.ADMISSION_MAX_CONCURRENCY.
+        max_queue (int, optional): Number of requests waiting for a slot. Default is md.ADMISSION_MAX_QUEUE.
+        timeout (float, optional): Time a request waits for a slot, in seconds. Default is md.ADMISSION_QUEUE_TIMEOUT.
+    """
+
+    def __init__(self, max_concurrency=md.ADMISSION_MAX_CONCURRENCY, max_queue=md.ADMISSION_MAX_QUEUE, timeout=md.ADMISSION_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiters = deque()
+
+    async def acquire(self):
+        """
+        Take a slot, waiting for one if none is free.
+
+        Returns:
+            bool: Whether the slot was taken, False if the request must be shed.
+        """
+        if self.in_flight < self.max_concurrency and not self.waiters:
+            self.in_flight += 1
+            return True
+        if len(self.waiters) >= self.max_queue:
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        metrics.ADMISSION.inc("waiting")
+        try:
+            await asyncio.wait_for(waiter, self.timeout)
+        except asyncio.TimeoutError:
+            # The slot may have been handed over at the last moment
+            return waiter.done() and not waiter.cancelled()
+        except asyncio.CancelledError:
+            # The client went away after being handed a slot
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            metrics.ADMISSION.dec("waiting")
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+        return True
+
+    def release(self):
+        """
+        Hand the slot over to the oldest waiting request, or free it.
+        """
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+class LimiterMiddleware:
+    """
+    ASGI middleware applying the rate limits of the client host, then the admission control, to the
+    routes of md.ROUTE_LIMITS, as long as md.LIMITER_ENABLED is set.
+
+    Args:
+        app (ASGI app): The application to wrap.
+        rate_limiter (RateLimiter): The token buckets of the clients.
+        admission (Admission): The global concurrency cap.
+    """
+
+    def __init__(self, app, rate_limiter, admission):
+        self.app = app
+        self.rate_limiter = rate_limiter
+        self.admission = admission
+
+    async def __call__(self, scope, receive, send):
+        group = route_group(scope["method"], scope["path"]) if scope["type"] == "http" and md.LIMITER_ENABLED else None
+        if group is None:
+            await self.app(scope, receive, send)
+            return
+
+        host = scope["client"][0] if scope.get("client") else "-"
+        wait = self.rate_limiter.acquire(host, group)
+        if wait > 0:
+            metrics.SHED.inc(group, 429)
+            await self.refuse(429, "Too many requests", wait, scope, receive, send)
+            return
+        if not await self.admission.acquire():
+            metrics.SHED.inc(group, 503)
+            await self.refuse(503, "Server overloaded", md.ADMISSION_RETRY_AFTER, scope, receive, send)
+            return
+
+        metrics.ADMISSION.inc("in_flight")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            metrics.ADMISSION.dec("in_flight")
+            self.admission.release()
+
+    async def refuse(self, status_code, detail, retry_after, scope, receive, send):
+        """
+        Answer a refused request right away, with the number of seconds to wait before retrying.
+        """
+        response = JSONResponse(status_code=status_code, content={"detail": detail}, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+        await response(scope, receive, send)
@@ -0,0 +1,266 @@
+"""
+Prometheus metrics of the API, exposed in the text format by the /metrics route.
+
+The request latency is recorded per route and status by `MetricsMiddleware`, and the time spent in
+each stage of a request (Mongo queries, handler, response serialization, access log) by `stage`.
+"""
+import time
+import threading
+import model as md
+from contextvars import ContextVar
+from contextlib import contextmanager
+from fastapi import Response
+from fastapi.routing import APIRoute
+from pymongo import monitoring
+
+# The sampling profiler is optional
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric:
+    """
+    Base of the metrics : a value per combination of label values.
+
+    Args:
+        name (str): Name of the metric.
+        help (str): Description of the metric.
+        labelnames (tuple[str], optional): Names of the labels.
+    """
+    type = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def format_labels(self, labels, extra=()):
+        pairs = list(zip(self.labelnames, labels)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + "}"
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append("{}{} {}".format(self.name, self.format_labels(labels), value))
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # One counter per bucket, then the sum and the count
+                counts = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        with self.lock:
+            for labels, counts in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append("{}_bucket{} {}".format(self.name, self.format_labels(labels, [("le", bound)]), count))
+                lines.append("{}_bucket{} {}".format(self.name, self.format_labels(labels, [("le", "+Inf")]), counts[-1]))
+                lines.append("{}_sum{} {}".format(self.name, self.format_labels(labels), counts[-2]))
+                lines.append("{}_count{} {}".format(self.name, self.format_labels(labels), counts[-1]))
+        return lines
+
+
+REGISTRY = []
+
+REQUESTS = Counter("siret_api_requests_total", "HTTP requests", ("route", "method", "status"))
+REQUEST_LATENCY = Histogram("siret_api_request_duration_seconds", "HTTP request latency", ("route", "method", "status"))
+REQUESTS_IN_FLIGHT = Gauge("siret_api_requests_in_flight", "HTTP requests being processed")
+STAGE_LATENCY = Histogram("siret_api_stage_duration_seconds", "Time spent in each stage of the requests", ("stage",))
+MONGO_QUERIES_IN_FLIGHT = Gauge("siret_api_mongo_queries_in_flight", "Mongo queries submitted to the storage thread pool and not done yet")
+MONGO_CONNECTIONS = Gauge("siret_api_mongo_connections", "Connections of the Mongo pools", ("state",))
+SINGLEFLIGHT = Counter("siret_api_singleflight_calls_total", "Lookups running their query (leader) or sharing an identical one in flight (coalesced)", ("group", "role"))
+SHED = Counter("siret_api_shed_requests_total", "Requests refused by the rate limits (429) or shed by the admission control (503)", ("group", "status"))
+ADMISSION = Gauge("siret_api_admission", "Requests holding or waiting for a slot of the admission control", ("state",))
+CACHE = Gauge("siret_api_cache", "Counters of the siret lookup cache", ("counter",))
+
+# End of the current endpoint call, the serialization of its result starting right after
+endpoint_done = ContextVar("endpoint_done", default=None)
+
+
+def render():
+    """
+    Render every metric in the Prometheus text format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+
+    return "\n".join(lines) + "\n"
+
+@contextmanager
+def stage(name):
+    """
+    Record the time spent in the block as the `name` stage of the request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - start, name)
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    """
+    Follow the connections opened and checked out of the pymongo pools.
+    """
+
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_created(self, event): MONGO_CONNECTIONS.inc("open")
+    def connection_ready(self, event): pass
+    def connection_closed(self, event): MONGO_CONNECTIONS.dec("open")
+    def connection_check_out_started(self, event): pass
+    def connection_check_out_failed(self, event): pass
+    def connection_checked_out(self, event): MONGO_CONNECTIONS.inc("checked_out")
+    def connection_checked_in(self, event): MONGO_CONNECTIONS.dec("checked_out")
+
+class TimedRoute(APIRoute):
+    """
+    Route recording the time spent in its endpoint and in the serialization of the endpoint result.
+    """
+
+    def __init__(self, path, endpoint, **kwargs):
+        async def timed_endpoint(*args, **kwargs):
+            with stage("endpoint"):
+                result = await endpoint(*args, **kwargs)
+            # A response built by the endpoint times its own serialization
+            if not isinstance(result, Response):
+                endpoint_done.set(time.perf_counter())
+            return result
+
+        # FastAPI reads the parameters of the endpoint through __wrapped__
+        timed_endpoint.__wrapped__ = endpoint
+        timed_endpoint.__name__ = endpoint.__name__
+        timed_endpoint.__doc__ = endpoint.__doc__
+        super().__init__(path, timed_endpoint, **kwargs)
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            endpoint_done.set(None)
+            response = await handler(request)
+            done = endpoint_done.get()
+            if done is not None:
+                STAGE_LATENCY.observe(time.perf_counter() - done, "serialization")
+            return response
+
+        return timed_handler
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency of every HTTP request per route and status, and the
+    number of requests in flight.
+
+    With md.PROFILING_ENABLED and pyinstrument installed, a request sent with the `X-Profile` header
+    is profiled and answered with the HTML report of the profiler instead of its response.
+
+    Args:
+        app (ASGI app): The application to wrap.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.routes = None
+
+    def route_of(self, scope):
+        """
+        Return the path template of the route which handled the request, to keep the label cardinality low.
+        """
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self.routes is None:
+            self.routes = {route.endpoint: route.path for route in scope["app"].routes if hasattr(route, "endpoint")}
+        return self.routes.get(endpoint, "unmatched")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if md.PROFILING_ENABLED and Profiler is not None and any(k == b"x-profile" for k, _ in scope["headers"]):
+            await self.profile(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            REQUESTS_IN_FLIGHT.dec()
+            labels = (self.route_of(scope), scope["method"], status["code"])
+            REQUESTS.inc(*labels)
+            REQUEST_LATENCY.observe(elapsed, *labels)
+
+    async def profile(self, scope, receive, send):
+        """
+        Run the request under the sampling profiler and send the report instead of its response.
+        """
+        async def discard(message):
+            pass
+
+        profiler = Profiler(interval=md.PROFILING_INTERVAL, async_mode="enabled")
+        profiler.start()
+        try:
+            await self.app(scope, receive, discard)
+        finally:
+            profiler.stop()
+
+        body = profiler.output_html().encode("utf-8")
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/html; charset=utf-8"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
@@ -1,66 +1,283 @@
+import os
+from enum import Enum
+from dotenv import load_dotenv
 from pydantic import BaseModel
-from typing import Union
+from datetime import date, datetime
+from typing import List, Optional
 
 # VARIABLES
 
+# The deployment settings can be overridden by environment variables or a .env file
+load_dotenv()
+
 ## Database : MongoDB
 
-MONGO_URL = "mongodb://localhost:27017/"
-DB_NAME = "companydb"
+MONGO_URL = os.getenv("MONGO_URL", "mongodb://localhost:27017/")
+DB_NAME = os.getenv("DB_NAME", "companydb")
 COLLECTION_NAME = "corporate"
+NAMES_COLLECTION_NAME = "corporate_names" # Name index of the companies, see name_index.py
+MONGO_POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", 50)) # Maximum number of connections, and of queries in flight, per worker
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0)) # Connections opened at startup and kept open, per worker
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)) # Time before a query fails when no server is reachable
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 0)) # 0 : no timeout, the exports run long queries
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", 0)) # 0 : the idle connections are kept
+
+## Storage backend
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mongo") # "mongo", or "snapshot" to serve the lookups from a read-only snapshot file without MongoDB
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "corporate.snapshot") # Snapshot written by `data_integration.py --snapshot`
+
+## Server : see serve.py
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", 8000))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", os.cpu_count() or 1)) # Number of worker processes
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", 2048)) # Connections waiting to be accepted
+SERVER_KEEP_ALIVE = int(os.getenv("SERVER_KEEP_ALIVE", 5)) # Idle time before a keep-alive connection is closed, in seconds
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", 2)) # Time given to the database to answer the readiness probe, in seconds
+PREWARM_FILE = os.getenv("PREWARM_FILE") # Optional file of hot sirets, one per line, loaded into the cache at startup
+
+## Ingest
+INGEST_FILES = "./*.csv" # Glob of the StockEtablissement csv files to load
+INGEST_CHUNK_BYTES = 64 * 1024 * 1024 # Size of the slice of csv parsed and inserted by a worker
+INGEST_WORKERS = 4 # Number of worker processes
+INGEST_CHECKPOINT = "ingest_checkpoint.json" # Chunks already committed, used to resume a load
+SYNC_LOOKUP_SIZE = 10000 # Number of stored companies fetched at once by the incremental mode
+
+# Explicit types of the csv columns, so that codes keep their leading zeros and are not read as floats
+CSV_DTYPES = {
+    "siren": "int64",
+    "nic": "int64",
+    "siret": "int64",
+    "anneeEffectifsEtablissement": "Int64",
+    "nombrePeriodesEtablissement": "Int64",
+}
+CSV_DEFAULT_DTYPE = "str"
+# Columns converted after parsing, as read_csv has no nullable date or boolean type
+CSV_DATE_COLUMNS = ["dateCreationEtablissement", "dateDernierTraitementEtablissement", "dateDebut"]
+CSV_BOOL_COLUMNS = ["etablissementSiege"]
 
 ## Logs
 logFile = "siret_api_logs.log"
+LOG_ROTATION = "100 MB" # Size at which the log file is rotated
+LOG_RETENTION = 10 # Number of rotated log files kept
+LOG_PER_WORKER = os.getenv("LOG_PER_WORKER", "false").lower() == "true" # One log file per process (siret_api_logs.<pid>.log), set by serve.py with several workers
+
+## Batch lookup
+BATCH_MAX_SIZE = 10000 # Maximum number of sirets accepted by a single batch request
+BATCH_CHUNK_SIZE = 1000 # Number of sirets resolved by each `$in` query
+
+## Export
+EXPORT_BATCH_SIZE = 5000 # Number of companies read from the cursor and encoded at once
+EXPORT_MAX_BATCH_SIZE = 100000
+
+## Bulk writes
+BULK_MAX_SIZE = 10000 # Maximum number of companies written by a single bulk request
+
+## Cache
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", 100000)) # Maximum number of sirets kept in memory per worker
+CACHE_TTL = float(os.getenv("CACHE_TTL", 300)) # Time to live of a cached company, in seconds
+CACHE_NEGATIVE_TTL = float(os.getenv("CACHE_NEGATIVE_TTL", 30)) # Time to live of a cached unknown siret, in seconds
+CACHE_INVALIDATIONS_COLLECTION_NAME = "cache_invalidations" # Sirets written by every worker, see invalidation.py
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", 1)) # Time between two polls of the writes of the other workers, in seconds, 0 to disable
+CACHE_SYNC_MARGIN = 5 # Overlap of two polls, covering the late records and the clock skew between hosts, in seconds
+CACHE_INVALIDATION_RETENTION = 3600 # Time the written sirets are kept, in seconds
+
+## Admission control : see limiter.py
+LIMITER_ENABLED = os.getenv("LIMITER_ENABLED", "true").lower() == "true" # Disable to run a load test from a single host
+# Token bucket of every client host per group of routes : (requests per second, burst)
+RATE_LIMITS = {
+    "lookup": (float(os.getenv("RATE_LIMIT_LOOKUP", 100)), int(os.getenv("RATE_LIMIT_LOOKUP_BURST", 200))),
+    "batch": (float(os.getenv("RATE_LIMIT_BATCH", 10)), int(os.getenv("RATE_LIMIT_BATCH_BURST", 20))),
+    "search": (float(os.getenv("RATE_LIMIT_SEARCH", 10)), int(os.getenv("RATE_LIMIT_SEARCH_BURST", 20))),
+    "export": (float(os.getenv("RATE_LIMIT_EXPORT", 0.1)), int(os.getenv("RATE_LIMIT_EXPORT_BURST", 2))),
+    "write": (float(os.getenv("RATE_LIMIT_WRITE", 20)), int(os.getenv("RATE_LIMIT_WRITE_BURST", 40))),
+}
+# Group of the routes, the first (method, path prefix) matching a request applies, the other routes aren't limited
+ROUTE_LIMITS = [
+    ("GET", "/get/batch", "batch"),
+    ("POST", "/get/batch", "batch"),
+    ("GET", "/get", "lookup"),
+    ("GET", "/search", "search"),
+    ("GET", "/export", "export"),
+    ("POST", "/", "write"),
+    ("PUT", "/", "write"),
+    ("DELETE", "/", "write"),
+]
+LIMITER_MAX_CLIENTS = 100000 # Token buckets kept in memory per worker, the least recently used being dropped
+ADMISSION_MAX_CONCURRENCY = int(os.getenv("ADMISSION_MAX_CONCURRENCY", 2 * MONGO_POOL_SIZE)) # Limited requests processed at the same time, per worker
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", 4 * MONGO_POOL_SIZE)) # Requests waiting for a slot before the new ones are shed
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 1)) # Time a request waits for a slot before being shed, in seconds
+ADMISSION_RETRY_AFTER = 1 # Retry-After of the shed requests, in seconds
+
+## Metrics
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true" # Profile the requests sent with the X-Profile header, needs pyinstrument
+PROFILING_INTERVAL = 0.001 # Sampling interval of the profiler, in seconds
+
+## Search
+SEARCH_FIELDS = ["siren", "codePostalEtablissement", "codeCommuneEtablissement", "activitePrincipaleEtablissement"]
+# One compound index per searchable field, the trailing siret sorting each page without a sort in memory
+SEARCH_INDEXES = [[field, "etatAdministratifEtablissement", "siret"] for field in SEARCH_FIELDS]
+ETATS_ADMINISTRATIFS = ["A", "F", None] # Every state, None matching the companies without any
+SEARCH_DEFAULT_LIMIT = 100
+SEARCH_MAX_LIMIT = 1000
+
+## Name search
+NAME_FIELDS = ["denominationUsuelleEtablissement", "enseigne1Etablissement", "enseigne2Etablissement", "enseigne3Etablissement"]
+NAME_MIN_FUZZY_LENGTH = 4 # Shorter tokens must be typed without any typo
+NAME_CANDIDATES = 1000 # Maximum number of names read from the index and ranked per lookup
+NAME_DEFAULT_LIMIT = 10
+NAME_MAX_LIMIT = 100
+
+## Statistics : counts of the companies per value of each dimension, see stats.py
+STATS_COLLECTION_NAME = "corporate_stats"
+STATS_DIMENSIONS = ["activitePrincipaleEtablissement", "trancheEffectifsEtablissement", "departement", "etatAdministratifEtablissement"]
+# Fields of a company read by the write routes to update the counts, the département coming from the commune code
+STATS_FIELDS = ["activitePrincipaleEtablissement", "trancheEffectifsEtablissement", "codeCommuneEtablissement", "etatAdministratifEtablissement"]
+
+## Field projection : named sets of fields accepted by the `fields` parameter of /get
+FIELD_PRESETS = {
+    "address": [
+        "complementAdresseEtablissement", "numeroVoieEtablissement", "indiceRepetitionEtablissement",
+        "typeVoieEtablissement", "libelleVoieEtablissement", "codePostalEtablissement",
+        "libelleCommuneEtablissement", "libelleCommuneEtrangerEtablissement", "distributionSpecialeEtablissement",
+        "codeCommuneEtablissement", "codeCedexEtablissement", "libelleCedexEtablissement",
+        "codePaysEtrangerEtablissement", "libellePaysEtrangerEtablissement",
+    ],
+    "activity": ["activitePrincipaleEtablissement", "nomenclatureActivitePrincipaleEtablissement"],
+    "status": ["etatAdministratifEtablissement", "dateDebut"],
+}
 
 # OBJECTS
+
+## Codes of the SIRENE nomenclatures
+class StatutDiffusion(str, Enum):
+    O = "O" # Diffusible
+    P = "P" # Partially diffusible
+    N = "N" # Not diffusible
+
+class TrancheEffectifs(str, Enum):
+    NN = "NN"
+    T00 = "00"
+    T01 = "01"
+    T02 = "02"
+    T03 = "03"
+    T11 = "11"
+    T12 = "12"
+    T21 = "21"
+    T22 = "22"
+    T31 = "31"
+    T32 = "32"
+    T41 = "41"
+    T42 = "42"
+    T51 = "51"
+    T52 = "52"
+    T53 = "53"
+
+class EtatAdministratif(str, Enum):
+    A = "A" # Active
+    F = "F" # Closed
+
+class NomenclatureActivite(str, Enum):
+    NAFRev2 = "NAFRev2"
+    NAFRev1 = "NAFRev1"
+    NAF1993 = "NAF1993"
+    NAP = "NAP"
+
+class CaractereEmployeur(str, Enum):
+    O = "O"
+    N = "N"
+
 class UpdateCompanyModel(BaseModel):
-    statutDiffusionEtablissement: Union[str, None] = ""
-    dateCreationEtablissement: Union[str, None] = ""
-    trancheEffectifsEtablissement: Union[str, None] = ""
-    anneeEffectifsEtablissement: Union[str, None] = ""
-    activitePrincipaleRegistreMetiersEtablissement: Union[str, None] = ""
-    dateDernierTraitementEtablissement: Union[str, None] = ""
-    etablissementSiege: Union[str, None] = ""
-    nombrePeriodesEtablissement: Union[str, None] = ""
-    complementAdresseEtablissement: Union[str, None] = ""
-    numeroVoieEtablissement: Union[str, None] = ""
-    indiceRepetitionEtablissement: Union[str, None] = ""
-    typeVoieEtablissement: Union[str, None] = ""
-    libelleVoieEtablissement: Union[str, None] = ""
-    codePostalEtablissement: Union[str, None] = ""
-    libelleCommuneEtablissement: Union[str, None] = ""
-    libelleCommuneEtrangerEtablissement: Union[str, None] = ""
-    distributionSpecialeEtablissement: Union[str, None] = ""
-    codeCommuneEtablissement: Union[str, None] = ""
-    codeCedexEtablissement: Union[str, None] = ""
-    libelleCedexEtablissement: Union[str, None] = ""
-    codePaysEtrangerEtablissement: Union[str, None] = ""
-    libellePaysEtrangerEtablissement: Union[str, None] = ""
-    complementAdresse2Etablissement: Union[str, None] = ""
-    numeroVoie2Etablissement: Union[str, None] = ""
-    indiceRepetition2Etablissement: Union[str, None] = ""
-    typeVoie2Etablissement: Union[str, None] = ""
-    libelleVoie2Etablissement: Union[str, None] = ""
-    codePostal2Etablissement: Union[str, None] = ""
-    libelleCommune2Etablissement: Union[str, None] = ""
-    libelleCommuneEtranger2Etablissement: Union[str, None] = ""
-    distributionSpeciale2Etablissement: Union[str, None] = ""
-    codeCommune2Etablissement: Union[str, None] = ""
-    codeCedex2Etablissement: Union[str, None] = ""
-    libelleCedex2Etablissement: Union[str, None] = ""
-    codePaysEtranger2Etablissement: Union[str, None] = ""
-    libellePaysEtranger2Etablissement: Union[str, None] = ""
-    dateDebut: Union[str, None] = ""
-    etatAdministratifEtablissement: Union[str, None] = ""
-    enseigne1Etablissement: Union[str, None] = ""
-    enseigne2Etablissement: Union[str, None] = ""
-    enseigne3Etablissement: Union[str, None] = ""
-    denominationUsuelleEtablissement: Union[str, None] = ""
-    activitePrincipaleEtablissement: Union[str, None] = ""
-    nomenclatureActivitePrincipaleEtablissement: Union[str, None] = ""
-    caractereEmployeurEtablissement: Union[str, None] = ""
+    statutDiffusionEtablissement: Optional[StatutDiffusion] = None
+    dateCreationEtablissement: Optional[date] = None
+    trancheEffectifsEtablissement: Optional[TrancheEffectifs] = None
+    anneeEffectifsEtablissement: Optional[int] = None
+    activitePrincipaleRegistreMetiersEtablissement: Optional[str] = None
+    dateDernierTraitementEtablissement: Optional[datetime] = None
+    etablissementSiege: Optional[bool] = None
+    nombrePeriodesEtablissement: Optional[int] = None
+    complementAdresseEtablissement: Optional[str] = None
+    numeroVoieEtablissement: Optional[str] = None
+    indiceRepetitionEtablissement: Optional[str] = None
+    typeVoieEtablissement: Optional[str] = None
+    libelleVoieEtablissement: Optional[str] = None
+    codePostalEtablissement: Optional[str] = None
+    libelleCommuneEtablissement: Optional[str] = None
+    libelleCommuneEtrangerEtablissement: Optional[str] = None
+    distributionSpecialeEtablissement: Optional[str] = None
+    codeCommuneEtablissement: Optional[str] = None
+    codeCedexEtablissement: Optional[str] = None
+    libelleCedexEtablissement: Optional[str] = None
+    codePaysEtrangerEtablissement: Optional[str] = None
+    libellePaysEtrangerEtablissement: Optional[str] = None
+    complementAdresse2Etablissement: Optional[str] = None
+    numeroVoie2Etablissement: Optional[str] = None
+    indiceRepetition2Etablissement: Optional[str] = None
+    typeVoie2Etablissement: Optional[str] = None
+    libelleVoie2Etablissement: Optional[str] = None
+    codePostal2Etablissement: Optional[str] = None
+    libelleCommune2Etablissement: Optional[str] = None
+    libelleCommuneEtranger2Etablissement: Optional[str] = None
+    distributionSpeciale2Etablissement: Optional[str] = None
+    codeCommune2Etablissement: Optional[str] = None
+    codeCedex2Etablissement: Optional[str] = None
+    libelleCedex2Etablissement: Optional[str] = None
+    codePaysEtranger2Etablissement: Optional[str] = None
+    libellePaysEtranger2Etablissement: Optional[str] = None
+    dateDebut: Optional[date] = None
+    etatAdministratifEtablissement: Optional[EtatAdministratif] = None
+    enseigne1Etablissement: Optional[str] = None
+    enseigne2Etablissement: Optional[str] = None
+    enseigne3Etablissement: Optional[str] = None
+    denominationUsuelleEtablissement: Optional[str] = None
+    activitePrincipaleEtablissement: Optional[str] = None
+    nomenclatureActivitePrincipaleEtablissement: Optional[NomenclatureActivite] = None
+    caractereEmployeurEtablissement: Optional[CaractereEmployeur] = None
+
+    class Config:
+        # Keep the codes as plain strings in the documents
+        use_enum_values = True
 
 class CompanyModel(UpdateCompanyModel):
     siret: int
     siren: int
     nic: int
+
+# Fields of a company in the order of the SIRENE files, identifiers first
+COMPANY_FIELDS = ["siret", "siren", "nic"] + list(UpdateCompanyModel.__fields__)
+
+class SparseCompanyModel(UpdateCompanyModel):
+    siret: int
+    siren: Optional[int] = None
+    nic: Optional[int] = None
+
+class SearchResultModel(BaseModel):
+    results: List[SparseCompanyModel]
+    next: Optional[int] = None
+
+class NameMatchModel(BaseModel):
+    siret: int
+    name: str
+    score: int
+
+class NameSearchResultModel(BaseModel):
+    results: List[NameMatchModel]
+
+class BulkUpdateCompanyModel(UpdateCompanyModel):
+    siret: int
+
+class BulkItemModel(BaseModel):
+    siret: int
+    status: int
+    detail: str
+
+class BulkReportModel(BaseModel):
+    results: List[BulkItemModel]
+
+class BatchSiretModel(BaseModel):
+    sirets: List[int]
+
+class BatchResultModel(BaseModel):
+    siret: int
+    found: bool
+    results: List[CompanyModel]
@@ -0,0 +1,161 @@
+"""
+Name index of the companies : prefix, accent insensitive and typo tolerant search over the
+denomination and the enseignes of the establishments.
+
+Every company with a name has an entry in the md.NAMES_COLLECTION_NAME collection holding the
+normalized tokens of its names (`tokens`) and these tokens with one character deleted (`keys`).
+Two tokens are at most one typo apart when their deletion variants intersect, so fuzzy matches
+are found with an exact lookup on the `keys` index instead of a regex scan.
+"""
+import unicodedata
+import model as md
+
+
+def normalize(text):
+    """
+    Lower case a text, strip its accents and replace the punctuation by spaces.
+    """
+    text = unicodedata.normalize("NFKD", str(text))
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+
+    return "".join(c if c.isalnum() else " " for c in text)
+
+def tokenize(text):
+    """
+    Split a text into its normalized tokens.
+    """
+    return normalize(text).split()
+
+def deletions(token):
+    """
+    Return the variants of a token with one character deleted. Short tokens have none, a
+    single typo making them match too many other tokens.
+    """
+    if len(token) < md.NAME_MIN_FUZZY_LENGTH:
+        return set()
+
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+def is_typo(a, b):
+    """
+    Tell whether two different tokens are one substitution, insertion, deletion or transposition apart.
+    """
+    if a == b or abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) == len(b):
+        diffs = [i for i in range(len(a)) if a[i] != b[i]]
+        if len(diffs) == 1:
+            return True
+        return len(diffs) == 2 and diffs[1] == diffs[0] + 1 and a[diffs[0]] == b[diffs[1]] and a[diffs[1]] == b[diffs[0]]
+    shorter, longer = (a, b) if len(a) < len(b) else (b, a)
+
+    return any(longer[:i] + longer[i + 1:] == shorter for i in range(len(longer)))
+
+def build_entry(company):
+    """
+    Build the name index entry of a company.
+
+    Args:
+        company (dict): The company document.
+
+    Returns:
+        dict | None: The entry, None if the company has no name.
+    """
+    names = [company[field] for field in md.NAME_FIELDS if company.get(field)]
+    if len(names) == 0:
+        return None
+
+    tokens = set()
+    for name in names:
+        tokens.update(tokenize(name))
+    keys = set(tokens)
+    for token in tokens:
+        keys.update(deletions(token))
+
+    return {"siret": company["siret"], "name": " / ".join(dict.fromkeys(names)), "tokens": sorted(tokens), "keys": sorted(keys)}
+
+def ensure_indexes(names):
+    """
+    Create the indexes of the name index collection.
+
+    Args:
+        names (pymongo.collection.Collection): The name index collection.
+    """
+    names.create_index("siret", unique=True)
+    names.create_index("tokens")
+    names.create_index("keys")
+
+def token_quality(query_token, tokens, last):
+    """
+    Grade how well a query token matches the tokens of a name.
+
+    Returns:
+        int: 3 for an exact match, 2 for a prefix match (last query token only), 1 for a typo, 0 otherwise.
+    """
+    if query_token in tokens:
+        return 3
+    if last and any(token.startswith(query_token) for token in tokens):
+        return 2
+    if any(is_typo(query_token, token) for token in tokens):
+        return 1
+
+    return 0
+
+def score(query_tokens, entry):
+    """
+    Score a name index entry against the tokens of a query.
+
+    Returns:
+        tuple: Sort key, the higher the better : number of query tokens matched, sum of their qualities,
+        and the shorter names first.
+    """
+    tokens = set(entry["tokens"])
+    qualities = [token_quality(token, tokens, i == len(query_tokens) - 1) for i, token in enumerate(query_tokens)]
+
+    return (sum(1 for quality in qualities if quality > 0), sum(qualities), -len(entry["tokens"]))
+
+async def search(names, query, limit=md.NAME_DEFAULT_LIMIT):
+    """
+    Retrieve the companies whose names best match a query.
+
+    Every query token must match exactly, the last one being a prefix (type-ahead). If that doesn't
+    give `limit` companies, the names where every query token matches up to a typo are looked up
+    through the deletion variants.
+
+    Args:
+        names (storage.AsyncCollection): The name index collection.
+        query (str): The searched name.
+        limit (int, optional): Maximum number of companies returned. Default is md.NAME_DEFAULT_LIMIT.
+
+    Returns:
+        list[dict]: The siret, names and match score of the best companies, best first.
+    """
+    query_tokens = tokenize(query)
+    if len(query_tokens) == 0:
+        return []
+    projection = {"_id": False, "keys": False}
+
+    # Exact tokens, the last one being a prefix
+    last = query_tokens[-1]
+    conditions = [{"tokens": token} for token in query_tokens[:-1]]
+    # $elemMatch : the two bounds must hold for the same token
+    conditions.append({"tokens": {"$elemMatch": {"$gte": last, "$lt": last + "\uffff"}}})
+    candidates = await names.find({"$and": conditions}, projection, limit=md.NAME_CANDIDATES)
+
+    # Typo tolerant lookup : every query token must match one of its variants, so that the names
+    # holding a common token can't fill md.NAME_CANDIDATES without the other tokens
+    if len(candidates) < limit:
+        conditions = [{"keys": {"$in": sorted(deletions(token) | {token})}} for token in query_tokens[:-1]]
+        # The last token may still be typed, as a prefix
+        conditions.append({"$or": [{"keys": {"$in": sorted(deletions(last) | {last})}}, {"tokens": {"$elemMatch": {"$gte": last, "$lt": last + "\uffff"}}}]})
+        candidates += await names.find({"$and": conditions}, projection, limit=md.NAME_CANDIDATES)
+
+    # The deletion variants of two tokens may intersect without them being one typo apart
+    ranked = {}
+    for entry in candidates:
+        key = score(query_tokens, entry)
+        if key[0] > 0:
+            ranked[entry["siret"]] = (key, entry)
+    best = sorted(ranked.values(), key=lambda item: item[0], reverse=True)[:limit]
+
+    return [{"siret": entry["siret"], "name": entry["name"], "score": key[1]} for key, entry in best]
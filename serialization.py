@@ -0,0 +1,97 @@
+"""
+Fast JSON encoding of the companies returned by the read routes.
+
+The stored documents are already typed by the ingest and the write routes : they are encoded in a
+single pass, in the field order of md.COMPANY_FIELDS, instead of being validated by the response
+models and walked again by jsonable_encoder before the JSON encoding. orjson is used when installed.
+"""
+import json
+import metrics
+import model as md
+from datetime import date, datetime
+from fastapi import Response
+
+# orjson is optional, the standard encoder is used without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Fields stored as datetimes but returned as dates
+DATE_FIELDS = frozenset(name for name, field in md.CompanyModel.__fields__.items() if field.type_ is date)
+
+
+def company_values(company):
+    """
+    Return the fields of a stored company in the order of md.COMPANY_FIELDS, the dates as dates and
+    without the _id and the empty fields.
+    """
+    values = {}
+    for name in md.COMPANY_FIELDS:
+        value = company.get(name)
+        if value is None:
+            continue
+        if name in DATE_FIELDS and isinstance(value, datetime):
+            value = value.date()
+        values[name] = value
+
+    return values
+
+def jsonable(company):
+    """
+    Return the fields of a stored company as JSON values, the dates and datetimes as ISO strings.
+    """
+    return {k: default(v) if isinstance(v, (date, datetime)) else v for k, v in company_values(company).items()}
+
+def default(value):
+    """
+    Encode the values the standard JSON encoder doesn't know.
+    """
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def dumps(content):
+    """
+    Encode a JSON value into bytes.
+    """
+    if orjson is not None:
+        return orjson.dumps(content)
+
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=default).encode("utf-8")
+
+def json_response(content, status_code=200):
+    """
+    Build the response of a route from an already serializable content, bypassing the response model.
+    """
+    with metrics.stage("serialization"):
+        return body_response(dumps(content), status_code)
+
+def encode_companies(companies):
+    """
+    Encode a list of stored companies, as returned by /get.
+    """
+    with metrics.stage("serialization"):
+        return dumps([company_values(company) for company in companies])
+
+def body_response(body, status_code=200):
+    """
+    Build the response of a route from an already encoded JSON body.
+    """
+    return Response(content=body, status_code=status_code, media_type="application/json")
+
+def batch_entry(entry):
+    """
+    Convert a batch result of controller.iter_batch_results into its JSON value.
+    """
+    return {"siret": entry["siret"], "found": entry["found"], "results": [company_values(company) for company in entry["results"]]}
+
+def search_response(page):
+    """
+    Build the response of a page of controller.search, the `next` cursor being omitted on the last page.
+    """
+    content = {"results": [company_values(company) for company in page["results"]]}
+    if page["next"] is not None:
+        content["next"] = page["next"]
+
+    return json_response(content)
@@ -0,0 +1,37 @@
+"""
+Production runner of the API.
+
+Every worker process imports the app and opens its own connection pool at startup, so that nothing
+is shared between the workers but the listening socket. The settings come from model.py, and so
+from the environment or a .env file, the command line taking precedence.
+
+Usage :
+    python serve.py [--workers 4] [--host 0.0.0.0] [--port 8000]
+"""
+import os
+import argparse
+import uvicorn
+import model as md
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the SIRET API with several worker processes")
+    parser.add_argument("--host", default=md.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=md.SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=md.SERVER_WORKERS)
+    args = parser.parse_args()
+
+    # The workers can't share a rotated log file, each one writes its own
+    if args.workers > 1:
+        os.environ["LOG_PER_WORKER"] = "true"
+
+    uvicorn.run(
+        "app:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        backlog=md.SERVER_BACKLOG,
+        timeout_keep_alive=md.SERVER_KEEP_ALIVE,
+        # The app writes its own access log
+        access_log=False,
+    )
@@ -0,0 +1,68 @@
+"""
+Coalescing of concurrent identical lookups.
+
+While a lookup is in flight, the requests asking for the same key wait for its result instead of
+running their own query : a burst of identical requests costs a single database query and a single
+serialization.
+"""
+import asyncio
+import metrics
+
+
+class SingleFlight:
+    """
+    Share the result of an in-flight call between the concurrent callers of the same key.
+
+    The call runs in its own task, so that a caller going away (a client disconnecting) doesn't
+    cancel it for the others.
+
+    Args:
+        name (str): Name of the group in the metrics.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}
+
+    def done(self, key, task):
+        # A later call of the same key may already have replaced this one, see forget
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        # The exception is raised to the callers, a task without any caller left must not log it
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key, func):
+        """
+        Await `func()`, or the call of the same key already in flight.
+
+        Args:
+            key (hashable): Identifier of the call.
+            func (Callable[[], Awaitable]): The call, only made when no call of the key is in flight.
+
+        Returns:
+            The result of the call, shared by every concurrent caller of the key.
+        """
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self.calls[key] = task
+            task.add_done_callback(lambda task: self.done(key, task))
+            metrics.SINGLEFLIGHT.inc(self.name, "leader")
+        else:
+            metrics.SINGLEFLIGHT.inc(self.name, "coalesced")
+
+        return await asyncio.shield(task)
+
+    def forget(self, match):
+        """
+        Stop sharing the in-flight calls whose key matches, e.g. after a write : the next callers start a new call.
+
+        Args:
+            match (Callable[[hashable], bool]): Tell whether a key must be forgotten.
+        """
+        for key in [key for key in self.calls if match(key)]:
+            del self.calls[key]
+
+    def __len__(self):
+        return len(self.calls)
@@ -0,0 +1,246 @@
+"""
+Read-only storage backend answering the siret lookups from a memory-mapped snapshot file, without
+any MongoDB server.
+
+Layout of a snapshot, integers being little-endian :
+
+    header   : magic (8 bytes), version (uint32), reserved (uint32), number of companies n (uint64)
+    keys     : the n sirets, sorted (uint64)
+    offsets  : the position in the file of the record of each siret (uint64)
+    records  : the companies, one BSON document each, which starts with its own length
+
+A lookup is a binary search over the keys array mapped in memory, followed by the decoding of a
+single record. The pages of the file are shared by every process mapping it.
+"""
+import os
+import sys
+import mmap
+import bson
+import struct
+import bisect
+import shutil
+import model as md
+from array import array
+
+MAGIC = b"SIRETSNP"
+VERSION = 1
+HEADER = struct.Struct("<8sIIQ")
+
+
+class UnsupportedOperation(Exception):
+    """
+    Raised for the writes and the queries a snapshot can't answer.
+    """
+
+
+class SnapshotWriter:
+    """
+    Write the companies into a snapshot file.
+
+    The records are appended to a temporary file as they come, and the keys are sorted once every
+    company has been added : a stock file sorted by siret is written without any sort.
+
+    Args:
+        path (str): Path of the snapshot to write.
+    """
+
+    def __init__(self, path):
+        if sys.byteorder != "little":
+            raise UnsupportedOperation("Snapshots are written on little-endian platforms only")
+        self.path = path
+        self.records = open(path + ".records", "wb")
+        self.keys = array("Q")
+        self.offsets = array("Q")
+        self.position = 0
+        self.ordered = True
+
+    def add(self, company):
+        """
+        Append a company, as stored in the database.
+        """
+        record = bson.encode(company)
+        if len(self.keys) > 0 and company["siret"] <= self.keys[-1]:
+            self.ordered = False
+        self.keys.append(company["siret"])
+        self.offsets.append(self.position)
+        self.records.write(record)
+        self.position += len(record)
+
+    def close(self):
+        """
+        Write the header, the sorted keys and the offsets, followed by the records.
+
+        Returns:
+            int: The number of companies in the snapshot, a duplicated siret keeping its first record.
+        """
+        self.records.close()
+        keys, offsets = self.keys, self.offsets
+        if not self.ordered:
+            # Stable sort : the first record of a duplicated siret comes first
+            order = sorted(range(len(keys)), key=keys.__getitem__)
+            keys, offsets = array("Q", (keys[i] for i in order)), array("Q", (offsets[i] for i in order))
+            unique = [i for i in range(len(keys)) if i == 0 or keys[i] != keys[i - 1]]
+            keys, offsets = array("Q", (keys[i] for i in unique)), array("Q", (offsets[i] for i in unique))
+
+        base = HEADER.size + 16 * len(keys)
+        for i in range(len(offsets)):
+            offsets[i] += base
+        with open(self.path + ".tmp", "wb") as file:
+            file.write(HEADER.pack(MAGIC, VERSION, 0, len(keys)))
+            keys.tofile(file)
+            offsets.tofile(file)
+            with open(self.path + ".records", "rb") as records:
+                shutil.copyfileobj(records, file, 16 * 1024 * 1024)
+        os.remove(self.path + ".records")
+        # The snapshot being served is only replaced by a complete file
+        os.replace(self.path + ".tmp", self.path)
+
+        return len(keys)
+
+def write_snapshot(path, companies):
+    """
+    Write a snapshot of companies.
+
+    Args:
+        path (str): Path of the snapshot to write.
+        companies (Iterable[dict]): The companies, as stored in the database.
+
+    Returns:
+        int: The number of companies in the snapshot.
+    """
+    writer = SnapshotWriter(path)
+    for company in companies:
+        writer.add(company)
+
+    return writer.close()
+
+def apply_projection(company, projection):
+    """
+    Keep the fields of a company selected by a find projection.
+    """
+    if projection is None:
+        return company
+    fields = [name for name, selected in projection.items() if selected and name != "_id"]
+    if len(fields) == 0:
+        company.pop("_id", None)
+        return company
+
+    return {name: company[name] for name in fields if name in company}
+
+
+class ReadOnlyCollection:
+    """
+    Collection of a snapshot backend : indexes are built in, writes and queries are unsupported.
+
+    Args:
+        name (str): Name of the collection.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def unsupported(self, *args, **kwargs):
+        raise UnsupportedOperation(f"The snapshot storage backend doesn't support this operation on {self.name}")
+
+    insert_one = insert_many = update_one = replace_one = delete_one = delete_many = unsupported
+    bulk_write = find_one_and_update = find_one_and_delete = drop_index = aggregate = unsupported
+    find = find_one = count_documents = unsupported
+
+    def create_index(self, *args, **kwargs):
+        pass
+
+    def index_information(self):
+        return {}
+
+class SnapshotCollection(ReadOnlyCollection):
+    """
+    Companies of a snapshot file, queried by siret like a pymongo collection.
+
+    Args:
+        path (str): Path of the snapshot.
+        name (str, optional): Name of the collection. Default is md.COLLECTION_NAME.
+
+    Raises:
+        ValueError: If the file is not a snapshot.
+    """
+
+    def __init__(self, path, name=md.COLLECTION_NAME):
+        super().__init__(name)
+        with open(path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, count = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} siret snapshot")
+        if sys.byteorder != "little":
+            raise UnsupportedOperation("Snapshots are read on little-endian platforms only")
+
+        # Views over the mapped pages, nothing is copied
+        view = memoryview(self.map)
+        self.keys = view[HEADER.size:HEADER.size + 8 * count].cast("Q")
+        self.offsets = view[HEADER.size + 8 * count:HEADER.size + 16 * count].cast("Q")
+        self.view = view
+
+    def __len__(self):
+        return len(self.keys)
+
+    def record(self, i):
+        """
+        Decode the record of the i-th siret.
+        """
+        offset = self.offsets[i]
+        length = int.from_bytes(self.view[offset:offset + 4], "little")
+
+        return bson.decode(self.view[offset:offset + length])
+
+    def positions(self, filter):
+        """
+        Return the positions of the sirets matching a filter, in siret order.
+        """
+        if filter == {}:
+            return range(len(self.keys))
+        if list(filter) == ["siret"]:
+            value = filter["siret"]
+            if isinstance(value, int):
+                sirets = [value]
+            elif isinstance(value, dict) and list(value) == ["$in"]:
+                sirets = sorted(set(value["$in"]))
+            else:
+                self.unsupported()
+            positions = [bisect.bisect_left(self.keys, siret) for siret in sirets]
+            return [i for i, siret in zip(positions, sirets) if i < len(self.keys) and self.keys[i] == siret]
+        self.unsupported()
+
+    def find(self, filter=None, projection=None, limit=0, **kwargs):
+        """
+        Iterate over the companies matching a filter on the siret (a value or `$in`), or over every company.
+        """
+        positions = self.positions(filter or {})
+        if limit:
+            positions = positions[:limit]
+
+        return (apply_projection(self.record(i), projection) for i in positions)
+
+    def find_one(self, filter=None, projection=None, **kwargs):
+        return next(self.find(filter, projection, limit=1), None)
+
+    def count_documents(self, filter, **kwargs):
+        return len(self.positions(filter))
+
+    def index_information(self):
+        return {"siret_1": {"key": [("siret", 1)], "unique": True}}
+
+    def close(self):
+        self.keys.release()
+        self.offsets.release()
+        self.view.release()
+        self.map.close()
+
+def open_collection(name=md.COLLECTION_NAME, path=md.SNAPSHOT_PATH):
+    """
+    Open a collection of the snapshot backend : the companies come from the snapshot file, the
+    other collections are not available.
+    """
+    if name == md.COLLECTION_NAME:
+        return SnapshotCollection(path, name)
+
+    return ReadOnlyCollection(name)
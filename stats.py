@@ -0,0 +1,218 @@
+"""
+Materialized counts of the companies per activity, headcount band, département and administrative state.
+
+The counts are stored in the md.STATS_COLLECTION_NAME collection, one document per dimension and
+value, so that /stats reads a few hundred small documents whatever the number of companies. They
+are rebuilt by data_integration.py after every load, and kept up to date by the write routes with
+`$inc` updates computed from the companies before and after each write, as returned by the write itself.
+
+Usage :
+    python stats.py verify
+    python stats.py rebuild
+"""
+import json
+import argparse
+import model as md
+import controller as ctrl
+from collections import Counter
+from pymongo import UpdateOne
+
+TOTAL = "total"
+
+
+def departement(code_commune):
+    """
+    Return the département of a commune code : 2 characters, 3 for the overseas départements.
+    """
+    if not code_commune:
+        return None
+    code_commune = str(code_commune)
+
+    return code_commune[:3] if code_commune[:2] in ("97", "98") else code_commune[:2]
+
+def dimension_values(company):
+    """
+    Return the (dimension, value) pairs counting a company, the total included.
+    """
+    values = [(TOTAL, None)]
+    for dimension in md.STATS_DIMENSIONS:
+        if dimension == "departement":
+            values.append((dimension, departement(company.get("codeCommuneEtablissement"))))
+        else:
+            values.append((dimension, company.get(dimension)))
+
+    return values
+
+def count(companies):
+    """
+    Count companies per dimension and value.
+
+    Returns:
+        collections.Counter: The number of companies keyed by (dimension, value).
+    """
+    counts = Counter()
+    for company in companies:
+        counts.update(dimension_values(company))
+
+    return counts
+
+def delta(previous, written):
+    """
+    Compute the changes of the counts made by a write.
+
+    Args:
+        previous (dict): The companies before the write, None for the inserted ones, keyed by siret.
+        written (dict): The companies after the write, None for the deleted ones, keyed by siret.
+
+    Returns:
+        collections.Counter: The non zero changes keyed by (dimension, value).
+    """
+    changes = count(company for company in written.values() if company is not None)
+    changes.subtract(count(company for company in previous.values() if company is not None))
+
+    return Counter({key: change for key, change in changes.items() if change != 0})
+
+def stats_id(dimension, value):
+    return TOTAL if dimension == TOTAL else f"{dimension}={value}"
+
+def increments(changes):
+    """
+    Build the upserts applying changes to the stored counts.
+    """
+    return [
+        UpdateOne({"_id": stats_id(dimension, value)}, {"$inc": {"count": change}, "$setOnInsert": {"dimension": dimension, "value": value}}, upsert=True)
+        for (dimension, value), change in changes.items()
+    ]
+
+async def apply(stats, previous, written):
+    """
+    Update the stored counts after a write, with a single bulk write.
+
+    Args:
+        stats (storage.AsyncCollection): The stats collection.
+        previous (dict): The companies before the write, None for the inserted ones, keyed by siret.
+        written (dict): The companies after the write, None for the deleted ones, keyed by siret.
+    """
+    operations = increments(delta(previous, written))
+    if operations:
+        await stats.bulk_write(operations, ordered=False)
+
+async def read(stats, dimension=None):
+    """
+    Read the stored counts.
+
+    Args:
+        stats (storage.AsyncCollection): The stats collection.
+        dimension (str, optional): Only read the counts of this dimension of md.STATS_DIMENSIONS.
+
+    Returns:
+        dict: The total and, for every dimension, the number of companies per value, the companies
+        without any value being counted under null.
+    """
+    filter = {"dimension": {"$in": [TOTAL, dimension]}} if dimension is not None else {}
+    documents = await stats.find(filter, {"_id": False})
+
+    return to_result(documents, [dimension] if dimension is not None else md.STATS_DIMENSIONS)
+
+def to_result(documents, dimensions):
+    """
+    Shape the stats documents into the response of /stats.
+    """
+    result = {TOTAL: 0}
+    result.update({dimension: {} for dimension in dimensions})
+    for document in documents:
+        if document["dimension"] == TOTAL:
+            result[TOTAL] = document["count"]
+        elif document["count"] > 0 and document["dimension"] in result:
+            # JSON keys are strings
+            result[document["dimension"]]["null" if document["value"] is None else str(document["value"])] = document["count"]
+
+    return result
+
+def recompute(collection):
+    """
+    Count the companies of the collection with one aggregation per dimension.
+
+    Args:
+        collection (pymongo.collection.Collection): The companies collection.
+
+    Returns:
+        collections.Counter: The number of companies keyed by (dimension, value).
+    """
+    counts = Counter()
+    for dimension in md.STATS_DIMENSIONS:
+        field = "codeCommuneEtablissement" if dimension == "departement" else dimension
+        for group in collection.aggregate([{"$group": {"_id": "$" + field, "count": {"$sum": 1}}}], allowDiskUse=True):
+            value = departement(group["_id"]) if dimension == "departement" else group["_id"]
+            counts[(dimension, value)] += group["count"]
+    counts[(TOTAL, None)] = collection.count_documents({})
+
+    return counts
+
+def stored(stats):
+    """
+    Read the stored counts of the stats collection.
+
+    Returns:
+        collections.Counter: The number of companies keyed by (dimension, value), without the zero counts.
+    """
+    return Counter({(document["dimension"], document["value"]): document["count"] for document in stats.find({"count": {"$ne": 0}})})
+
+def rebuild(collection, stats):
+    """
+    Bring the stored counts to a full recompute.
+
+    The differences with the stored counts are applied as `$inc` updates instead of replacing the
+    counts, so that the increments of the writes landing after the stored counts are read aren't
+    overwritten. A write landing during the recompute may still be counted twice or not at all, as
+    the aggregations may or may not see it : rebuild while no write runs, or run `verify` again
+    once the writes are over.
+
+    Args:
+        collection (pymongo.collection.Collection): The companies collection.
+        stats (pymongo.collection.Collection): The stats collection.
+
+    Returns:
+        collections.Counter: The recomputed counts.
+    """
+    counts = recompute(collection)
+    changes = Counter(counts)
+    changes.subtract(stored(stats))
+    operations = increments(Counter({key: change for key, change in changes.items() if change != 0}))
+    if operations:
+        stats.bulk_write(operations, ordered=False)
+    # The values no company holds anymore
+    stats.delete_many({"count": 0})
+
+    return counts
+
+def verify(collection, stats):
+    """
+    Compare the stored counts with a full recompute.
+
+    Returns:
+        list[dict]: The dimension, value, stored and recomputed counts of every difference, none if the counts match.
+    """
+    expected, actual = recompute(collection), stored(stats)
+
+    return [
+        {"dimension": dimension, "value": value, "stored": actual.get((dimension, value), 0), "recomputed": expected.get((dimension, value), 0)}
+        for dimension, value in sorted(set(expected) | set(actual), key=str)
+        if actual.get((dimension, value), 0) != expected.get((dimension, value), 0)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check or rebuild the materialized statistics")
+    parser.add_argument("action", choices=["verify", "rebuild"])
+    args = parser.parse_args()
+
+    collection = ctrl.init_collection()
+    stats = ctrl.init_collection(name=md.STATS_COLLECTION_NAME)
+    if args.action == "verify":
+        differences = verify(collection, stats)
+        print(json.dumps(differences, indent=2, default=str))
+        print("{} difference(s) with a full recompute".format(len(differences)))
+        raise SystemExit(1 if differences else 0)
+    counts = rebuild(collection, stats)
+    print("{} companies counted".format(counts[(TOTAL, None)]))
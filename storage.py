@@ -0,0 +1,108 @@
+"""
+Asynchronous access to the MongoDB collection.
+
+pymongo is synchronous : every call is offloaded to a dedicated thread pool so that the
+`async def` handlers of the API never block the event loop while waiting for the database.
+"""
+import asyncio
+import metrics
+import model as md
+from functools import partial
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncCollection:
+    """
+    Wrap a pymongo collection and expose its operations as coroutines.
+
+    Args:
+        collection (pymongo.collection.Collection): The collection to wrap.
+        pool_size (int, optional): Number of queries allowed in flight at the same time. Default is md.MONGO_POOL_SIZE.
+    """
+
+    def __init__(self, collection, pool_size=md.MONGO_POOL_SIZE):
+        self.collection = collection
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="mongo")
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run a blocking call in the thread pool and wait for its result without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        metrics.MONGO_QUERIES_IN_FLIGHT.inc()
+        try:
+            # Includes the wait for a free thread of the pool
+            with metrics.stage("mongo"):
+                return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+        finally:
+            metrics.MONGO_QUERIES_IN_FLIGHT.dec()
+
+    async def find(self, filter, projection=None, **kwargs):
+        """
+        Run a find query and return the whole result as a list.
+        """
+        return await self.run(lambda: list(self.collection.find(filter, projection, **kwargs)))
+
+    def iter_batches(self, filter, projection=None, batch_size=1000, **kwargs):
+        """
+        Iterate over the result of a find query by lists of `batch_size` documents.
+
+        Only one batch is held in memory at a time, whatever the size of the result. The cursor is
+        created right away, without any I/O : a query the storage backend doesn't support fails
+        here, before a streamed response has sent its headers.
+        """
+        cursor = self.collection.find(filter, projection, batch_size=batch_size, **kwargs)
+        return self.read_batches(cursor, batch_size)
+
+    async def read_batches(self, cursor, batch_size):
+        """
+        Read a cursor by lists of `batch_size` documents, then close it.
+        """
+        try:
+            while True:
+                batch = await self.run(lambda: list(islice(cursor, batch_size)))
+                if len(batch) == 0:
+                    break
+                yield batch
+        finally:
+            cursor.close()
+
+    async def ping(self):
+        """
+        Run a cheap indexed lookup, to check that the collection answers.
+        """
+        return await self.find_one({"siret": 0}, {"_id": True})
+
+    async def find_one(self, filter, projection=None, **kwargs):
+        return await self.run(self.collection.find_one, filter, projection, **kwargs)
+
+    async def insert_one(self, document, **kwargs):
+        return await self.run(self.collection.insert_one, document, **kwargs)
+
+    async def update_one(self, filter, update, **kwargs):
+        return await self.run(self.collection.update_one, filter, update, **kwargs)
+
+    async def delete_one(self, filter, **kwargs):
+        return await self.run(self.collection.delete_one, filter, **kwargs)
+
+    async def delete_many(self, filter, **kwargs):
+        return await self.run(self.collection.delete_many, filter, **kwargs)
+
+    async def bulk_write(self, requests, **kwargs):
+        return await self.run(self.collection.bulk_write, requests, **kwargs)
+
+    async def replace_one(self, filter, replacement, **kwargs):
+        return await self.run(self.collection.replace_one, filter, replacement, **kwargs)
+
+    async def find_one_and_update(self, filter, update, **kwargs):
+        return await self.run(self.collection.find_one_and_update, filter, update, **kwargs)
+
+    async def find_one_and_delete(self, filter, **kwargs):
+        return await self.run(self.collection.find_one_and_delete, filter, **kwargs)
+
+    def close(self):
+        """
+        Stop the thread pool once the pending queries are done.
+        """
+        self.executor.shutdown(wait=True)
@@ -1,12 +1,47 @@
+import os
+import json
+import time
+import asyncio
 import unittest
+from unittest import mock
 import random
+import httpx
+import tempfile
+import snapshot
+import serialization
+import stats
+import storage
+import benchmark
+import app as api
+import limiter
+import name_index
+import invalidation
+import data_integration
+import model as md
+import controller as ctrl
+from cache import TTLCache, MISSING
+from datetime import datetime
+from pymongo.errors import ServerSelectionTimeoutError
 from fastapi.testclient import TestClient
-from controller import init_collection, consistency_siret, create_new_company, find_result
-from model import CompanyModel, UpdateCompanyModel
+from fastapi.encoders import jsonable_encoder
+from controller import init_collection, ensure_indexes, ensure_siret_index, has_unique_siret_index, consistency_siret, create_new_company, find_result
+from model import CompanyModel, SparseCompanyModel, UpdateCompanyModel, STATS_COLLECTION_NAME
 from app import app
 
 client = TestClient(app)
 
+def setUpModule():
+    # The indexes are built by data_integration.py, the app only checks them
+    ensure_indexes(init_collection())
+    name_index.ensure_indexes(init_collection(name=md.NAMES_COLLECTION_NAME))
+    # Run the startup of the app, which opens the database connection
+    client.__enter__()
+    # Every test client comes from the same host : the rate limits are only enabled by TestLimiter
+    md.LIMITER_ENABLED = False
+
+def tearDownModule():
+    client.__exit__(None, None, None)
+
 def filter_res(p_response, p_fields=["siret", "siren", "nic"]):
     return [{k:v for k,v in p_response.json()[0].items() if k in p_fields}]
 
@@ -48,7 +83,7 @@ class TestAPI(unittest.TestCase):
         response = client.get("/get", params={"siret": 12345600789})
         self.assertEqual(response.status_code, 200)
         self.assertEqual(filter_res(response), 
-        [{"siret": "12345600789", "siren": "123456", "nic": "789"}])
+        [{"siret": 12345600789, "siren": 123456, "nic": 789}])
 
         # Test fetching a company that does not exist in the database
         response = client.get("/get", params={"siret": 987654321})
@@ -58,7 +93,7 @@ class TestAPI(unittest.TestCase):
 
     def test_3_update_company(self):
         # Test updating a company that exists in the database
-        update_data = UpdateCompanyModel(etablissementSiege="Paris")
+        update_data = UpdateCompanyModel(etablissementSiege=True, etatAdministratifEtablissement="F")
         response = client.put("/12345600789", json=update_data.dict())
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json(), {"detail": "The update proceed correctly"})
@@ -79,5 +114,772 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(response.json(), {"detail": "The corporate with 987654321 siret code doesn't exist"})
 
+class TestSchema(unittest.TestCase):
+    def setUp(self):
+        self.collection = init_collection()
+        api.company_cache.clear()
+
+    def tearDown(self):
+        self.collection.delete_many({"siret": 42345600001})
+
+    def test_typed_document(self):
+        # Test the empty fields are omitted and the types are kept in the database
+        company = CompanyModel(siret=42345600001, siren=423456, nic=1, dateCreationEtablissement="2001-02-03",
+        etablissementSiege="true", trancheEffectifsEtablissement="00", codePostalEtablissement="01500")
+        self.assertEqual(client.post("/", json=json.loads(company.json())).status_code, 200)
+        document = self.collection.find_one({"siret": 42345600001}, {"_id": False})
+        self.assertEqual(len(document), 7)
+        self.assertIs(document["etablissementSiege"], True)
+
+        # Test the response serializes the types directly
+        response = client.get("/get", params={"siret": 42345600001})
+        self.assertEqual(response.json(), [{"siret": 42345600001, "siren": 423456, "nic": 1, "dateCreationEtablissement": "2001-02-03",
+        "etablissementSiege": True, "trancheEffectifsEtablissement": "00", "codePostalEtablissement": "01500"}])
+
+        # Test an unknown code is rejected
+        response = client.put("/42345600001", json={"etatAdministratifEtablissement": "X"})
+        self.assertEqual(response.status_code, 422)
+
+        # Test the update removes the fields left empty
+        response = client.put("/42345600001", json={"etatAdministratifEtablissement": "A"})
+        self.assertEqual(response.status_code, 200)
+        document = self.collection.find_one({"siret": 42345600001}, {"_id": False})
+        self.assertEqual(document, {"siret": 42345600001, "siren": 423456, "nic": 1, "etatAdministratifEtablissement": "A"})
+
+class TestProjection(unittest.TestCase):
+    def setUp(self):
+        self.collection = init_collection()
+        api.company_cache.clear()
+        company = CompanyModel(siret=52345600001, siren=523456, nic=1, codePostalEtablissement="75001",
+        libelleCommuneEtablissement="PARIS", etatAdministratifEtablissement="A", activitePrincipaleEtablissement="62.01Z")
+        self.collection.insert_one(create_new_company(company))
+
+    def tearDown(self):
+        self.collection.delete_many({"siret": 52345600001})
+
+    def test_fields(self):
+        # Test a preset combined with a field name, from the database then from the cache
+        for _ in range(2):
+            response = client.get("/get", params={"siret": 52345600001, "fields": "address,siren"})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json(), [{"siret": 52345600001, "siren": 523456,
+            "codePostalEtablissement": "75001", "libelleCommuneEtablissement": "PARIS"}])
+            client.get("/get", params={"siret": 52345600001})
+
+        # Test an unknown field is rejected
+        response = client.get("/get", params={"siret": 52345600001, "fields": "status,codePostal"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"detail": "Unknown fields : codePostal"})
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        self.collection = init_collection()
+        for nic in range(1, 6):
+            company = CompanyModel(siret=int(f"623456{nic:05}"), siren=623456, nic=nic, codePostalEtablissement="98714",
+            etatAdministratifEtablissement="A" if nic % 2 else "F")
+            self.collection.insert_one(create_new_company(company))
+
+    def tearDown(self):
+        self.collection.delete_many({"siren": 623456})
+
+    def test_search(self):
+        # Test the pages follow each other through the next cursor
+        sirets, after = [], None
+        while True:
+            params = {"codePostalEtablissement": "98714", "limit": 2, "fields": "siren"}
+            if after is not None:
+                params["after"] = after
+            page = client.get("/search", params=params).json()
+            sirets += [company["siret"] for company in page["results"]]
+            after = page.get("next")
+            if after is None:
+                break
+        self.assertEqual(sirets, [int(f"623456{nic:05}") for nic in range(1, 6)])
+
+        # Test combining a criterion with the administrative state
+        response = client.get("/search", params={"siren": 623456, "etatAdministratifEtablissement": "F"})
+        self.assertEqual([company["nic"] for company in response.json()["results"]], [2, 4])
+
+        # Test a search without any criterion
+        response = client.get("/search", params={"etatAdministratifEtablissement": "A"})
+        self.assertEqual(response.status_code, 400)
+
+class TestNameSearch(unittest.TestCase):
+    def setUp(self):
+        api.company_cache.clear()
+        self.companies = [
+            CompanyModel(siret=72345600001, siren=723456, nic=1, denominationUsuelleEtablissement="Boulangerie Pâtisserie Dupont"),
+            CompanyModel(siret=72345600002, siren=723456, nic=2, enseigne1Etablissement="Café du Marché"),
+        ]
+        for company in self.companies:
+            client.post("/", json=company.dict())
+
+    def tearDown(self):
+        for company in self.companies:
+            client.delete(f"/delete/{company.siret}")
+
+    def test_search_name(self):
+        # Test a prefix without the accents
+        response = client.get("/search/name", params={"q": "boulangerie patis"})
+        self.assertEqual(response.json()["results"][0]["siret"], 72345600001)
+
+        # Test a typo
+        response = client.get("/search/name", params={"q": "marshé"})
+        self.assertEqual(response.json()["results"][0]["name"], "Café du Marché")
+
+        # Test the index follows the updates and the deletions
+        client.put("/72345600002", json={"enseigne1Etablissement": "Brasserie du Port"})
+        response = client.get("/search/name", params={"q": "marche"})
+        self.assertNotIn(72345600002, [result["siret"] for result in response.json()["results"]])
+        client.delete("/delete/72345600001")
+        response = client.get("/search/name", params={"q": "dupont"})
+        self.assertNotIn(72345600001, [result["siret"] for result in response.json()["results"]])
+
+    def test_common_token_typo(self):
+        # Other bakeries, indexed first, fill the candidates with the common token alone
+        client.delete("/delete/72345600001")
+        others = [CompanyModel(siret=72345600010 + i, siren=723456, nic=10 + i, denominationUsuelleEtablissement=f"Boulangerie Martin {i}") for i in range(3)]
+        for company in others + self.companies[:1]:
+            client.post("/", json=company.dict())
+        self.companies += others
+
+        # Test a typo in the rare token still finds the company
+        with mock.patch.object(md, "NAME_CANDIDATES", 2):
+            response = client.get("/search/name", params={"q": "boulangerie dupomt"})
+        self.assertEqual(response.json()["results"][0]["siret"], 72345600001)
+
+class TestBulk(unittest.TestCase):
+    def setUp(self):
+        api.company_cache.clear()
+
+    def tearDown(self):
+        init_collection().delete_many({"siren": 823456})
+
+    def test_bulk_writes(self):
+        # Test inserting a list with an inconsistent and a duplicated company
+        companies = [CompanyModel(siret=82345600001, siren=823456, nic=1, enseigne1Etablissement="Le Zinc"),
+        CompanyModel(siret=82345600002, siren=823456, nic=3), CompanyModel(siret=82345600001, siren=823456, nic=1)]
+        response = client.post("/bulk", json=[company.dict() for company in companies])
+        self.assertEqual([item["status"] for item in response.json()["results"]], [200, 400, 409])
+
+        # Test updating a known and an unknown company
+        response = client.put("/bulk", json=[{"siret": 82345600001, "etablissementSiege": True}, {"siret": 82345600009}])
+        self.assertEqual([item["status"] for item in response.json()["results"]], [200, 404])
+        self.assertEqual(client.get("/get", params={"siret": 82345600001}).json()[0]["etablissementSiege"], True)
+        response = client.get("/search/name", params={"q": "zinc"})
+        self.assertNotIn(82345600001, [result["siret"] for result in response.json()["results"]])
+
+        # Test deleting a known and an unknown company
+        response = client.request("DELETE", "/bulk", json={"sirets": [82345600001, 82345600009]})
+        self.assertEqual([item["status"] for item in response.json()["results"]], [200, 404])
+        self.assertEqual(client.get("/get", params={"siret": 82345600001}).status_code, 404)
+
+    def test_write_during_bulk(self):
+        # Another request writes every company right before the bulk routes do
+        class WritingCollection(SlowCollection):
+            def find_one_and_update(self, filter, *args, **kwargs):
+                self.collection.update_one(filter, {"$set": {"activitePrincipaleEtablissement": "99.97Z"}})
+                return self.collection.find_one_and_update(filter, *args, **kwargs)
+
+            def find_one_and_delete(self, filter, *args, **kwargs):
+                if filter["siret"] == 82345600002:
+                    self.collection.delete_one(filter)
+                return self.collection.find_one_and_delete(filter, *args, **kwargs)
+
+        collection = init_collection()
+        for nic in [1, 2]:
+            collection.insert_one(create_new_company(CompanyModel(siret=int(f"82345600{nic:03}"), siren=823456, nic=nic, activitePrincipaleEtablissement="99.99Z")))
+        async_collection = storage.AsyncCollection(WritingCollection(collection, 0))
+        try:
+            # Test the previous companies are the ones replaced, the updates of a siret being merged in order
+            updates = [md.BulkUpdateCompanyModel(siret=82345600001, etablissementSiege=True), md.BulkUpdateCompanyModel(siret=82345600001, activitePrincipaleEtablissement="99.98Z"), md.BulkUpdateCompanyModel(siret=82345600009)]
+            report, written, previous = asyncio.run(ctrl.bulk_update(async_collection, updates))
+            self.assertEqual([item["status"] for item in report], [200, 200, 404])
+            self.assertEqual(previous[82345600001]["activitePrincipaleEtablissement"], "99.97Z")
+            self.assertEqual(written[82345600001]["activitePrincipaleEtablissement"], "99.98Z")
+            self.assertNotIn("etablissementSiege", written[82345600001])
+            self.assertEqual(collection.find_one({"siret": 82345600001}, {"_id": False}), dict(written[82345600001], siren=823456, nic=1))
+
+            # Test a company deleted by the other request first is reported unknown
+            report, written, previous = asyncio.run(ctrl.bulk_delete(async_collection, [82345600001, 82345600002]))
+            self.assertEqual([item["status"] for item in report], [200, 404])
+            self.assertEqual((list(written), list(previous)), ([82345600001], [82345600001]))
+        finally:
+            async_collection.close()
+            collection.delete_many({"siren": 823456})
+
+class TestIngest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = f"{self.tmp.name}/StockEtablissement.csv"
+        self.companies = list(benchmark.synthetic_companies(60, seed=5, start=700000000))
+        benchmark.write_csv(self.path, self.companies)
+
+    def tearDown(self):
+        init_collection().delete_many({"siret": {"$in": [company["siret"] for company in self.companies]}})
+        self.tmp.cleanup()
+
+    def test_split_file(self):
+        # Test the slices follow each other and start on a line
+        header, chunks = data_integration.split_file(self.path, chunk_bytes=1000)
+        with open(self.path, "rb") as file:
+            data = file.read()
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(chunks[0][0], len(header))
+        self.assertEqual(chunks[-1][1], len(data))
+        for (_, end), (start, _) in zip(chunks, chunks[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[start - 1:start], b"\n")
+
+        # Test every record is read once
+        sirets = [siret for start, end in chunks for siret in data_integration.read_chunk(self.path, header, start, end)["siret"]]
+        self.assertEqual(sirets, [company["siret"] for company in self.companies])
+
+    def test_to_documents(self):
+        # Test the dates, booleans and integers are typed and the empty fields omitted
+        with open(self.path, "w") as file:
+            file.write("siren,nic,siret,etablissementSiege,dateCreationEtablissement,anneeEffectifsEtablissement,codePostalEtablissement\n")
+            file.write("700000001,1,70000000100001,true,2020-01-15,2021,01000\n")
+            file.write("700000001,2,70000000100002,false,,,\n")
+        header, chunks = data_integration.split_file(self.path)
+        documents = data_integration.to_documents(data_integration.read_chunk(self.path, header, *chunks[0]))
+        self.assertEqual(documents, [
+            {"siren": 700000001, "nic": 1, "siret": 70000000100001, "etablissementSiege": True, "dateCreationEtablissement": datetime(2020, 1, 15), "anneeEffectifsEtablissement": 2021, "codePostalEtablissement": "01000"},
+            {"siren": 700000001, "nic": 2, "siret": 70000000100002, "etablissementSiege": False},
+        ])
+        # The values are BSON encodable, pandas.Timestamp being a datetime
+        for value, expected in zip(documents[0].values(), [int, int, int, bool, datetime, int, str]):
+            self.assertIsInstance(value, expected)
+
+    def test_resume(self):
+        # Test a resumed ingest only loads the chunks not committed yet, then drops its checkpoint
+        checkpoint = f"{self.tmp.name}/checkpoint.json"
+        header, chunks = data_integration.split_file(self.path, chunk_bytes=1000)
+        data_integration.write_checkpoint(checkpoint, 1000, {self.path: {0}})
+        self.assertEqual(data_integration.read_checkpoint(checkpoint, 1000), {self.path: {0}})
+        self.assertEqual(data_integration.read_checkpoint(checkpoint, 2000), {})
+
+        first = len(data_integration.read_chunk(self.path, header, *chunks[0]))
+        self.assertEqual(data_integration.ingest([self.path], workers=1, chunk_bytes=1000, checkpoint=checkpoint), len(self.companies) - first)
+        self.assertFalse(os.path.exists(checkpoint))
+
+        # Test the checkpoint of a previous version of the file is ignored
+        data_integration.write_checkpoint(checkpoint, 1000, {self.path: {0}})
+        with open(self.path, "a") as file:
+            file.write("\n")
+        self.assertEqual(data_integration.read_checkpoint(checkpoint, 1000), {})
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = f"{self.tmp.name}/StockEtablissement.csv"
+        companies = list(benchmark.synthetic_companies(4, seed=6, start=710000000))
+        self.sirets = [company["siret"] for company in companies]
+
+        # The first 3 companies are stored as loaded, the file then changes the date of the second, a
+        # name of the third without its date, and adds the fourth
+        benchmark.write_csv(self.path, companies[:3])
+        init_collection().insert_many(self.read_file())
+        companies[1]["dateDernierTraitementEtablissement"] = datetime(2024, 6, 1)
+        companies[2]["enseigne1Etablissement"] = "NOUVELLE ENSEIGNE"
+        benchmark.write_csv(self.path, companies)
+        data_integration.init_worker()
+
+    def tearDown(self):
+        init_collection().delete_many({"siret": {"$in": self.sirets}})
+        init_collection(name=md.NAMES_COLLECTION_NAME).delete_many({"siret": {"$in": self.sirets}})
+        self.tmp.cleanup()
+
+    def read_file(self):
+        header, chunks = data_integration.split_file(self.path)
+        return data_integration.to_documents(data_integration.read_chunk(self.path, header, *chunks[0]))
+
+    def sync_file(self, compare, dry_run=False):
+        header, chunks = data_integration.split_file(self.path)
+        return data_integration.sync_chunk(self.path, header, *chunks[0], compare, dry_run, None)
+
+    def test_compare(self):
+        # Test the dry run counts the changes without writing them
+        self.assertEqual(self.sync_file("date", dry_run=True), (4, 1, 1, None))
+        self.assertIsNone(init_collection().find_one({"siret": self.sirets[3]}))
+        self.assertNotEqual(init_collection().find_one({"siret": self.sirets[1]})["dateDernierTraitementEtablissement"], datetime(2024, 6, 1))
+
+        # Test the content comparison also finds the change without a new date
+        self.assertEqual(self.sync_file("content", dry_run=True), (4, 1, 2, None))
+
+        # Test the changes are written, the next sync finding every record unchanged
+        self.assertEqual(self.sync_file("content"), (4, 1, 2, None))
+        self.assertEqual(init_collection().find_one({"siret": self.sirets[2]})["enseigne1Etablissement"], "NOUVELLE ENSEIGNE")
+        self.assertIn("nouvelle", init_collection(name=md.NAMES_COLLECTION_NAME).find_one({"siret": self.sirets[2]})["tokens"])
+        self.assertIsNotNone(init_collection().find_one({"siret": self.sirets[3]}))
+        self.assertEqual(self.sync_file("date"), (4, 0, 0, None))
+        self.assertEqual(self.sync_file("content"), (4, 0, 0, None))
+
+    def test_deletions(self):
+        # The stored sirets are merged with the sorted sirets of the slices, written to files
+        collection = init_collection()
+        collection.insert_many([create_new_company(CompanyModel(siret=int(f"92345600{nic:03}"), siren=923456, nic=nic)) for nic in [1, 2, 3]])
+        sirets = [company["siret"] for company in collection.find({}, {"siret": True}) if company["siret"] != 92345600002]
+        with tempfile.TemporaryDirectory() as tmp:
+            files = [data_integration.write_sirets(tmp, sirets[::2]), data_integration.write_sirets(tmp, sirets[1::2])]
+            self.assertEqual(list(data_integration.read_sirets(files[0], block_size=2)), sorted(sirets[::2]))
+
+            # Test only the companies missing from every file are deleted
+            self.assertEqual(data_integration.delete_missing(files, dry_run=True), 1)
+            self.assertEqual(data_integration.delete_missing(files), 1)
+        self.assertIsNone(collection.find_one({"siret": 92345600002}))
+        self.assertEqual(list(data_integration.missing_sirets([1, 2, 4, 7], [1, 1, 3, 4, 5])), [2, 7])
+        collection.delete_many({"siren": 923456})
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.collection = init_collection()
+        self.stats = init_collection(name=STATS_COLLECTION_NAME)
+        stats.rebuild(self.collection, self.stats)
+
+    def tearDown(self):
+        self.collection.delete_many({"siren": 723456})
+        stats.rebuild(self.collection, self.stats)
+
+    def test_incremental_counts(self):
+        # Test the counts follow the single and bulk writes
+        total = client.get("/stats").json()["total"]
+        company = CompanyModel(siret=72345600001, siren=723456, nic=1, activitePrincipaleEtablissement="99.99Z", codeCommuneEtablissement="97411")
+        client.post("/", json=company.dict())
+        client.post("/bulk", json=[dict(company.dict(), siret=72345600002, nic=2, codeCommuneEtablissement="2A004")])
+        client.put("/72345600001", json={"activitePrincipaleEtablissement": "99.98Z", "codeCommuneEtablissement": "97411"})
+        client.put("/bulk", json=[{"siret": 72345600002, "activitePrincipaleEtablissement": "99.99Z", "etatAdministratifEtablissement": "F"}])
+
+        counts = client.get("/stats").json()
+        self.assertEqual(counts["total"], total + 2)
+        self.assertEqual((counts["activitePrincipaleEtablissement"]["99.98Z"], counts["activitePrincipaleEtablissement"]["99.99Z"]), (1, 1))
+        self.assertEqual(client.get("/stats", params={"dimension": "departement"}).json()["departement"]["974"], 1)
+        self.assertEqual(client.get("/stats", params={"dimension": "siret"}).status_code, 400)
+
+        # Test the incremental counts match a full recompute
+        client.delete("/delete/72345600001")
+        client.request("DELETE", "/bulk", json={"sirets": [72345600002]})
+        self.assertEqual(stats.verify(self.collection, self.stats), [])
+        self.assertNotIn("99.99Z", client.get("/stats").json()["activitePrincipaleEtablissement"])
+
+        # Test a rebuild fixes a drifted count, the values no company holds being dropped
+        self.stats.update_one({"_id": "total"}, {"$inc": {"count": 3}})
+        self.stats.insert_one({"_id": "activitePrincipaleEtablissement=99.96Z", "dimension": "activitePrincipaleEtablissement", "value": "99.96Z", "count": 1})
+        self.assertEqual(len(stats.verify(self.collection, self.stats)), 2)
+        stats.rebuild(self.collection, self.stats)
+        self.assertEqual(stats.verify(self.collection, self.stats), [])
+        self.assertIsNone(self.stats.find_one({"value": "99.96Z"}))
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.collection = init_collection()
+        for nic in range(1, 4):
+            company = CompanyModel(siret=int(f"923456{nic:05}"), siren=923456, nic=nic, codeCommuneEtablissement="2A004",
+            dateCreationEtablissement="2001-02-03", etatAdministratifEtablissement="A" if nic < 3 else "F")
+            self.collection.insert_one(create_new_company(company))
+
+    def tearDown(self):
+        self.collection.delete_many({"siren": 923456})
+
+    def test_export(self):
+        # Test the active companies of a département, streamed by batches of one company
+        params = {"departement": "2A", "etatAdministratifEtablissement": "A", "batch_size": 1, "fields": "siren,dateCreationEtablissement"}
+        response = client.get("/export", params=params)
+        self.assertEqual([json.loads(line) for line in response.text.splitlines()],
+        [{"siret": int(f"923456{nic:05}"), "siren": 923456, "dateCreationEtablissement": "2001-02-03"} for nic in (1, 2)])
+
+        # Test the CSV format, compressed
+        response = client.get("/export", params=dict(params, format="csv", gzip=True))
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertEqual(response.text.splitlines(), ["siret,siren,dateCreationEtablissement",
+        "92345600001,923456,2001-02-03", "92345600002,923456,2001-02-03"])
+
+        # Test an unknown format
+        response = client.get("/export", params={"format": "xlsx"})
+        self.assertEqual(response.status_code, 400)
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.collection = init_collection()
+        api.company_cache.clear()
+        self.sirets = [22345600001, 22345600002]
+        for siret in self.sirets:
+            company = CompanyModel(siret=siret, siren=223456, nic=siret % 100000)
+            self.collection.insert_one(create_new_company(company))
+
+    def tearDown(self):
+        self.collection.delete_many({"siret": {"$in": self.sirets}})
+
+    def test_fetch_batch(self):
+        # Test fetching a batch keeps the input order and reports the misses
+        response = client.post("/get/batch", json={"sirets": [22345600002, 987654321, 22345600001]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([(r["siret"], r["found"]) for r in response.json()],
+        [(22345600002, True), (987654321, False), (22345600001, True)])
+        self.assertEqual(response.json()[0]["results"][0]["nic"], 2)
+
+        # Test the GET variant
+        response = client.get("/get/batch", params={"siret": [22345600001, 987654321]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r["found"] for r in response.json()], [True, False])
+
+        # Test streaming the results as NDJSON
+        response = client.post("/get/batch", params={"format": "ndjson"}, json={"sirets": self.sirets})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([json.loads(line)["siret"] for line in response.text.splitlines()], self.sirets)
+
+        # Test an empty batch
+        response = client.post("/get/batch", json={"sirets": []})
+        self.assertEqual(response.status_code, 400)
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = TTLCache(maxsize=2, ttl=10, negative_ttl=1, timer=lambda: self.now)
+
+    def test_eviction_and_expiration(self):
+        # Test the least recently used entry is evicted first
+        self.cache.set(1, ["a"])
+        self.cache.set(2, ["b"])
+        self.cache.get(1)
+        self.cache.set(3, ["c"])
+        self.assertIs(self.cache.get(2), MISSING)
+        self.assertEqual(self.cache.get(1), ["a"])
+
+        # Test unknown sirets expire sooner than companies
+        self.cache.set(4, [])
+        self.now = 5
+        self.assertIs(self.cache.get(4), MISSING)
+        self.assertEqual(self.cache.get(1), ["a"])
+        self.now = 11
+        self.assertIs(self.cache.get(1), MISSING)
+
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["evictions"], stats["expirations"]), (3, 2, 2))
+
+    def test_write_invalidation(self):
+        # Test a cached 404 doesn't survive the insertion of the company
+        api.company_cache.clear()
+        company = CompanyModel(siret=32345600001, siren=323456, nic=1)
+        self.assertEqual(client.get("/get", params={"siret": company.siret}).status_code, 404)
+        self.assertEqual(client.post("/", json=company.dict()).status_code, 200)
+        self.assertEqual(client.get("/get", params={"siret": company.siret}).status_code, 200)
+
+        # Test the deletion drops the cached company
+        self.assertEqual(client.delete(f"/delete/{company.siret}").status_code, 200)
+        self.assertEqual(client.get("/get", params={"siret": company.siret}).status_code, 404)
+        self.assertGreater(client.get("/cache/stats").json()["invalidations"], 0)
+
+    def test_other_worker_invalidation(self):
+        # Another worker has cached the company before its update by this one
+        company = CompanyModel(siret=33345600001, siren=333456, nic=1, etatAdministratifEtablissement="A")
+        self.assertEqual(client.post("/", json=company.dict()).status_code, 200)
+        other = TTLCache()
+        other.set(company.siret, [create_new_company(company)])
+        since = datetime.utcnow()
+        self.assertEqual(client.put(f"/{company.siret}", json={"etatAdministratifEtablissement": "F"}).status_code, 200)
+
+        # Test its next poll drops the company, a poll without any new write keeping its cache
+        since = asyncio.run(invalidation.poll(api.invalidations, other, since))
+        self.assertIs(other.get(company.siret), MISSING)
+        other.set(company.siret, [create_new_company(company)])
+        with mock.patch.object(md, "CACHE_SYNC_MARGIN", 0):
+            asyncio.run(invalidation.poll(api.invalidations, other, since))
+        self.assertIsNot(other.get(company.siret), MISSING)
+        self.assertEqual(client.delete(f"/delete/{company.siret}").status_code, 200)
+
+class TestHealth(unittest.TestCase):
+    def test_probes(self):
+        self.assertEqual(client.get("/health/live").json(), {"status": "alive"})
+        self.assertEqual(client.get("/health/ready").json(), {"status": "ready"})
+
+    def test_database_unavailable(self):
+        # Test a database unreachable at startup leaves the worker alive but not ready
+        state = (api.client, api.collection, api.names, api.stats_collection, api.invalidations, api.invalidation_task, api.prewarm_task, api.indexes_checked)
+        unavailable = mock.patch.object(ctrl, "has_unique_siret_index", side_effect=ServerSelectionTimeoutError("unreachable"))
+        try:
+            with unavailable:
+                asyncio.run(api.startup())
+                self.assertFalse(api.indexes_checked)
+                self.assertEqual(client.get("/health/live").status_code, 200)
+                response = client.get("/health/ready")
+                self.assertEqual(response.status_code, 503)
+                self.assertIn("ServerSelectionTimeoutError", response.json()["detail"])
+
+            # Test the readiness probe checks the indexes once the database answers
+            self.assertEqual(client.get("/health/ready").status_code, 200)
+            self.assertTrue(api.indexes_checked)
+        finally:
+            for async_collection in (api.collection, api.names, api.stats_collection, api.invalidations):
+                async_collection.close()
+            api.client, api.collection, api.names, api.stats_collection, api.invalidations, api.invalidation_task, api.prewarm_task, api.indexes_checked = state
+
+    def test_index_migration(self):
+        # Test a worker isn't ready without the unique siret indexes
+        with mock.patch.object(ctrl, "has_unique_siret_index", return_value=False):
+            asyncio.run(api.check_indexes())
+            response = client.get("/health/ready")
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("--migrate-indexes", response.json()["detail"])
+        self.assertEqual(client.get("/health/ready").status_code, 200)
+
+        # Test the non unique index of a previous version is only replaced without duplicated sirets
+        legacy = init_collection(name="corporate_legacy")
+        legacy.create_index("siret")
+        legacy.insert_many([{"siret": 1}, {"siret": 1}, {"siret": 2}])
+        self.assertFalse(has_unique_siret_index(legacy))
+        with self.assertRaises(ValueError):
+            ensure_siret_index(legacy)
+        self.assertIn("siret_1", legacy.index_information())
+        legacy.delete_one({"siret": 1})
+        ensure_siret_index(legacy)
+        self.assertTrue(has_unique_siret_index(legacy))
+        legacy.drop()
+
+    def test_prewarm(self):
+        # Test the sirets of the file are loaded into the cache, the unknown ones included
+        company = CompanyModel(siret=62345600001, siren=623456, nic=1)
+        self.assertEqual(client.post("/", json=company.dict()).status_code, 200)
+        api.company_cache.clear()
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f"{tmp}/hot.txt"
+            with open(path, "w") as file:
+                file.write(f"{company.siret}\n62345600002\n\n")
+            asyncio.run(api.prewarm(path))
+        self.assertEqual(api.company_cache.get(company.siret)[0]["siret"], company.siret)
+        self.assertEqual(api.company_cache.get(62345600002), [])
+
+        # Test a missing file only leaves the cache cold
+        asyncio.run(api.prewarm(f"{tmp}/missing.txt"))
+        self.assertEqual(client.delete(f"/delete/{company.siret}").status_code, 200)
+
+class TestMetrics(unittest.TestCase):
+    def test_metrics(self):
+        # Test the latency is recorded per route template and status, not per siret
+        client.get("/get", params={"siret": 42345600001})
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('siret_api_requests_total{route="/get",method="GET",status="404"}', response.text)
+        self.assertIn('siret_api_request_duration_seconds_bucket{route="/get",method="GET",status="404",le="+Inf"}', response.text)
+
+        # Test the stages of the requests are timed
+        for stage in ["mongo", "endpoint", "logging"]:
+            self.assertIn(f'siret_api_stage_duration_seconds_count{{stage="{stage}"}}', response.text)
+        self.assertIn("siret_api_requests_in_flight", response.text)
+
+class TestBenchmark(unittest.TestCase):
+    def test_synthetic_companies(self):
+        # Test the synthetic companies are valid, unique and reproducible
+        companies = list(benchmark.synthetic_companies(500, seed=1))
+        for company in companies:
+            model = CompanyModel(**company)
+            self.assertTrue(consistency_siret(model.siret, model.siren, model.nic))
+        self.assertEqual(len({company["siret"] for company in companies}), 500)
+        self.assertEqual(companies, list(benchmark.synthetic_companies(500, seed=1)))
+
+class TestSnapshot(unittest.TestCase):
+    def test_lookup(self):
+        # Test the records written out of order are found by siret, a duplicate keeping its first record
+        companies = [create_new_company(CompanyModel(siret=int(f"52345600{nic:03}"), siren=523456, nic=nic, numeroVoieEtablissement=str(nic))) for nic in [30, 10, 20]]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f"{tmp}/test.snapshot"
+            self.assertEqual(snapshot.write_snapshot(path, companies + [dict(companies[0], numeroVoieEtablissement="0")]), 3)
+            collection = snapshot.SnapshotCollection(path)
+            self.assertEqual(collection.find_one({"siret": 52345600030}, {"_id": False}), companies[0])
+            self.assertEqual(collection.find_one({"siret": 52345600040}), None)
+            found = collection.find({"siret": {"$in": [52345600020, 52345600040, 52345600010]}}, {"_id": False, "nic": True})
+            self.assertEqual(list(found), [{"nic": 10}, {"nic": 20}])
+            self.assertEqual([company["nic"] for company in collection.find({})], [10, 20, 30])
+
+            # Test the writes and the other queries are rejected
+            with self.assertRaises(snapshot.UnsupportedOperation):
+                collection.insert_one(companies[0])
+            with self.assertRaises(snapshot.UnsupportedOperation):
+                collection.find({"siren": 523456})
+
+            # Test a filtered export is rejected before its response starts
+            original, api.collection = api.collection, storage.AsyncCollection(collection)
+            try:
+                self.assertEqual(len(client.get("/export").text.splitlines()), 3)
+                self.assertEqual(client.get("/export", params={"etatAdministratifEtablissement": "A"}).status_code, 501)
+            finally:
+                api.collection.close()
+                api.collection = original
+            collection.close()
+
+class TestSerialization(unittest.TestCase):
+    def test_fast_path(self):
+        # Test the fast path gives the same JSON as the response model, with and without orjson
+        company = create_new_company(CompanyModel(siret=62345600001, siren=623456, nic=1, dateDebut="2020-01-02", etablissementSiege=True,
+                                                  dateDernierTraitementEtablissement="2021-03-04T05:06:07", enseigne1Etablissement="Café"))
+        company["_id"] = "internal"
+        expected = jsonable_encoder(SparseCompanyModel(**company), exclude_none=True)
+        self.assertEqual(json.loads(serialization.encode_companies([company])), [expected])
+        self.assertEqual(list(serialization.company_values(company))[:3], ["siret", "siren", "nic"])
+        self.assertEqual(serialization.jsonable(company), expected)
+
+        encoder, serialization.orjson = serialization.orjson, None
+        try:
+            self.assertEqual(json.loads(serialization.encode_companies([company])), [expected])
+        finally:
+            serialization.orjson = encoder
+
+class SlowCollection:
+    """
+    Stand-in for a pymongo collection whose find queries block for `delay` seconds after reading
+    the documents, the other operations being passed through.
+    """
+    def __init__(self, collection, delay):
+        self.collection = collection
+        self.delay = delay
+        self.queries = 0
+
+    def find(self, *args, **kwargs):
+        self.queries += 1
+        documents = list(self.collection.find(*args, **kwargs))
+        time.sleep(self.delay)
+        return documents
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+class TestConcurrency(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_requests_overlap(self):
+        # Run concurrent lookups against a collection blocking for 0.2s per query
+        delay, n = 0.2, 10
+        original, api.collection = api.collection, storage.AsyncCollection(SlowCollection(init_collection(), delay))
+        try:
+            async with httpx.AsyncClient(app=app, base_url="http://test") as async_client:
+                start = time.perf_counter()
+                responses = await asyncio.gather(*[async_client.get("/get", params={"siret": 987654321 + i}) for i in range(n)])
+                elapsed = time.perf_counter() - start
+        finally:
+            api.collection = original
+
+        # The queries overlap instead of being serialized on the event loop
+        self.assertTrue(all(response.status_code == 404 for response in responses))
+        self.assertLess(elapsed, n * delay / 2)
+
+    async def test_thundering_herd(self):
+        # Run identical concurrent lookups against a collection blocking for 0.2s per query
+        n = 50
+        api.company_cache.clear()
+        slow = SlowCollection(init_collection(), 0.2)
+        original, api.collection = api.collection, storage.AsyncCollection(slow)
+        try:
+            async with httpx.AsyncClient(app=app, base_url="http://test") as async_client:
+                responses = await asyncio.gather(*[async_client.get("/get", params={"siret": 987654300}) for _ in range(n)])
+                metrics = (await async_client.get("/metrics")).text
+        finally:
+            api.collection = original
+
+        # A single query answers every request
+        self.assertTrue(all(response.status_code == 404 for response in responses))
+        self.assertEqual(slow.queries, 1)
+        self.assertIn('siret_api_singleflight_calls_total{group="get",role="coalesced"}', metrics)
+        self.assertEqual(len(api.lookups), 0)
+
+    async def test_write_during_lookup(self):
+        # Update a company while a lookup of the previous version is in flight
+        api.company_cache.clear()
+        company = CompanyModel(siret=82345600001, siren=823456, nic=1, etatAdministratifEtablissement="A")
+        original, api.collection = api.collection, storage.AsyncCollection(SlowCollection(init_collection(), 0.2))
+        try:
+            async with httpx.AsyncClient(app=app, base_url="http://test") as async_client:
+                self.assertEqual((await async_client.post("/", json=company.dict())).status_code, 200)
+                lookup = asyncio.ensure_future(async_client.get("/get", params={"siret": company.siret}))
+                await asyncio.sleep(0.1)
+                self.assertEqual((await async_client.put(f"/{company.siret}", json={"etatAdministratifEtablissement": "F"})).status_code, 200)
+                self.assertEqual((await lookup).json()[0]["etatAdministratifEtablissement"], "A")
+
+                # The lookup in flight doesn't put the previous version back into the cache
+                response = await async_client.get("/get", params={"siret": company.siret})
+                self.assertEqual(response.json()[0]["etatAdministratifEtablissement"], "F")
+                self.assertEqual((await async_client.delete(f"/delete/{company.siret}")).status_code, 200)
+        finally:
+            api.collection = original
+
+class TestLimiter(unittest.IsolatedAsyncioTestCase):
+    def test_token_bucket(self):
+        # Test a client is refused once its burst is spent, the other clients and groups keeping their budget
+        now = [0]
+        rate_limiter = limiter.RateLimiter({"lookup": (2, 3), "export": (0.1, 1)}, timer=lambda: now[0])
+        self.assertEqual([rate_limiter.acquire("a", "lookup") for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(rate_limiter.acquire("a", "lookup"), 0.5)
+        self.assertEqual(rate_limiter.acquire("b", "lookup"), 0)
+        self.assertEqual(rate_limiter.acquire("a", "export"), 0)
+        self.assertAlmostEqual(rate_limiter.acquire("a", "export"), 10)
+
+        # Test the bucket is refilled at its rate
+        now[0] = 0.5
+        self.assertEqual(rate_limiter.acquire("a", "lookup"), 0)
+        self.assertGreater(rate_limiter.acquire("a", "lookup"), 0)
+        self.assertEqual(limiter.route_group("GET", "/get/batch"), "batch")
+        self.assertEqual(limiter.route_group("DELETE", "/delete/1"), "write")
+        self.assertIsNone(limiter.route_group("GET", "/metrics"))
+
+    async def test_admission(self):
+        # Test the requests beyond the slots wait, then are shed once the queue is full or after the timeout
+        admission = limiter.Admission(max_concurrency=1, max_queue=1, timeout=0.05)
+        self.assertTrue(await admission.acquire())
+        waiting = asyncio.ensure_future(admission.acquire())
+        await asyncio.sleep(0)
+        self.assertFalse(await admission.acquire())
+        admission.release()
+        self.assertTrue(await waiting)
+        self.assertFalse(await admission.acquire())
+        admission.release()
+        self.assertEqual(admission.in_flight, 0)
+
+    async def abuse(self, enabled):
+        """
+        Send a burst of 100 concurrent lookups of successive sirets from a host, against a collection
+        blocking for 0.02s per query on 2 threads, then 10 lookups from another host, one every 0.1s.
+
+        Returns:
+            tuple: The responses of the burst and the sorted latencies of the other host.
+        """
+        api.company_cache.clear()
+        api.rate_limiter.clear()
+        md.LIMITER_ENABLED = enabled
+        limits, api.rate_limiter.limits = api.rate_limiter.limits, {"lookup": (10, 10)}
+        original, api.collection = api.collection, storage.AsyncCollection(SlowCollection(init_collection(), 0.02), pool_size=2)
+        latencies = []
+
+        def host_client(host):
+            return httpx.AsyncClient(transport=httpx.ASGITransport(app=app, client=(host, 1234)), base_url="http://test")
+
+        try:
+            async with host_client("10.0.0.1") as abusive, host_client("10.0.0.2") as regular:
+                burst = asyncio.gather(*[abusive.get("/get", params={"siret": siret}) for siret in range(987600000, 987600100)])
+                await asyncio.sleep(0.3)
+                for siret in range(987700000, 987700010):
+                    start = time.perf_counter()
+                    self.assertEqual((await regular.get("/get", params={"siret": siret})).status_code, 404)
+                    latencies.append(time.perf_counter() - start)
+                    await asyncio.sleep(0.1)
+                responses = await burst
+        finally:
+            api.collection = original
+            api.rate_limiter.limits = limits
+            api.rate_limiter.clear()
+            md.LIMITER_ENABLED = False
+
+        return responses, sorted(latencies)
+
+    async def test_abusive_client(self):
+        # Without the rate limits, the burst saturates the collection and delays the other host
+        _, latencies = await self.abuse(enabled=False)
+        self.assertGreater(latencies[-1], 0.6)
+
+        # With the rate limits, the burst is refused once its budget is spent and told when to retry
+        responses, latencies = await self.abuse(enabled=True)
+        refused = [response for response in responses if response.status_code == 429]
+        self.assertGreaterEqual(len(refused), 80)
+        self.assertEqual(refused[0].headers["Retry-After"], "1")
+
+        # The other host is always served, its p99 staying bounded
+        self.assertLess(latencies[int(0.99 * len(latencies))], 0.4)
+
 if __name__ == 'main':
     unittest.main()
\ No newline at end of file